@@ -1,40 +1,77 @@
-from flask import Blueprint, render_template, request, jsonify, session
+from flask import Blueprint, render_template, request, jsonify, Response, stream_with_context, abort, make_response
 import sys
 import os
+import json
 from datetime import datetime
 
 # 親ディレクトリにある chatbot.py を import できるようにする
 sys.path.append(os.path.dirname(os.path.dirname(os.path.dirname(__file__))))
 import chatbot
+from app.services.farm_repository import farm_repository, current_owner_id
+from app.services.embedding_cache import embedding_cache
+from app.services.response_cache import response_cache
+from app.services.question_router import route_latency
+from app.services.conversation_store import conversation_store
 
 chatbot_bp = Blueprint('chatbot', __name__, url_prefix='/chatbot')
 
 @chatbot_bp.route('/')
 def chatbot_view():
-    return render_template('chatbot.html', title='AIアグリアドバイザー')
+    farms = farm_repository.list(current_owner_id(), detail=False)
+    return render_template('chatbot.html', title='AIアグリアドバイザー', farms=farms)
 
-@chatbot_bp.route('/ask', methods=['POST'])
-def ask_question():
-    data = request.json
+def _question_args():
+    # リクエストのJSONから質問・農場ID・日付を取り出す
+    data = request.json or {}
     question = data.get('question', '')
     farm_id = data.get('farm_id', None)
     date = data.get('date', None)
     
-    # 農場IDがない場合、セッションから取得を試みる
+    # 農場IDは数値のみ受け付ける（ストリーミングの開始後ではエラーを返せないため、ここで確認する）
+    if farm_id:
+        try:
+            farm_id = int(farm_id)
+        except (TypeError, ValueError):
+            abort(make_response(jsonify({'error': '農場IDが正しくありません'}), 400))
+    
+    # 農場IDがない場合、利用者の最初の農場を使用
     if not farm_id:
-        farms = session.get('farms', [])
+        farms = farm_repository.list(current_owner_id(), detail=False)
         if farms:
             farm_id = farms[0]['id']
     
     # 日付がない場合、現在の日付を使用
     if not date:
         date = datetime.now().strftime('%Y-%m-%d')
+    return question, farm_id, date
+
+@chatbot_bp.route('/ask', methods=['POST'])
+def ask_question():
+    question, farm_id, date = _question_args()
     
     # chatbot.py の関数を呼び出し
     response = chatbot.generate_rag_response(question, farm_id, date)
     
     return jsonify({'response': response})
 
+@chatbot_bp.route('/ask/stream', methods=['POST'])
+def ask_question_stream():
+    """回答のトークンとツールの進捗をServer-Sent Eventsで順次返す"""
+    question, farm_id, date = _question_args()
+    
+    # セッションの更新（会話スレッドID）はレスポンスの送信前に済ませる
+    events = chatbot.stream_rag_response(question, farm_id, date)
+    
+    def sse():
+        for event in events:
+            yield f"event: {event['event']}\ndata: {json.dumps(event['data'], ensure_ascii=False)}\n\n"
+    
+    response = Response(stream_with_context(sse()), mimetype='text/event-stream')
+    response.headers['Cache-Control'] = 'no-cache'
+    # リバースプロキシでバッファリングされないようにする
+    response.headers['X-Accel-Buffering'] = 'no'
+    return response
+
 @chatbot_bp.route('/farm/<int:farm_id>/advice', methods=['GET'])
 def get_farm_advice(farm_id):
     """特定の農場に対するNDVIデータと農業アドバイスを取得"""
@@ -42,7 +79,7 @@ def get_farm_advice(farm_id):
     
     # NDVIデータに基づいたアドバイスを生成
     question = "この農場の現在の状態について詳細な分析と今後の管理方法のアドバイスを提供してください"
-    advice = chatbot.generate_rag_response(question, farm_id, date)
+    advice = chatbot.generate_rag_response(question, farm_id, date, use_cache=True)
     
     return jsonify({
         'farm_id': farm_id,
@@ -59,19 +96,28 @@ def get_weather_advice():
     
     # 緯度経度がない場合、農場IDから取得を試みる
     if not (lat and lng) and farm_id:
-        farms = session.get('farms', [])
-        farm = next((f for f in farms if f['id'] == int(farm_id)), None)
+        farm = farm_repository.get(int(farm_id), current_owner_id())
         if farm and farm.get('coordinates'):
             coords = farm['coordinates'][0] if isinstance(farm['coordinates'], list) else farm['coordinates']
             lat = coords.get('lat')
             lng = coords.get('lng')
     
     question = "今後の天候予報に基づいて、農場管理のアドバイスを提供してください"
-    advice = chatbot.generate_rag_response(question, farm_id)
+    advice = chatbot.generate_rag_response(question, farm_id, use_cache=True)
     
     return jsonify({
         'farm_id': farm_id,
         'lat': lat,
         'lng': lng,
         'advice': advice
-    })
\ No newline at end of file
+    })
+
+@chatbot_bp.route('/stats', methods=['GET'])
+def chatbot_stats():
+    """チャットボットのキャッシュ・保存している会話の統計情報と回答経路ごとの応答時間を返す"""
+    return jsonify({
+        'embedding_cache': embedding_cache.stats(),
+        'response_cache': response_cache.stats(),
+        'conversations': conversation_store.stats(),
+        'routes': route_latency.stats()
+    })
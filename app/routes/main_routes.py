@@ -1,13 +1,24 @@
-from flask import Blueprint, render_template, jsonify, request, redirect, url_for, session
+from flask import Blueprint, render_template, jsonify, request, redirect, url_for, send_file, abort
 from app.services.satellite_service import get_latest_ndvi_data, get_ndvi_data_by_date, validate_farm_area, get_farm_ndvi_image
+from app.services.ndvi_timeseries import get_farm_ndvi_timeseries
+from app.services.farm_batch import get_farms_ndvi_batch
+from app.services import ndvi_history
+from app.services.job_service import job_manager
+from app.services.farm_mask import rasterize_polygon, encode_mask
+from app.services.ndvi_render import image_store, MIMETYPES
+from app.services.farm_repository import farm_repository, current_owner_id
+from app.services.ndvi_analytics import panel_cache, TREND_WINDOW_DAYS
 from datetime import datetime, timedelta
 
 main = Blueprint('main', __name__)
 
+# 描画済み画像のブラウザキャッシュ期間（秒）
+IMAGE_MAX_AGE = 365 * 24 * 3600
+
 @main.route('/')
 def index():
     # 登録済み農場があるかチェック
-    farms = session.get('farms', [])
+    farms = farm_repository.list(current_owner_id(), detail=False)
     return render_template('index.html', title='Agristar - スマート農業の未来', farms=farms)
 
 @main.route('/farm/register', methods=['GET', 'POST'])
@@ -21,39 +32,29 @@ def register_farm():
         if not validation['valid']:
             return jsonify({'success': False, 'error': validation['message']})
         
-        # セッションから既存の農場リストを取得
-        farms = session.get('farms', [])
-        
-        # 新しい農場IDを生成
-        farm_id = len(farms) + 1
-        
-        # 新しい農場データを作成
-        new_farm = {
-            'id': farm_id,
-            'name': farm_data.get('name'),
-            'coordinates': farm_data.get('coordinates'),  # 4か所の座標を保存
-            'bbox': validation['bbox'],  # バウンディングボックスを保存
-            'created_at': farm_data.get('created_at')
-        }
-        
-        # 農場リストに追加
-        farms.append(new_farm)
+        # 新しい農場をリポジトリに登録（IDはリポジトリで採番）
+        new_farm = farm_repository.add(
+            current_owner_id(),
+            farm_data.get('name'),
+            farm_data.get('coordinates'),  # 4か所の座標を保存
+            validation['bbox'],  # バウンディングボックスを保存
+            # 農場ポリゴンを取得グリッド上にラスタライズしたマスク（NDVI統計の集計範囲）
+            mask=encode_mask(rasterize_polygon(
+                farm_data.get('coordinates'), validation['bbox'], (validation['size'][1], validation['size'][0])
+            )),
+            crop_type=farm_data.get('crop_type'),
+            created_at=farm_data.get('created_at')
+        )
         
-        # セッションを更新
-        session['farms'] = farms
-        
-        return jsonify({'success': True, 'farm_id': farm_id})
+        return jsonify({'success': True, 'farm_id': new_farm['id']})
     
     # GETリクエストの場合は地図画面を表示
     return render_template('farm_register.html', title='農場登録')
 
 @main.route('/farm/<int:farm_id>')
 def view_farm(farm_id):
-    # セッションから農場データを取得
-    farms = session.get('farms', [])
-    
-    # 指定されたIDの農場を検索
-    farm = next((f for f in farms if f['id'] == farm_id), None)
+    # 指定されたIDの農場を取得
+    farm = farm_repository.get(farm_id, current_owner_id())
     
     if not farm:
         # 農場が見つからない場合はトップページにリダイレクト
@@ -62,19 +63,11 @@ def view_farm(farm_id):
     # 農場データを表示
     return render_template('farm_view.html', title=f'農場: {farm["name"]}', farm=farm)
 
-@main.route('/farm/<int:farm_id>/ndvi', methods=['POST'])
-def calculate_ndvi(farm_id):
-    # セッションから農場データを取得
-    farms = session.get('farms', [])
-    farm = next((f for f in farms if f['id'] == farm_id), None)
-    
-    if not farm:
-        return jsonify({'success': False, 'error': '農場が見つかりません'})
-    
-    # リクエストから日付を取得
-    data = request.json
-    date_str = data.get('date')
-    
+def _run_ndvi_calculation(farm, date_str):
+    """
+    農場のNDVIを計算し、レスポンス用の辞書を返します。
+    バックグラウンドジョブからも呼ばれるため、sessionやrequestには依存しません。
+    """
     # 日付が指定されていない場合は最近5日間を使用
     if date_str:
         date_obj = datetime.strptime(date_str, '%Y-%m-%d')
@@ -85,37 +78,208 @@ def calculate_ndvi(farm_id):
         date_range = None
     
     # NDVI画像を取得
-    result = get_farm_ndvi_image(farm['coordinates'], date_range)
+    result = get_farm_ndvi_image(farm['coordinates'], date_range, farm_mask=farm.get('mask'))
     
     if not result['success']:
-        return jsonify({'success': False, 'error': result['message']})
+        return {'success': False, 'error': result['message']}
+    
+    ndvi_stats = result['data']['ndvi_stats']
+    if 'mean' not in ndvi_stats:
+        return {'success': False, 'error': ndvi_stats['message']}
     
     # 結果を返す
     ndvi_result = {
-        'farm_id': farm_id,
+        'farm_id': farm['id'],
         'farm_name': farm['name'],
-        'average_ndvi': result['data']['ndvi_stats']['mean'],
-        'min_ndvi': result['data']['ndvi_stats']['min'],
-        'max_ndvi': result['data']['ndvi_stats']['max'],
-        'median_ndvi': result['data']['ndvi_stats']['median'],
-        'ndvi_image': result['data']['ndvi_image'],
-        'rgb_image': result['data']['rgb_image'],
+        'average_ndvi': ndvi_stats['mean'],
+        'min_ndvi': ndvi_stats['min'],
+        'max_ndvi': ndvi_stats['max'],
+        'median_ndvi': ndvi_stats['median'],
+        'health_zones': result['data']['health_zones'],
+        # bandsモードで指数の計算中に確保した最大バイト数の見積もり（indexモードは None）
+        'peak_bytes': result['data']['peak_bytes'],
+        'ndvi_image_id': result['data']['ndvi_image_id'],
+        'rgb_image_id': result['data']['rgb_image_id'],
+        'bbox': result['data']['bbox'],
         'date': date_str or datetime.now().strftime('%Y-%m-%d'),
         'start_date': result['data']['start_date'], # 開始日を追加
         'end_date': result['data']['end_date'] 
     }
     
-    return jsonify({'success': True, 'result': ndvi_result})
+    return {'success': True, 'result': ndvi_result}
+
+def _with_image_urls(payload):
+    """計算結果の画像IDを配信用のURLに置き換えます（リクエストコンテキストが必要）。"""
+    if not payload.get('success') or 'result' not in payload:
+        return payload
+    result = dict(payload['result'])
+    result['ndvi_image_url'] = url_for('main.rendered_image', image_id=result.pop('ndvi_image_id'))
+    result['rgb_image_url'] = url_for('main.rendered_image', image_id=result.pop('rgb_image_id'))
+    return {**payload, 'result': result}
+
+@main.route('/farm/<int:farm_id>/ndvi', methods=['POST'])
+def calculate_ndvi(farm_id):
+    # 指定されたIDの農場を取得
+    farm = farm_repository.get(farm_id, current_owner_id())
+    
+    if not farm:
+        return jsonify({'success': False, 'error': '農場が見つかりません'})
+    
+    # リクエストから日付を取得
+    data = request.json or {}
+    date_str = data.get('date')
+    
+    # 非同期モード: ジョブIDをすぐに返し、計算はバックグラウンドで実行
+    if data.get('async'):
+        job_id = job_manager.submit(_run_ndvi_calculation, farm, date_str)
+        return jsonify({
+            'success': True,
+            'job_id': job_id,
+            'status_url': url_for('main.ndvi_job_status', job_id=job_id)
+        }), 202
+    
+    return jsonify(_with_image_urls(_run_ndvi_calculation(farm, date_str)))
+
+@main.route('/farm/ndvi/jobs/<job_id>')
+def ndvi_job_status(job_id):
+    job = job_manager.get(job_id)
+    
+    if not job:
+        return jsonify({'success': False, 'error': 'ジョブが見つかりません'}), 404
+    
+    if job['status'] == 'done':
+        return jsonify({'status': 'done', **_with_image_urls(job['result'])})
+    if job['status'] == 'failed':
+        return jsonify({'status': 'failed', 'success': False, 'error': job['error']})
+    
+    # 実行中はクライアントに再ポーリングを促す
+    return jsonify({'status': job['status'], 'success': True})
+
+@main.route('/farm/images/<image_id>')
+def rendered_image(image_id):
+    path = image_store.path_for(image_id)
+    
+    if not path:
+        abort(404)
+    
+    # 画像IDは内容のハッシュなので、同じURLの内容は変わらない
+    fmt = image_id.rsplit('.', 1)[1]
+    response = send_file(path, mimetype=MIMETYPES[fmt], etag=image_id.split('.')[0], max_age=IMAGE_MAX_AGE)
+    response.cache_control.immutable = True
+    return response
+
+def _run_ndvi_backfill(farm, start_date, end_date):
+    """
+    農場のNDVI時系列を取得して履歴に保存し、レスポンス用の辞書を返します。
+    バックグラウンドジョブから呼ばれるため、sessionやrequestには依存しません。
+    """
+    try:
+        # 保存した観測はトレンド用のパネルにも追加する
+        series = get_farm_ndvi_timeseries(
+            farm, start_date, end_date,
+            on_result=lambda item: panel_cache.update(farm['id'], item['date'], item['ndvi_stats']['mean'])
+        )
+    except ValueError as e:
+        return {'success': False, 'error': str(e)}
+    
+    return {
+        'success': True,
+        'farm_id': farm['id'],
+        'start_date': start_date,
+        'end_date': end_date,
+        'series': [{'date': item['date'], **item['ndvi_stats']} for item in series]
+    }
+
+@main.route('/farm/<int:farm_id>/ndvi/backfill', methods=['POST'])
+def backfill_ndvi(farm_id):
+    # 指定されたIDの農場を取得
+    farm = farm_repository.get(farm_id, current_owner_id())
+    
+    if not farm:
+        return jsonify({'success': False, 'error': '農場が見つかりません'})
+    
+    # リクエストから期間を取得（指定がない場合は過去180日間）
+    data = request.json or {}
+    try:
+        end_date = data.get('end_date') or datetime.now().strftime('%Y-%m-%d')
+        start_date = data.get('start_date') or (datetime.strptime(end_date, '%Y-%m-%d') - timedelta(days=180)).strftime('%Y-%m-%d')
+        datetime.strptime(start_date, '%Y-%m-%d')
+        datetime.strptime(end_date, '%Y-%m-%d')
+    except ValueError:
+        return jsonify({'success': False, 'error': '日付はYYYY-MM-DD形式で指定してください'})
+    
+    # 期間全体の取得には時間がかかるため、常にバックグラウンドで実行してジョブIDを返す
+    job_id = job_manager.submit(_run_ndvi_backfill, farm, start_date, end_date)
+    return jsonify({
+        'success': True,
+        'job_id': job_id,
+        'status_url': url_for('main.ndvi_job_status', job_id=job_id)
+    }), 202
+
+def _run_ndvi_refresh(farms):
+    """
+    複数の農場の最新のNDVIを近接する農場ごとにまとめて取得し、履歴に保存します。
+    バックグラウンドジョブから呼ばれるため、sessionやrequestには依存しません。
+    """
+    results = get_farms_ndvi_batch(farms)
+    
+    records = []
+    summary = []
+    for farm in farms:
+        result = results.get(farm['id'])
+        if result is None:
+            continue
+        item = {'farm_id': farm['id'], 'farm_name': farm['name'], 'success': result['success']}
+        ndvi_stats = result['data']['ndvi_stats'] if result['success'] else {}
+        if 'mean' in ndvi_stats:
+            # 期間の終了日は最新の撮影日（撮影日が分からない場合は直近の日付）
+            date = result['data']['date_range'][1]
+            records.append((farm['id'], date, ndvi_stats, farm.get('crop_type')))
+            item.update(date=date, **ndvi_stats)
+        else:
+            item.update(success=False, error=ndvi_stats.get('message') or result['message'])
+        summary.append(item)
+    
+    ndvi_history.save_ndvi_records(records)
+    for farm_id, date, ndvi_stats, _ in records:
+        panel_cache.update(farm_id, date, ndvi_stats['mean'])
+    
+    return {'success': True, 'farms': summary}
+
+@main.route('/farm/ndvi/refresh', methods=['POST'])
+def refresh_ndvi():
+    # 利用者の全農場の最新のNDVIをまとめて取得する（時間がかかるため常にバックグラウンドで実行）
+    farms = farm_repository.list(current_owner_id())
+    
+    if not farms:
+        return jsonify({'success': False, 'error': '農場が登録されていません'})
+    
+    job_id = job_manager.submit(_run_ndvi_refresh, farms)
+    return jsonify({
+        'success': True,
+        'job_id': job_id,
+        'status_url': url_for('main.ndvi_job_status', job_id=job_id)
+    }), 202
+
+@main.route('/farm/ndvi/trends')
+def ndvi_trends():
+    # 利用者の全農場のNDVIトレンドをまとめて返す（?days= で対象期間、?window_days= でトレンドの期間を指定）
+    days = request.args.get('days', 365, type=int)
+    window_days = request.args.get('window_days', TREND_WINDOW_DAYS, type=int)
+    start_date = (datetime.now() - timedelta(days=days)).strftime('%Y-%m-%d')
+    
+    farms = farm_repository.list(current_owner_id(), detail=False)
+    report = panel_cache.report([farm['id'] for farm in farms], start_date, window_days)
+    
+    return jsonify({
+        'success': True,
+        'start_date': start_date,
+        'farms': [{'farm_id': farm['id'], 'farm_name': farm['name'], **report[farm['id']]} for farm in farms]
+    })
 
 @main.route('/farm/delete/<int:farm_id>', methods=['POST'])
 def delete_farm(farm_id):
-    # セッションから農場データを取得
-    farms = session.get('farms', [])
-    
     # 指定されたIDの農場を削除
-    farms = [farm for farm in farms if farm['id'] != farm_id]
-    
-    # セッションを更新
-    session['farms'] = farms
+    farm_repository.delete(farm_id, current_owner_id())
     
     return jsonify({'success': True})
\ No newline at end of file
@@ -1,34 +1,144 @@
-from flask import Blueprint, render_template, jsonify, request ,session
-from app.services.satellite_service import get_latest_ndvi_data, get_ndvi_data_by_date, get_available_dates
+from flask import Blueprint, render_template, jsonify, request, make_response, abort
+from app.services.satellite_service import (
+    get_latest_ndvi_data, get_ndvi_data_by_date, get_available_dates, get_encoded_ndvi_grid
+)
+from app.services.ndvi_tiles import get_ndvi_tile, empty_tile, validate_tile, tile_bounds
+from app.services.farm_repository import farm_repository, current_owner_id
+from app.services.ndvi_grid import GRID_SIZE, GRID_MIMETYPE, GRID_DTYPES
+import hashlib
 
 map_bp = Blueprint('map', __name__, url_prefix='/map')
 
 @map_bp.route('/')
 def map_view():
-    # 最新の衛星画像取得日
-    latest_date = get_available_dates()[0] if get_available_dates() else "データなし"
-    return render_template('map.html', title='農場マップ', latest_date=latest_date)
+    # NDVIタイルは農場ごとの最新の撮影日で描画するため、ここでは日付を調べない
+    return render_template('map.html', title='農場マップ')
+
+# グリッドサイズの上限（クエリパラメータ grid_size で指定可能）
+MAX_GRID_SIZE = 1000
+
+def _requested_grid_size():
+    grid_size = request.args.get('grid_size', GRID_SIZE, type=int)
+    return min(max(grid_size, 1), MAX_GRID_SIZE)
+
+def _requested_bbox():
+    # クエリパラメータ bbox=min_lon,min_lat,max_lon,max_lat（指定がなければ None）
+    value = request.args.get('bbox')
+    if not value:
+        return None
+    try:
+        bbox = tuple(float(v) for v in value.split(','))
+    except ValueError:
+        bbox = ()
+    if len(bbox) != 4:
+        raise ValueError('bboxは min_lon,min_lat,max_lon,max_lat の形式で指定してください')
+    return bbox
+
+def _wants_binary_grid():
+    # ?format=grid または Accept: application/vnd.agristar.ndvi-grid の場合はバイナリ形式で返す
+    if request.args.get('format') == 'grid':
+        return True
+    return request.accept_mimetypes.best_match([GRID_MIMETYPE, 'application/json']) == GRID_MIMETYPE
+
+def _binary_grid_response(date_str):
+    dtype = request.args.get('dtype', 'float32')
+    if dtype not in GRID_DTYPES:
+        return jsonify({'error': 'dtypeは float32 または uint8 を指定してください'}), 400
+    date_str, data, compressed = get_encoded_ndvi_grid(date_str, _requested_grid_size(), dtype)
+
+    # gzipと非圧縮はバイト列が異なるため、ETagにエンコーディングを含める
+    etag = hashlib.sha1(data).hexdigest()
+    if 'gzip' in request.accept_encodings:
+        response = make_response(compressed)
+        response.headers['Content-Encoding'] = 'gzip'
+        etag += '-gzip'
+    else:
+        response = make_response(data)
+    response.mimetype = GRID_MIMETYPE
+    response.vary.update(('Accept', 'Accept-Encoding'))
+    response.headers['X-NDVI-Date'] = date_str
+    response.set_etag(etag)
+    response.cache_control.max_age = 300
+    return response.make_conditional(request)
 
 @map_bp.route('/data/latest')
 def get_latest_data():
     # 最新のNDVIデータを返す
-    data = get_latest_ndvi_data()
+    if _wants_binary_grid():
+        return _binary_grid_response(None)
+    data = get_latest_ndvi_data(_requested_grid_size())
     return jsonify(data)
 
 @map_bp.route('/data/by-date/<date_str>')
 def get_data_by_date(date_str):
     # 指定日のNDVIデータを返す
-    data = get_ndvi_data_by_date(date_str)
+    try:
+        if _wants_binary_grid():
+            return _binary_grid_response(date_str)
+        data = get_ndvi_data_by_date(date_str, _requested_grid_size())
+    except ValueError:
+        return jsonify({'error': '日付はYYYYMMDD形式で指定してください'}), 400
     return jsonify(data)
 
 @map_bp.route('/dates')
 def available_dates():
-    # 利用可能な日付リストを返す
-    dates = get_available_dates()
+    # 利用可能な日付リストを返す（?bbox=min_lon,min_lat,max_lon,max_lat&max_cloud_cover=% で範囲と雲量を指定可能）
+    try:
+        bbox = _requested_bbox()
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    dates = get_available_dates(bbox, request.args.get('max_cloud_cover', type=float))
     return jsonify(dates)
 
+# このズームレベル未満では農場のポリゴンを返さず、中心点だけを返す
+FARM_DETAIL_MIN_ZOOM = 12
+
+def _farm_center(farm):
+    bbox = farm['bbox']
+    return {'lat': (bbox[1] + bbox[3]) / 2, 'lng': (bbox[0] + bbox[2]) / 2}
+
 @map_bp.route('/farms')
 def get_farms_data():
-    """登録された農場データを返す"""
-    farms = session.get('farms', [])
+    """
+    登録された農場データを返す
+    ?bbox=min_lon,min_lat,max_lon,max_lat を指定した場合は表示範囲に掛かる農場のみ、
+    ?zoom= が FARM_DETAIL_MIN_ZOOM 未満の場合は座標を中心点だけにして返す
+    """
+    owner_id = current_owner_id()
+    try:
+        bbox = _requested_bbox()
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    if bbox:
+        farms = farm_repository.find_in_bbox(bbox, owner_id, detail=False)
+    else:
+        farms = farm_repository.list(owner_id, detail=False)
+    
+    zoom = request.args.get('zoom', type=int)
+    if zoom is not None and zoom < FARM_DETAIL_MIN_ZOOM:
+        farms = [{'id': farm['id'], 'name': farm['name'], 'coordinates': _farm_center(farm)} for farm in farms]
     return jsonify(farms)
+
+
+@map_bp.route('/tiles/ndvi/<date_str>/<int:z>/<int:x>/<int:y>.png')
+def ndvi_tile(date_str, z, x, y):
+    """農場のNDVIをXYZタイルとして返す"""
+    try:
+        validate_tile(z, x, y)
+        # タイルに掛かる農場だけをR-treeインデックスで取得
+        farms = farm_repository.find_in_bbox(tile_bounds(z, x, y), current_owner_id())
+        data = get_ndvi_tile(date_str, z, x, y, farms)
+    except ValueError:
+        abort(404)
+    
+    # 農場が掛からないタイルは透明画像を返す
+    if data is None:
+        data = empty_tile()
+    
+    response = make_response(data)
+    response.mimetype = 'image/png'
+    response.set_etag(hashlib.sha1(data).hexdigest())
+    # タイルは利用者の農場ごとに異なり、新しい衛星データで更新されるため短めにキャッシュする
+    response.cache_control.private = True
+    response.cache_control.max_age = 300
+    return response.make_conditional(request)
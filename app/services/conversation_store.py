@@ -0,0 +1,268 @@
+"""
+チャットボットの会話履歴（LangGraphのチェックポイント）をSQLiteに保存するモジュール
+
+MemorySaver と違い、会話はプロセスの外（SQLiteのファイル）に保存されるため、再起動後も続けられ、
+gunicorn の複数のワーカーで同じ会話を共有できます。
+保存するのは会話スレッドごとに最新のチェックポイントだけで、古いチェックポイントは上書きします。
+一定期間（ttl）更新のない会話スレッドは削除します。
+
+会話の長さ自体の上限（ターン数・トークン数と古いターンの要約）は chatbot.py の compact_history で管理します。
+"""
+import os
+import time
+import sqlite3
+import threading
+
+from langgraph.checkpoint.base import BaseCheckpointSaver, CheckpointTuple, WRITES_IDX_MAP
+
+DEFAULT_DB_PATH = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.dirname(__file__))), 'instance', 'conversations.db'
+)
+# 古い会話スレッドの削除を行う間隔（チェックポイントの保存回数）
+EVICT_EVERY_PUTS = 500
+
+
+class ConversationStore(BaseCheckpointSaver):
+    """会話スレッドごとに最新のチェックポイントだけを保存するSQLiteのチェックポインター"""
+
+    def __init__(self, db_path=DEFAULT_DB_PATH, ttl=7 * 24 * 3600):
+        """
+        パラメータ:
+        db_path (str): SQLiteデータベースのパス。
+        ttl (float): 会話スレッドを保持する期間（最後の更新からの秒数）。
+        """
+        super().__init__()
+        self.db_path = db_path
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._conn = None
+        self._puts_since_evict = 0
+
+    def _connect(self):
+        if self._conn is None:
+            os.makedirs(os.path.dirname(self.db_path), exist_ok=True)
+            conn = sqlite3.connect(self.db_path, timeout=10, check_same_thread=False)
+            # 複数のワーカーから読み書きするため WAL を使う
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.executescript('''
+            CREATE TABLE IF NOT EXISTS checkpoints (
+                thread_id TEXT NOT NULL,
+                checkpoint_ns TEXT NOT NULL,
+                checkpoint_id TEXT NOT NULL,
+                parent_checkpoint_id TEXT,
+                checkpoint_type TEXT,
+                checkpoint BLOB,
+                metadata_type TEXT,
+                metadata BLOB,
+                updated_at REAL NOT NULL,
+                PRIMARY KEY (thread_id, checkpoint_ns)
+            );
+            CREATE INDEX IF NOT EXISTS idx_checkpoints_updated ON checkpoints (updated_at);
+            CREATE TABLE IF NOT EXISTS writes (
+                thread_id TEXT NOT NULL,
+                checkpoint_ns TEXT NOT NULL,
+                checkpoint_id TEXT NOT NULL,
+                task_id TEXT NOT NULL,
+                idx INTEGER NOT NULL,
+                channel TEXT NOT NULL,
+                value_type TEXT,
+                value BLOB,
+                PRIMARY KEY (thread_id, checkpoint_ns, checkpoint_id, task_id, idx)
+            );
+            ''')
+            self._conn = conn
+        return self._conn
+
+    def get_tuple(self, config):
+        """
+        会話スレッドの最新のチェックポイントを返します。
+
+        パラメータ:
+        config (dict): thread_id（と checkpoint_ns, checkpoint_id）を含むグラフの設定。
+
+        戻り値:
+        CheckpointTuple or None: チェックポイント。ない場合（指定したIDが最新でない場合を含む）は None。
+        """
+        configurable = config["configurable"]
+        thread_id = configurable["thread_id"]
+        checkpoint_ns = configurable.get("checkpoint_ns", "")
+        with self._lock:
+            conn = self._connect()
+            row = conn.execute(
+                "SELECT checkpoint_id, parent_checkpoint_id, checkpoint_type, checkpoint, metadata_type, metadata "
+                "FROM checkpoints WHERE thread_id = ? AND checkpoint_ns = ?",
+                (thread_id, checkpoint_ns)
+            ).fetchone()
+            if row is None:
+                return None
+            checkpoint_id = configurable.get("checkpoint_id")
+            if checkpoint_id and checkpoint_id != row[0]:
+                return None
+            writes = conn.execute(
+                "SELECT task_id, channel, value_type, value FROM writes "
+                "WHERE thread_id = ? AND checkpoint_ns = ? AND checkpoint_id = ? ORDER BY task_id, idx",
+                (thread_id, checkpoint_ns, row[0])
+            ).fetchall()
+        return self._to_tuple(thread_id, checkpoint_ns, row, writes)
+
+    def list(self, config, *, filter=None, before=None, limit=None):
+        """
+        チェックポイントを返します（会話スレッドごとに最新の1件のみ保存しています）。
+
+        パラメータ:
+        config (dict): thread_id を含むグラフの設定。None の場合はすべての会話スレッド。
+        filter (dict): メタデータの条件。
+        before (dict): この設定のチェックポイントより前のものだけを返します。
+        limit (int): 返す件数の上限。
+        """
+        query = ("SELECT thread_id, checkpoint_ns, checkpoint_id, parent_checkpoint_id, checkpoint_type, checkpoint, "
+                 "metadata_type, metadata FROM checkpoints")
+        params = []
+        if config is not None:
+            query += " WHERE thread_id = ?"
+            params.append(config["configurable"]["thread_id"])
+            if "checkpoint_ns" in config["configurable"]:
+                query += " AND checkpoint_ns = ?"
+                params.append(config["configurable"]["checkpoint_ns"])
+        query += " ORDER BY updated_at DESC"
+        with self._lock:
+            rows = self._connect().execute(query, params).fetchall()
+
+        count = 0
+        for thread_id, checkpoint_ns, *row in rows:
+            if before is not None and row[0] >= before["configurable"]["checkpoint_id"]:
+                continue
+            found = self._to_tuple(thread_id, checkpoint_ns, row, [])
+            if filter and any(found.metadata.get(key) != value for key, value in filter.items()):
+                continue
+            if limit is not None and count >= limit:
+                return
+            count += 1
+            yield found
+
+    def put(self, config, checkpoint, metadata, new_versions):
+        """
+        会話スレッドのチェックポイントを保存します（前のチェックポイントは上書きします）。
+
+        戻り値:
+        dict: 保存したチェックポイントを指すグラフの設定。
+        """
+        configurable = config["configurable"]
+        thread_id = configurable["thread_id"]
+        checkpoint_ns = configurable.get("checkpoint_ns", "")
+        checkpoint_type, checkpoint_data = self.serde.dumps_typed(checkpoint)
+        metadata_type, metadata_data = self.serde.dumps_typed(metadata)
+        with self._lock:
+            conn = self._connect()
+            with conn:
+                conn.execute(
+                    "INSERT OR REPLACE INTO checkpoints (thread_id, checkpoint_ns, checkpoint_id, parent_checkpoint_id, "
+                    "checkpoint_type, checkpoint, metadata_type, metadata, updated_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                    (thread_id, checkpoint_ns, checkpoint["id"], configurable.get("checkpoint_id"),
+                     checkpoint_type, checkpoint_data, metadata_type, metadata_data, time.time())
+                )
+                # 上書きしたチェックポイントの書き込みは不要になる
+                conn.execute(
+                    "DELETE FROM writes WHERE thread_id = ? AND checkpoint_ns = ? AND checkpoint_id != ?",
+                    (thread_id, checkpoint_ns, checkpoint["id"])
+                )
+            self._puts_since_evict += 1
+            if self._puts_since_evict >= EVICT_EVERY_PUTS:
+                self._evict_idle(conn)
+        return {"configurable": {
+            "thread_id": thread_id,
+            "checkpoint_ns": checkpoint_ns,
+            "checkpoint_id": checkpoint["id"],
+        }}
+
+    def put_writes(self, config, writes, task_id, task_path=""):
+        """チェックポイントに対するタスクの書き込み（途中まで実行したステップの結果）を保存します。"""
+        configurable = config["configurable"]
+        rows = []
+        replace = all(channel in WRITES_IDX_MAP for channel, _ in writes)
+        for idx, (channel, value) in enumerate(writes):
+            value_type, value_data = self.serde.dumps_typed(value)
+            rows.append((configurable["thread_id"], configurable.get("checkpoint_ns", ""), configurable["checkpoint_id"],
+                         task_id, WRITES_IDX_MAP.get(channel, idx), channel, value_type, value_data))
+        with self._lock:
+            conn = self._connect()
+            with conn:
+                conn.executemany(
+                    f"INSERT OR {'REPLACE' if replace else 'IGNORE'} INTO writes (thread_id, checkpoint_ns, "
+                    "checkpoint_id, task_id, idx, channel, value_type, value) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                    rows
+                )
+
+    def delete_thread(self, thread_id):
+        """会話スレッドを削除します。"""
+        with self._lock:
+            conn = self._connect()
+            with conn:
+                conn.execute("DELETE FROM checkpoints WHERE thread_id = ?", (thread_id,))
+                conn.execute("DELETE FROM writes WHERE thread_id = ?", (thread_id,))
+
+    def evict_idle(self):
+        """
+        ttl より長く更新のない会話スレッドを削除します。
+
+        戻り値:
+        int: 削除した会話スレッド数。
+        """
+        with self._lock:
+            return self._evict_idle(self._connect())
+
+    def stats(self):
+        """
+        保存している会話の統計情報を返します。
+
+        戻り値:
+        dict: 会話スレッド数、データベースのサイズ（バイト）。
+        """
+        with self._lock:
+            conn = self._connect()
+            threads = conn.execute("SELECT COUNT(DISTINCT thread_id) FROM checkpoints").fetchone()[0]
+            page_count = conn.execute("PRAGMA page_count").fetchone()[0]
+            page_size = conn.execute("PRAGMA page_size").fetchone()[0]
+        return {'threads': threads, 'db_bytes': page_count * page_size}
+
+    def _evict_idle(self, conn):
+        self._puts_since_evict = 0
+        expired = [thread_id for (thread_id,) in conn.execute(
+            "SELECT thread_id FROM checkpoints GROUP BY thread_id HAVING MAX(updated_at) < ?",
+            (time.time() - self.ttl,)
+        )]
+        with conn:
+            conn.executemany("DELETE FROM checkpoints WHERE thread_id = ?", [(t,) for t in expired])
+            conn.executemany("DELETE FROM writes WHERE thread_id = ?", [(t,) for t in expired])
+        return len(expired)
+
+    def _to_tuple(self, thread_id, checkpoint_ns, row, writes):
+        checkpoint_id, parent_checkpoint_id, checkpoint_type, checkpoint, metadata_type, metadata = row
+        parent_config = None
+        if parent_checkpoint_id:
+            parent_config = {"configurable": {
+                "thread_id": thread_id,
+                "checkpoint_ns": checkpoint_ns,
+                "checkpoint_id": parent_checkpoint_id,
+            }}
+        return CheckpointTuple(
+            config={"configurable": {
+                "thread_id": thread_id,
+                "checkpoint_ns": checkpoint_ns,
+                "checkpoint_id": checkpoint_id,
+            }},
+            checkpoint=self.serde.loads_typed((checkpoint_type, checkpoint)),
+            metadata=self.serde.loads_typed((metadata_type, metadata)),
+            parent_config=parent_config,
+            pending_writes=[
+                (task_id, channel, self.serde.loads_typed((value_type, value)))
+                for task_id, channel, value_type, value in writes
+            ],
+        )
+
+
+conversation_store = ConversationStore(
+    db_path=os.getenv("CONVERSATION_DB_PATH", DEFAULT_DB_PATH),
+    ttl=float(os.getenv("CONVERSATION_TTL", 7 * 24 * 3600))
+)
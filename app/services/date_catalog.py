@@ -0,0 +1,207 @@
+"""
+衛星画像の撮影日カタログモジュール
+
+Sentinel Hub Catalog APIで範囲ごとの実際の撮影日と雲量を調べ、ローカルのSQLiteとメモリに保持します。
+有効期間（TTL）を過ぎた範囲は古いデータを返しつつバックグラウンドで差分だけを更新するため、
+日付の問い合わせで毎回計算やSentinel Hubへの問い合わせが発生することはありません。
+"""
+import os
+import json
+import time
+import sqlite3
+import threading
+from datetime import datetime, timedelta
+
+from sentinelhub import SentinelHubCatalog, BBox, CRS, DataCollection
+
+DEFAULT_DB_PATH = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.dirname(__file__))), 'instance', 'catalog.db'
+)
+CATALOG_TTL = int(os.getenv("DATE_CATALOG_TTL", "21600"))  # 6時間
+# 初回に調べる期間と、差分更新時に遡って再確認する日数
+INITIAL_LOOKBACK_DAYS = 90
+REFRESH_OVERLAP_DAYS = 3
+
+
+def _area_key(bbox):
+    return ",".join(f"{float(v):.4f}" for v in bbox)
+
+
+class DateCatalog:
+    """範囲（バウンディングボックス）ごとの撮影日インデックス"""
+
+    def __init__(self, config, db_path=DEFAULT_DB_PATH, ttl=CATALOG_TTL):
+        self.config = config
+        self.db_path = db_path
+        self.ttl = ttl
+        self._memory = {}  # area_key -> (acquisitions, refreshed_at)
+        self._refreshing = set()
+        self._lock = threading.Lock()
+        self._schema_ready = False
+
+    def get_acquisitions(self, bbox, max_cloud_cover=None, block=True):
+        """
+        範囲の撮影日と雲量を新しい順に返します。
+
+        パラメータ:
+        bbox (tuple): WGS84形式の座標 (min_lon, min_lat, max_lon, max_lat)
+        max_cloud_cover (float): 雲量（%）の上限。指定した場合はそれ以下の日付のみ。
+        block (bool): 一度も調べていない範囲の場合に、取得を待つかどうか。
+                      Falseの場合はバックグラウンドで取得を始めて空のリストを返します。
+
+        戻り値:
+        list: [{'date': 'YYYY-MM-DD', 'cloud_cover': float}, ...]
+        """
+        key = _area_key(bbox)
+        with self._lock:
+            cached = self._memory.get(key)
+
+        if cached is None:
+            acquisitions, refreshed_at = self._load(key)
+            if refreshed_at is not None:
+                cached = (acquisitions, refreshed_at)
+                with self._lock:
+                    self._memory[key] = cached
+            elif not block:
+                self._refresh_in_background(bbox)
+                return []
+            else:
+                # 一度も調べていない範囲は同期的に取得する
+                try:
+                    self.refresh(bbox)
+                except Exception as e:
+                    print(f"撮影日カタログの取得に失敗しました: {str(e)}")
+                    # 失敗した場合も次のTTLまでは再試行しない
+                    with self._lock:
+                        self._memory[key] = ([], time.time())
+                with self._lock:
+                    cached = self._memory[key]
+
+        acquisitions, refreshed_at = cached
+        if time.time() - refreshed_at > self.ttl:
+            self._refresh_in_background(bbox)
+
+        if max_cloud_cover is None:
+            return list(acquisitions)
+        return [item for item in acquisitions
+                if item['cloud_cover'] is None or item['cloud_cover'] <= max_cloud_cover]
+
+    def get_dates(self, bbox, max_cloud_cover=None, block=True):
+        """
+        範囲の撮影日（YYYYMMDD）を新しい順に返します。
+        """
+        acquisitions = self.get_acquisitions(bbox, max_cloud_cover, block)
+        return [item['date'].replace('-', '') for item in acquisitions]
+
+    def refresh(self, bbox):
+        """
+        Catalog APIで前回の更新以降の撮影日を取得してインデックスを更新します。
+
+        パラメータ:
+        bbox (tuple): WGS84形式の座標 (min_lon, min_lat, max_lon, max_lat)
+        """
+        key = _area_key(bbox)
+        conn = self._connect()
+        try:
+            row = conn.execute("SELECT covered_until FROM catalog_areas WHERE area_key = ?", (key,)).fetchone()
+            today = datetime.now()
+            if row and row[0]:
+                start = datetime.strptime(row[0], '%Y-%m-%d') - timedelta(days=REFRESH_OVERLAP_DAYS)
+            else:
+                start = today - timedelta(days=INITIAL_LOOKBACK_DAYS)
+
+            # 同じ日に複数のタイルがある場合は雲量の最小値を採用する
+            by_date = {}
+            for item in self._search(bbox, start, today):
+                date = item['properties']['datetime'][:10]
+                cloud_cover = item['properties'].get('eo:cloud_cover')
+                previous = by_date.get(date)
+                if previous is None or (cloud_cover is not None and cloud_cover < previous):
+                    by_date[date] = cloud_cover
+
+            conn.executemany(
+                "INSERT INTO catalog_acquisitions (area_key, date, cloud_cover) VALUES (?, ?, ?) "
+                "ON CONFLICT(area_key, date) DO UPDATE SET cloud_cover = excluded.cloud_cover",
+                [(key, date, cloud_cover) for date, cloud_cover in by_date.items()]
+            )
+            conn.execute(
+                "INSERT INTO catalog_areas (area_key, bbox, covered_until, refreshed_at) VALUES (?, ?, ?, ?) "
+                "ON CONFLICT(area_key) DO UPDATE SET covered_until = excluded.covered_until, refreshed_at = excluded.refreshed_at",
+                (key, json.dumps(list(bbox)), today.strftime('%Y-%m-%d'), time.time())
+            )
+            conn.commit()
+        finally:
+            conn.close()
+
+        acquisitions, refreshed_at = self._load(key)
+        with self._lock:
+            self._memory[key] = (acquisitions, refreshed_at or time.time())
+
+    def _refresh_in_background(self, bbox):
+        key = _area_key(bbox)
+        with self._lock:
+            if key in self._refreshing:
+                return
+            self._refreshing.add(key)
+
+        def run():
+            try:
+                self.refresh(bbox)
+            except Exception as e:
+                print(f"撮影日カタログの更新に失敗しました: {str(e)}")
+                # 失敗した場合も次のTTLまでは再試行しない
+                with self._lock:
+                    acquisitions = self._memory.get(key, ([], 0))[0]
+                    self._memory[key] = (acquisitions, time.time())
+            finally:
+                with self._lock:
+                    self._refreshing.discard(key)
+
+        threading.Thread(target=run, name=f"catalog-refresh-{key}", daemon=True).start()
+
+    def _search(self, bbox, start, end):
+        catalog = SentinelHubCatalog(config=self.config)
+        collection = DataCollection.SENTINEL2_L2A.define_from(
+            name="s2",
+            service_url="https://sh.dataspace.copernicus.eu"
+        )
+        return catalog.search(
+            collection,
+            bbox=BBox(bbox=bbox, crs=CRS.WGS84),
+            time=(start.strftime('%Y-%m-%d'), end.strftime('%Y-%m-%d')),
+            fields={"include": ["id", "properties.datetime", "properties.eo:cloud_cover"], "exclude": []}
+        )
+
+    def _load(self, key):
+        conn = self._connect()
+        try:
+            area = conn.execute("SELECT refreshed_at FROM catalog_areas WHERE area_key = ?", (key,)).fetchone()
+            rows = conn.execute(
+                "SELECT date, cloud_cover FROM catalog_acquisitions WHERE area_key = ? ORDER BY date DESC",
+                (key,)
+            ).fetchall()
+        finally:
+            conn.close()
+        acquisitions = [{'date': date, 'cloud_cover': cloud_cover} for date, cloud_cover in rows]
+        return acquisitions, (area[0] if area else None)
+
+    def _connect(self):
+        os.makedirs(os.path.dirname(self.db_path), exist_ok=True)
+        conn = sqlite3.connect(self.db_path, timeout=10)
+        if not self._schema_ready:
+            conn.executescript('''
+            CREATE TABLE IF NOT EXISTS catalog_areas (
+                area_key TEXT PRIMARY KEY,
+                bbox TEXT NOT NULL,
+                covered_until TEXT,
+                refreshed_at REAL
+            );
+            CREATE TABLE IF NOT EXISTS catalog_acquisitions (
+                area_key TEXT NOT NULL,
+                date TEXT NOT NULL,
+                cloud_cover REAL,
+                PRIMARY KEY (area_key, date)
+            );
+            ''')
+            self._schema_ready = True
+        return conn
@@ -0,0 +1,229 @@
+"""
+埋め込みベクトルの2層キャッシュモジュール
+
+キーは (埋め込みモデル, 正規化したテキスト) のハッシュです。1層目はメモリ上のLRUキャッシュ、
+2層目はSQLiteのディスクストアで、どちらも件数の上限を超えると古いものから削除されます。
+CachedEmbeddings で埋め込みモデルを包むと、検索クエリとナレッジベース登録時のチャンクの両方で
+キャッシュにあるテキストは埋め込みAPIを呼び出さずに済みます。
+"""
+import os
+import re
+import time
+import json
+import hashlib
+import sqlite3
+import threading
+import unicodedata
+from collections import OrderedDict
+
+import numpy as np
+from langchain_core.embeddings import Embeddings
+
+DEFAULT_CACHE_PATH = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.dirname(__file__))), 'instance', 'embedding_cache.db'
+)
+
+_WHITESPACE = re.compile(r'\s+')
+
+
+def normalize_text(text):
+    """全角・半角を揃え（NFKC）、連続する空白を1つにまとめて前後の空白を除きます。"""
+    return _WHITESPACE.sub(' ', unicodedata.normalize('NFKC', text)).strip()
+
+
+class EmbeddingCache:
+    """(model, 正規化したテキスト) をキーとする埋め込みベクトルのキャッシュ"""
+
+    def __init__(self, db_path=DEFAULT_CACHE_PATH, memory_max_entries=4096, disk_max_entries=200000):
+        self.db_path = db_path
+        self.memory_max_entries = memory_max_entries
+        self.disk_max_entries = disk_max_entries
+        self._memory = OrderedDict()  # key -> np.ndarray
+        self._lock = threading.Lock()
+        self._conn = None
+        self._puts_since_evict = 0
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def make_key(model, text):
+        """
+        キャッシュキーを作成します。
+
+        パラメータ:
+        model (str): 埋め込みモデル名（クエリ用・文書用で結果が異なる場合はそれも含める）。
+        text (str): 埋め込むテキスト。
+
+        戻り値:
+        str: キャッシュキー（SHA-1の16進文字列）。
+        """
+        payload = json.dumps([model, normalize_text(text)], ensure_ascii=False)
+        return hashlib.sha1(payload.encode('utf-8')).hexdigest()
+
+    def _connect(self):
+        if self._conn is None:
+            os.makedirs(os.path.dirname(self.db_path), exist_ok=True)
+            conn = sqlite3.connect(self.db_path, timeout=10, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.executescript('''
+            CREATE TABLE IF NOT EXISTS embeddings (
+                key TEXT PRIMARY KEY,
+                vector BLOB NOT NULL,
+                accessed_at REAL NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS idx_embeddings_accessed ON embeddings (accessed_at);
+            ''')
+            self._conn = conn
+        return self._conn
+
+    def get_many(self, keys):
+        """
+        キャッシュから埋め込みベクトルを取得します。メモリ、ディスクの順に探します。
+
+        パラメータ:
+        keys (list): make_keyで作成したキーのリスト。
+
+        戻り値:
+        dict: {キー: np.ndarray}（キャッシュにあったものだけ）
+        """
+        found = {}
+        with self._lock:
+            for key in keys:
+                vector = self._memory.get(key)
+                if vector is not None:
+                    self._memory.move_to_end(key)
+                    found[key] = vector
+            self.memory_hits += len(found)
+
+            missing = list(dict.fromkeys(key for key in keys if key not in found))
+            if missing:
+                conn = self._connect()
+                rows = []
+                for start in range(0, len(missing), 500):
+                    batch = missing[start:start + 500]
+                    rows += conn.execute(
+                        f"SELECT key, vector FROM embeddings WHERE key IN ({','.join('?' * len(batch))})", batch
+                    ).fetchall()
+                if rows:
+                    # LRU判定用に最終アクセス時刻を更新
+                    with conn:
+                        conn.executemany("UPDATE embeddings SET accessed_at = ? WHERE key = ?",
+                                         [(time.time(), key) for key, _ in rows])
+                for key, blob in rows:
+                    vector = np.frombuffer(blob, dtype=np.float32)
+                    found[key] = vector
+                    self._store_memory(key, vector)
+                self.disk_hits += len(rows)
+                self.misses += len(missing) - len(rows)
+        return found
+
+    def put_many(self, vectors):
+        """
+        埋め込みベクトルをキャッシュに保存します。
+
+        パラメータ:
+        vectors (dict): {キー: 埋め込みベクトル}
+        """
+        if not vectors:
+            return
+        now = time.time()
+        items = {key: np.asarray(vector, dtype=np.float32) for key, vector in vectors.items()}
+        with self._lock:
+            conn = self._connect()
+            with conn:
+                conn.executemany(
+                    "INSERT OR REPLACE INTO embeddings (key, vector, accessed_at) VALUES (?, ?, ?)",
+                    [(key, vector.tobytes(), now) for key, vector in items.items()]
+                )
+            for key, vector in items.items():
+                self._store_memory(key, vector)
+            self._puts_since_evict += len(items)
+            if self._puts_since_evict >= 1000:
+                self._evict_disk(conn)
+
+    def stats(self):
+        """
+        キャッシュの統計情報を返します。
+
+        戻り値:
+        dict: ヒット数、ミス数、ヒット率、メモリ上の件数。
+        """
+        with self._lock:
+            lookups = self.memory_hits + self.disk_hits + self.misses
+            return {
+                'memory_hits': self.memory_hits,
+                'disk_hits': self.disk_hits,
+                'misses': self.misses,
+                'hit_rate': (self.memory_hits + self.disk_hits) / lookups if lookups else 0.0,
+                'memory_entries': len(self._memory),
+            }
+
+    def clear(self):
+        """メモリとディスクのキャッシュをすべて削除します。"""
+        with self._lock:
+            self._memory.clear()
+            conn = self._connect()
+            with conn:
+                conn.execute("DELETE FROM embeddings")
+
+    def _store_memory(self, key, vector):
+        self._memory[key] = vector
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.memory_max_entries:
+            self._memory.popitem(last=False)
+
+    def _evict_disk(self, conn):
+        self._puts_since_evict = 0
+        with conn:
+            conn.execute(
+                "DELETE FROM embeddings WHERE key IN ("
+                "SELECT key FROM embeddings ORDER BY accessed_at DESC LIMIT -1 OFFSET ?)",
+                (self.disk_max_entries,)
+            )
+
+
+embedding_cache = EmbeddingCache(
+    db_path=os.getenv("EMBEDDING_CACHE_PATH", DEFAULT_CACHE_PATH),
+    memory_max_entries=int(os.getenv("EMBEDDING_CACHE_SIZE", 4096))
+)
+
+
+class CachedEmbeddings(Embeddings):
+    """埋め込みモデルを包み、EmbeddingCache にある結果は埋め込みAPIを呼び出さずに返す"""
+
+    def __init__(self, embedding, model, cache=embedding_cache):
+        """
+        パラメータ:
+        embedding (Embeddings): 包む埋め込みモデル。
+        model (str): 埋め込みモデル名（キャッシュキーに含める）。
+        cache (EmbeddingCache): 使用するキャッシュ。
+        """
+        self.embedding = embedding
+        self.model = model
+        self.cache = cache
+
+    def embed_documents(self, texts):
+        # 文書用とクエリ用で埋め込みが異なるモデルがあるため、キーを分ける
+        keys = [self.cache.make_key(f"{self.model}:document", text) for text in texts]
+        found = self.cache.get_many(keys)
+
+        missing = {}
+        for key, text in zip(keys, texts):
+            if key not in found and key not in missing:
+                missing[key] = text
+        if missing:
+            vectors = self.embedding.embed_documents(list(missing.values()))
+            computed = dict(zip(missing, vectors))
+            self.cache.put_many(computed)
+            found.update((key, np.asarray(vector, dtype=np.float32)) for key, vector in computed.items())
+        return [found[key].tolist() for key in keys]
+
+    def embed_query(self, text):
+        key = self.cache.make_key(f"{self.model}:query", text)
+        vector = self.cache.get_many([key]).get(key)
+        if vector is None:
+            vector = np.asarray(self.embedding.embed_query(text), dtype=np.float32)
+            self.cache.put_many({key: vector})
+        return vector.tolist()
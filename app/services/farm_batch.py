@@ -0,0 +1,184 @@
+"""
+複数農場のNDVIをまとめて取得するモジュール
+
+近接する農場を1つのリクエスト範囲（エンベロープ）にまとめて1回だけ取得し、
+共有した配列から各農場の範囲をコピーせずに切り出します。
+"""
+import math
+
+from sentinelhub import BBox, CRS, bbox_to_dimensions
+
+from app.services.farm_mask import get_farm_mask
+from app.services.satellite_service import (
+    get_farm_bbox, latest_acquisition_date_range, calculate_ndvi_stats, create_index_evalscript,
+    process_index_data, iter_sentinel_images, INDEX_SAMPLE_TYPE, DOWNLOAD_MAX_WORKERS,
+    FARM_RESOLUTION, FARM_MAXCC
+)
+
+# Sentinel Hubの1リクエストあたりの最大ピクセル数
+MAX_PIXELS = 2500
+# エンベロープの面積が農場の面積の合計の何倍までならまとめるか（離れた農場の間の空白を取得しないため）
+MAX_AREA_RATIO = 4
+
+
+def _union_bbox(a, b):
+    return (min(a[0], b[0]), min(a[1], b[1]), max(a[2], b[2]), max(a[3], b[3]))
+
+
+def _bbox_size(bbox, resolution):
+    return bbox_to_dimensions(BBox(bbox=bbox, crs=CRS.WGS84), resolution=resolution)
+
+
+def _bbox_pixels(bbox, resolution):
+    width, height = _bbox_size(bbox, resolution)
+    return max(width, 1) * max(height, 1)
+
+
+def group_farms_into_envelopes(farms, resolution=FARM_RESOLUTION, max_pixels=MAX_PIXELS, max_area_ratio=MAX_AREA_RATIO):
+    """
+    近接する農場をまとめてリクエスト範囲（エンベロープ）を作成します。
+
+    農場を経度順に並べ、既存のエンベロープに加えても最大ピクセル数を超えず、
+    かつエンベロープの面積が含まれる農場（のバウンディングボックス）の面積の合計の
+    max_area_ratio 倍以下の場合はそこに追加します。離れた農場は別のエンベロープになります。
+
+    パラメータ:
+    farms (list): 農場データのリスト [{id, coordinates, ...}, ...]
+    resolution (int): メートル単位の解像度。
+    max_pixels (int): エンベロープの幅・高さの最大ピクセル数。
+    max_area_ratio (float): エンベロープの面積と農場の面積の合計の比の上限。
+
+    戻り値:
+    list: エンベロープのリスト [{'bbox': tuple, 'farms': [(farm, farm_bbox), ...]}, ...]
+    """
+    items = sorted(
+        ((farm, get_farm_bbox(farm['coordinates'])) for farm in farms),
+        key=lambda item: (item[1][0], item[1][1])
+    )
+
+    envelopes = []
+    for farm, farm_bbox in items:
+        farm_pixels = _bbox_pixels(farm_bbox, resolution)
+        for envelope in envelopes:
+            union = _union_bbox(envelope['bbox'], farm_bbox)
+            width, height = _bbox_size(union, resolution)
+            if width > max_pixels or height > max_pixels:
+                continue
+            if max(width, 1) * max(height, 1) > max_area_ratio * (envelope['farm_pixels'] + farm_pixels):
+                continue
+            envelope['bbox'] = union
+            envelope['farms'].append((farm, farm_bbox))
+            envelope['farm_pixels'] += farm_pixels
+            break
+        else:
+            envelopes.append({'bbox': farm_bbox, 'farms': [(farm, farm_bbox)], 'farm_pixels': farm_pixels})
+
+    for envelope in envelopes:
+        del envelope['farm_pixels']
+        envelope['size'] = _bbox_size(envelope['bbox'], resolution)
+    return envelopes
+
+
+def crop_farm_window(image, envelope_bbox, farm_bbox):
+    """
+    エンベロープの画像から農場の範囲を切り出します（コピーせずビューを返します）。
+
+    パラメータ:
+    image (ndarray): エンベロープ全体の画像 (高さ, 幅, バンド)。
+    envelope_bbox (tuple): エンベロープの座標 (min_lon, min_lat, max_lon, max_lat)。
+    farm_bbox (tuple): 農場の座標 (min_lon, min_lat, max_lon, max_lat)。
+
+    戻り値:
+    ndarray: 農場の範囲の画像（imageのビュー）。
+    """
+    height, width = image.shape[:2]
+    lon_span = envelope_bbox[2] - envelope_bbox[0]
+    lat_span = envelope_bbox[3] - envelope_bbox[1]
+
+    # 画像の1行目が北端なので、行は最大緯度から数える
+    col0 = int(math.floor((farm_bbox[0] - envelope_bbox[0]) / lon_span * width))
+    col1 = int(math.ceil((farm_bbox[2] - envelope_bbox[0]) / lon_span * width))
+    row0 = int(math.floor((envelope_bbox[3] - farm_bbox[3]) / lat_span * height))
+    row1 = int(math.ceil((envelope_bbox[3] - farm_bbox[1]) / lat_span * height))
+
+    col0, row0 = max(col0, 0), max(row0, 0)
+    col1, row1 = min(max(col1, col0 + 1), width), min(max(row1, row0 + 1), height)
+    return image[row0:row1, col0:col1]
+
+
+def get_farms_ndvi_batch(farms, date_range=None, resolution=FARM_RESOLUTION, max_workers=DOWNLOAD_MAX_WORKERS):
+    """
+    複数農場のNDVI統計をまとめて取得します。
+
+    期間を省略した場合は農場ごとに get_farm_ndvi_image と同じく最新の撮影日までの期間を使い、
+    同じ期間の農場どうしをエンベロープにまとめます。
+
+    パラメータ:
+    farms (list): 農場データのリスト [{id, coordinates, ...}, ...]
+    date_range (tuple): 日付範囲 (start_date, end_date)。省略時は農場ごとの最新の撮影日までの5日間。
+    resolution (int): メートル単位の解像度。
+    max_workers (int): 同時に実行するダウンロード数の上限。
+
+    戻り値:
+    dict: 農場IDをキーとする処理結果 {'success': bool, 'message': str, 'data': dict or None}
+    """
+    # エンベロープは1つの期間で取得するため、期間ごとに農場を分ける
+    farms_by_range = {}
+    for farm in farms:
+        farm_range = date_range or latest_acquisition_date_range(get_farm_bbox(farm['coordinates']))
+        farms_by_range.setdefault(tuple(farm_range), []).append(farm)
+
+    evalscript = create_index_evalscript(("ndvi",), INDEX_SAMPLE_TYPE)
+    envelopes = []
+    for farm_range, range_farms in farms_by_range.items():
+        for envelope in group_farms_into_envelopes(range_farms, resolution):
+            envelope['date_range'] = farm_range
+            envelopes.append(envelope)
+    jobs = [
+        {
+            'bbox': envelope['bbox'],
+            'aoi_bbox': BBox(bbox=envelope['bbox'], crs=CRS.WGS84),
+            'aoi_size': envelope['size'],
+            'date_range': envelope['date_range'],
+            'evalscript': evalscript,
+            'resolution': resolution,
+            'maxcc': FARM_MAXCC
+        }
+        for envelope in envelopes
+    ]
+
+    results = {}
+    for index, images in iter_sentinel_images(jobs, max_workers):
+        envelope = envelopes[index]
+        for farm, farm_bbox in envelope['farms']:
+            if isinstance(images, Exception):
+                results[farm['id']] = {
+                    'success': False,
+                    'message': f"エラーが発生しました: {str(images)}",
+                    'data': None
+                }
+                continue
+            if not images:
+                results[farm['id']] = {
+                    'success': False,
+                    'message': "指定された日付範囲で利用可能な画像がありません。",
+                    'data': None
+                }
+                continue
+            try:
+                window = crop_farm_window(images[0], envelope['bbox'], farm_bbox)
+                ndvi = process_index_data([window], ("ndvi",), INDEX_SAMPLE_TYPE)['ndvi']
+                mask = get_farm_mask(farm['coordinates'], farm_bbox, ndvi.shape, farm.get('mask'))
+            except ValueError as e:
+                results[farm['id']] = {'success': False, 'message': str(e), 'data': None}
+                continue
+            results[farm['id']] = {
+                'success': True,
+                'message': "NDVIデータを取得しました。",
+                'data': {
+                    'ndvi_stats': calculate_ndvi_stats(ndvi, mask),
+                    'bbox': farm_bbox,
+                    'date_range': envelope['date_range']
+                }
+            }
+    return results
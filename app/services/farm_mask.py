@@ -0,0 +1,91 @@
+"""
+農場ポリゴンのラスタマスクを作成・保存するモジュール
+
+バウンディングボックスは10%広げてあるため、統計は農場ポリゴン内の画素だけで計算します。
+マスクはビット列に詰めて圧縮し、農場データと一緒に保存できる大きさにします。
+"""
+import zlib
+import base64
+
+import cv2
+import numpy as np
+
+# cv2.fillPolyのサブピクセル精度（2^SHIFT 分の1ピクセル）
+_SHIFT = 4
+
+
+def rasterize_polygon(coordinates, bbox, shape):
+    """
+    農場ポリゴンをリクエストの画素グリッド上にラスタライズします。
+
+    パラメータ:
+    coordinates (list): 農場の座標リスト [{lat, lng}, ...]
+    bbox (tuple): グリッドの座標 (min_lon, min_lat, max_lon, max_lat)
+    shape (tuple): グリッドの (高さ, 幅)
+
+    戻り値:
+    ndarray: ポリゴン内の画素がTrueのbool配列。
+    """
+    height, width = shape
+    lngs = np.array([coord['lng'] for coord in coordinates], dtype=np.float64)
+    lats = np.array([coord['lat'] for coord in coordinates], dtype=np.float64)
+
+    # 画像の1行目が北端なので、行は最大緯度から数える
+    cols = (lngs - bbox[0]) / (bbox[2] - bbox[0]) * width
+    rows = (bbox[3] - lats) / (bbox[3] - bbox[1]) * height
+    # 画素中心で判定するため0.5ずらす
+    points = np.round(np.stack([cols - 0.5, rows - 0.5], axis=1) * (1 << _SHIFT)).astype(np.int32)
+
+    mask = np.zeros((height, width), dtype=np.uint8)
+    cv2.fillPoly(mask, [points], 1, lineType=cv2.LINE_8, shift=_SHIFT)
+    return mask.astype(bool)
+
+
+def encode_mask(mask):
+    """
+    マスクをJSONに保存できる形式に変換します。
+
+    パラメータ:
+    mask (ndarray): bool配列。
+
+    戻り値:
+    dict: {'shape': [高さ, 幅], 'data': 圧縮したビット列のBase64文字列}
+    """
+    packed = np.packbits(mask, axis=None)
+    return {
+        'shape': list(mask.shape),
+        'data': base64.b64encode(zlib.compress(packed.tobytes(), 9)).decode('ascii')
+    }
+
+
+def decode_mask(encoded):
+    """
+    encode_maskで変換したマスクを復元します。
+
+    パラメータ:
+    encoded (dict): encode_maskの戻り値。
+
+    戻り値:
+    ndarray: bool配列。
+    """
+    height, width = encoded['shape']
+    packed = np.frombuffer(zlib.decompress(base64.b64decode(encoded['data'])), dtype=np.uint8)
+    return np.unpackbits(packed, count=height * width).reshape(height, width).astype(bool)
+
+
+def get_farm_mask(coordinates, bbox, shape, encoded=None):
+    """
+    農場のマスクを取得します。保存済みのマスクがグリッドと一致すればそれを使い、なければラスタライズします。
+
+    パラメータ:
+    coordinates (list): 農場の座標リスト [{lat, lng}, ...]
+    bbox (tuple): グリッドの座標 (min_lon, min_lat, max_lon, max_lat)
+    shape (tuple): グリッドの (高さ, 幅)
+    encoded (dict): 農場に保存されたマスク（encode_maskの戻り値）。
+
+    戻り値:
+    ndarray: bool配列。
+    """
+    if encoded and tuple(encoded['shape']) == tuple(shape):
+        return decode_mask(encoded)
+    return rasterize_polygon(coordinates, bbox, shape)
@@ -0,0 +1,230 @@
+"""
+農場データ（ポリゴン・バウンディングボックス・マスク・属性）をSQLiteに保存するモジュール
+
+バウンディングボックスはR-treeインデックス（farms_rtree）にも登録し、地図の表示範囲やタイルに
+掛かる農場だけを検索できるようにします。農場は利用者（owner）ごとに管理します。
+"""
+import os
+import json
+import uuid
+import sqlite3
+import threading
+
+from flask import session
+
+from app.services.ndvi_history import DB_PATH
+
+# 表示範囲の検索で返す農場数の上限
+MAX_FARMS_PER_QUERY = 5000
+
+
+def _to_farm(row, detail=True):
+    farm = {
+        'id': row['id'],
+        'name': row['name'],
+        'coordinates': json.loads(row['coordinates']),
+        'bbox': json.loads(row['bbox']),
+        'crop_type': row['crop_type'],
+        'created_at': row['created_at']
+    }
+    if detail:
+        farm['mask'] = json.loads(row['mask']) if row['mask'] else None
+    return farm
+
+
+class FarmRepository:
+    """農場データのSQLiteリポジトリ"""
+
+    def __init__(self, db_path=DB_PATH):
+        self.db_path = db_path
+        self._schema_ready = False
+        self._lock = threading.Lock()
+
+    def _connect(self):
+        os.makedirs(os.path.dirname(self.db_path), exist_ok=True)
+        conn = sqlite3.connect(self.db_path, timeout=10)
+        conn.row_factory = sqlite3.Row
+        if not self._schema_ready:
+            with self._lock:
+                conn.executescript('''
+                CREATE TABLE IF NOT EXISTS farms (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    owner_id TEXT NOT NULL,
+                    name TEXT,
+                    coordinates TEXT NOT NULL,
+                    bbox TEXT NOT NULL,
+                    mask TEXT,
+                    crop_type TEXT,
+                    created_at TEXT
+                );
+                CREATE INDEX IF NOT EXISTS idx_farms_owner ON farms (owner_id);
+                CREATE VIRTUAL TABLE IF NOT EXISTS farms_rtree USING rtree (
+                    id, min_lon, max_lon, min_lat, max_lat
+                );
+                ''')
+                self._schema_ready = True
+        return conn
+
+    def add(self, owner_id, name, coordinates, bbox, mask=None, crop_type=None, created_at=None):
+        """
+        農場を登録します。
+
+        パラメータ:
+        owner_id (str): 利用者ID。
+        name (str): 農場名。
+        coordinates (list): 農場の座標リスト [{lat, lng}, ...]
+        bbox (tuple): WGS84形式の座標 (min_lon, min_lat, max_lon, max_lat)
+        mask (dict): ポリゴンマスク（farm_mask.encode_maskの戻り値）
+        crop_type (str): 作物の種類。
+        created_at (str): 登録日時。
+
+        戻り値:
+        dict: 登録した農場データ
+        """
+        conn = self._connect()
+        try:
+            with conn:
+                cursor = conn.execute(
+                    "INSERT INTO farms (owner_id, name, coordinates, bbox, mask, crop_type, created_at) "
+                    "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                    (owner_id, name, json.dumps(coordinates), json.dumps(list(bbox)),
+                     json.dumps(mask) if mask else None, crop_type, created_at)
+                )
+                farm_id = cursor.lastrowid
+                conn.execute(
+                    "INSERT INTO farms_rtree (id, min_lon, max_lon, min_lat, max_lat) VALUES (?, ?, ?, ?, ?)",
+                    (farm_id, bbox[0], bbox[2], bbox[1], bbox[3])
+                )
+            row = conn.execute("SELECT * FROM farms WHERE id = ?", (farm_id,)).fetchone()
+        finally:
+            conn.close()
+        return _to_farm(row)
+
+    def get(self, farm_id, owner_id=None):
+        """
+        農場を取得します。
+
+        パラメータ:
+        farm_id (int): 農場ID。
+        owner_id (str): 利用者ID。指定した場合はその利用者の農場のみ。
+
+        戻り値:
+        dict or None: 農場データ
+        """
+        query = "SELECT * FROM farms WHERE id = ?"
+        params = [farm_id]
+        if owner_id is not None:
+            query += " AND owner_id = ?"
+            params.append(owner_id)
+        conn = self._connect()
+        try:
+            row = conn.execute(query, params).fetchone()
+        finally:
+            conn.close()
+        return _to_farm(row) if row else None
+
+    def list(self, owner_id=None, detail=True):
+        """
+        農場を登録順に返します。
+
+        パラメータ:
+        owner_id (str): 利用者ID。指定した場合はその利用者の農場のみ。
+        detail (bool): Falseの場合はマスクを含めません。
+
+        戻り値:
+        list: 農場データのリスト
+        """
+        query = "SELECT * FROM farms"
+        params = []
+        if owner_id is not None:
+            query += " WHERE owner_id = ?"
+            params.append(owner_id)
+        conn = self._connect()
+        try:
+            rows = conn.execute(query + " ORDER BY id", params).fetchall()
+        finally:
+            conn.close()
+        return [_to_farm(row, detail) for row in rows]
+
+    def find_in_bbox(self, bbox, owner_id=None, detail=True, limit=MAX_FARMS_PER_QUERY):
+        """
+        バウンディングボックスが指定範囲に掛かる農場をR-treeインデックスで検索します。
+
+        パラメータ:
+        bbox (tuple): WGS84形式の座標 (min_lon, min_lat, max_lon, max_lat)
+        owner_id (str): 利用者ID。指定した場合はその利用者の農場のみ。
+        detail (bool): Falseの場合はマスクを含めません。
+        limit (int): 返す農場数の上限。
+
+        戻り値:
+        list: 農場データのリスト
+        """
+        query = (
+            "SELECT farms.* FROM farms_rtree JOIN farms ON farms.id = farms_rtree.id "
+            "WHERE farms_rtree.max_lon >= ? AND farms_rtree.min_lon <= ? "
+            "AND farms_rtree.max_lat >= ? AND farms_rtree.min_lat <= ?"
+        )
+        params = [bbox[0], bbox[2], bbox[1], bbox[3]]
+        if owner_id is not None:
+            query += " AND farms.owner_id = ?"
+            params.append(owner_id)
+        query += " ORDER BY farms.id LIMIT ?"
+        params.append(limit)
+        conn = self._connect()
+        try:
+            rows = conn.execute(query, params).fetchall()
+        finally:
+            conn.close()
+        return [_to_farm(row, detail) for row in rows]
+
+    def delete(self, farm_id, owner_id=None):
+        """
+        農場を削除します。
+
+        パラメータ:
+        farm_id (int): 農場ID。
+        owner_id (str): 利用者ID。指定した場合はその利用者の農場のみ。
+
+        戻り値:
+        bool: 削除した場合は True。
+        """
+        query = "DELETE FROM farms WHERE id = ?"
+        params = [farm_id]
+        if owner_id is not None:
+            query += " AND owner_id = ?"
+            params.append(owner_id)
+        conn = self._connect()
+        try:
+            with conn:
+                deleted = conn.execute(query, params).rowcount > 0
+                if deleted:
+                    conn.execute("DELETE FROM farms_rtree WHERE id = ?", (farm_id,))
+        finally:
+            conn.close()
+        return deleted
+
+
+farm_repository = FarmRepository(db_path=os.getenv("FARM_DB_PATH", DB_PATH))
+
+
+def current_owner_id():
+    """
+    セッションの利用者IDを返します（なければ作成します）。
+    以前のバージョンでセッションに保存していた農場は、このときリポジトリに移します。
+
+    戻り値:
+    str: 利用者ID
+    """
+    owner_id = session.get('user_id')
+    if not owner_id:
+        owner_id = uuid.uuid4().hex
+        session['user_id'] = owner_id
+
+    legacy_farms = session.pop('farms', None)
+    for farm in legacy_farms or []:
+        if farm.get('coordinates') and farm.get('bbox'):
+            farm_repository.add(
+                owner_id, farm.get('name'), farm['coordinates'], farm['bbox'],
+                farm.get('mask'), farm.get('crop_type'), farm.get('created_at')
+            )
+    return owner_id
@@ -0,0 +1,192 @@
+"""
+作物・地域ごとの農作業カレンダーと季節ごとの栽培のヒントの定義モジュール
+"""
+from datetime import datetime
+
+DEFAULT_CROP_TYPE = "rice"
+DEFAULT_REGION = "関東"
+
+# 作物と季節の表示名
+CROP_LABELS = {"rice": "イネ", "wheat": "コムギ", "soybean": "大豆", "vegetables": "野菜"}
+SEASON_LABELS = {"spring": "春", "summer": "夏", "autumn": "秋", "winter": "冬"}
+
+# 作物・地域ごとの農作業カレンダー（月ごとの作業）
+FARMING_CALENDARS = {
+    "rice": {
+        "北海道": {
+            "1月": ["休耕期", "来年の生産計画を立てる"],
+            "2月": ["休耕期", "種子の準備"],
+            "3月": ["休耕期", "苗床の準備"],
+            "4月": ["苗床準備", "育苗開始"],
+            "5月": ["田植え", "肥料散布"],
+            "6月": ["水管理", "除草"],
+            "7月": ["水管理", "病害虫防除"],
+            "8月": ["水管理", "出穂期の管理"],
+            "9月": ["落水", "刈り取り準備"],
+            "10月": ["収穫", "乾燥・調製"],
+            "11月": ["稲わら処理", "土壌改良"],
+            "12月": ["休耕期", "機械メンテナンス"]
+        },
+        "東北": {
+            "1月": ["休耕期", "生産計画策定"],
+            "2月": ["休耕期", "種子消毒"],
+            "3月": ["育苗準備", "温湯種子消毒"],
+            "4月": ["育苗", "本田準備"],
+            "5月": ["田植え", "初期水管理"],
+            "6月": ["除草", "中干し"],
+            "7月": ["水管理", "病害虫防除"],
+            "8月": ["出穂期管理", "水管理"],
+            "9月": ["落水", "刈り取り準備"],
+            "10月": ["収穫", "乾燥調製"],
+            "11月": ["稲わら処理", "土づくり"],
+            "12月": ["休耕期", "農業機械整備"]
+        },
+        "関東": {
+            "1月": ["休耕期", "計画策定"],
+            "2月": ["休耕期", "種子準備"],
+            "3月": ["育苗準備", "種まき"],
+            "4月": ["育苗管理", "本田準備"],
+            "5月": ["田植え", "水管理"],
+            "6月": ["除草", "中干し"],
+            "7月": ["水管理", "病害虫防除"],
+            "8月": ["出穂・開花", "水管理"],
+            "9月": ["落水", "収穫準備"],
+            "10月": ["収穫", "乾燥調製"],
+            "11月": ["わら処理", "土づくり"],
+            "12月": ["休耕期", "次年度準備"]
+        }
+    },
+    "wheat": {
+        "北海道": {
+            "1月": ["雪害対策", "排水対策"],
+            "2月": ["雪害対策", "排水対策"],
+            "3月": ["融雪対策", "追肥"],
+            "4月": ["追肥", "病害虫防除"],
+            "5月": ["病害虫防除", "生育調査"],
+            "6月": ["穂肥", "赤かび病防除"],
+            "7月": ["収穫準備", "収穫"],
+            "8月": ["収穫", "わら処理"],
+            "9月": ["土づくり", "は種準備"],
+            "10月": ["は種", "基肥"],
+            "11月": ["越冬準備", "排水対策"],
+            "12月": ["越冬管理", "積雪対策"]
+        }
+    },
+    "vegetables": {
+        "関東": {
+            "1月": ["ハウス栽培", "霜対策"],
+            "2月": ["育苗", "土壌準備"],
+            "3月": ["春野菜の植付け", "土壌改良"],
+            "4月": ["春野菜の管理", "追肥"],
+            "5月": ["病害虫防除", "収穫開始"],
+            "6月": ["梅雨対策", "夏野菜の植付け"],
+            "7月": ["夏野菜の管理", "高温対策"],
+            "8月": ["かん水", "秋野菜の準備"],
+            "9月": ["秋野菜の植付け", "台風対策"],
+            "10月": ["秋野菜の管理", "収穫"],
+            "11月": ["晩秋野菜の収穫", "土づくり"],
+            "12月": ["冬野菜の管理", "霜対策"]
+        }
+    },
+    "soybean": {
+        "東北": {
+            "1月": ["休耕期", "計画策定"],
+            "2月": ["休耕期", "種子選別"],
+            "3月": ["休耕期", "土壌診断"],
+            "4月": ["圃場準備", "土壌改良"],
+            "5月": ["圃場準備", "播種準備"],
+            "6月": ["播種", "初期管理"],
+            "7月": ["中耕・培土", "病害虫防除"],
+            "8月": ["開花期管理", "病害虫防除"],
+            "9月": ["莢伸長期管理", "排水対策"],
+            "10月": ["収穫準備", "収穫"],
+            "11月": ["収穫", "乾燥調製"],
+            "12月": ["休耕期", "土づくり"]
+        }
+    }
+}
+
+# 季節ごと・作物ごとの栽培のヒント
+SEASON_TIPS = {
+    "spring": {
+        "rice": "苗の健全な生育を促すため、育苗期の温度管理に注意してください。昼夜の温度差が大きい場合は保温対策を。",
+        "wheat": "春の追肥のタイミングは茎立ち期直前が最適です。窒素過多に注意して施肥量を調整してください。",
+        "vegetables": "春野菜の定植後は急な低温に注意。不織布などで保護する準備をしておきましょう。",
+        "soybean": "播種前の土壌水分と地温の確認が重要です。地温が15℃以上になってから播種すると発芽が良好になります。"
+    },
+    "summer": {
+        "rice": "高温期の水管理が重要です。特に開花期には深水管理を行い、受精障害を防止しましょう。",
+        "wheat": "収穫時期の雨に注意。刈り遅れると品質低下を招きます。天候予報を確認して適期収穫に努めてください。",
+        "vegetables": "夏野菜の収穫適期を逃さないように注意。朝夕の涼しい時間帯に収穫すると鮮度が保たれます。",
+        "soybean": "開花期・莢形成期の水分ストレスは収量に大きく影響します。土壌水分をチェックし、必要に応じて灌水してください。"
+    },
+    "autumn": {
+        "rice": "収穫時期の判断は籾の黄化率で行います。適期収穫で高品質米を目指しましょう。",
+        "wheat": "播種適期は地域によって異なります。適期内播種で越冬前に十分な生育量を確保しましょう。",
+        "vegetables": "秋野菜の定植後は害虫対策が重要です。防虫ネットの活用や早期発見・早期防除を心がけてください。",
+        "soybean": "収穫時の豆の水分含量は適正値（15%程度）を目安にしてください。刈り遅れると品質低下につながります。"
+    },
+    "winter": {
+        "rice": "休閑期の土づくりが翌年の収量・品質に影響します。土壌診断に基づいた土壌改良を計画的に。",
+        "wheat": "積雪地域では雪腐病対策が重要です。根雪前の防除を忘れずに実施してください。",
+        "vegetables": "ハウス栽培では温度管理と換気のバランスに注意。日中の温度上昇と夜間の冷え込みに対応した管理を。",
+        "soybean": "次期作に向けた土壌分析と施肥設計を行う時期です。土壌診断結果に基づいた土づくりを計画しましょう。"
+    }
+}
+
+
+def season_of_month(month):
+    """
+    月から季節を判断する
+
+    Parameters:
+    month (int): 月（1〜12）
+
+    Returns:
+    str: 季節（spring, summer, autumn, winter）
+    """
+    if 3 <= month <= 5:
+        return "spring"
+    elif 6 <= month <= 8:
+        return "summer"
+    elif 9 <= month <= 11:
+        return "autumn"
+    else:
+        return "winter"
+
+def get_calendar(crop_type=None, region=None, month=None):
+    """
+    作物と地域の農作業カレンダーと、指定月・翌月の作業、季節のヒントを返す
+
+    Parameters:
+    crop_type (str): 作物の種類（rice, wheat, soybean, vegetables）。見つからない場合はコメ
+    region (str): 地域。作物に対応する地域が見つからない場合はその作物の最初の地域
+    month (int): 月（1〜12）。省略時は現在の月
+
+    Returns:
+    dict: crop_type, region, calendar, current_tasks, next_month_tasks, season_tips, crop_specific_tip
+    """
+    crop_type = crop_type or DEFAULT_CROP_TYPE
+    region = region or DEFAULT_REGION
+
+    # 指定された作物と地域のカレンダーを取得
+    if crop_type not in FARMING_CALENDARS:
+        crop_type, region = DEFAULT_CROP_TYPE, DEFAULT_REGION
+    elif region not in FARMING_CALENDARS[crop_type]:
+        region = next(iter(FARMING_CALENDARS[crop_type]))
+    calendar_data = FARMING_CALENDARS[crop_type][region]
+
+    # 指定月と翌月の作業を特定
+    month = month or datetime.now().month
+    next_month = month + 1 if month < 12 else 1
+    season_tips = SEASON_TIPS[season_of_month(month)]
+
+    return {
+        "crop_type": crop_type,
+        "region": region,
+        "calendar": calendar_data,
+        "current_tasks": calendar_data.get(f"{month}月", ["データなし"]),
+        "next_month_tasks": calendar_data.get(f"{next_month}月", ["データなし"]),
+        "season_tips": season_tips,
+        "crop_specific_tip": season_tips.get(crop_type, "データなし")
+    }
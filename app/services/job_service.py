@@ -0,0 +1,173 @@
+"""
+時間のかかる処理をバックグラウンドで実行するジョブ管理モジュール
+
+リクエストスレッドはジョブIDをすぐに返し、クライアントはステータスをポーリングして結果を取得します。
+ジョブの状態と結果はSQLiteに保存するため、gunicorn の別のワーカーへのポーリングでも結果を取得できます。
+ジョブを実行しているプロセスは定期的にハートビートを記録し、ハートビートが途絶えたジョブ
+（ワーカーの再起動などで実行中に失われたジョブ）は失敗として扱います。
+"""
+import os
+import json
+import time
+import uuid
+import socket
+import sqlite3
+import threading
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+
+DEFAULT_DB_PATH = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.dirname(__file__))), 'instance', 'jobs.db'
+)
+JOB_MAX_WORKERS = int(os.getenv("JOB_MAX_WORKERS", "4"))
+# 完了したジョブの結果を保持する秒数
+JOB_RESULT_TTL = int(os.getenv("JOB_RESULT_TTL", "3600"))
+# 実行中のジョブのハートビートを記録する間隔（秒）。この3倍の間ハートビートがなければ失敗とみなす
+JOB_HEARTBEAT_INTERVAL = 30
+
+
+class JobManager:
+    """ThreadPoolExecutor上でジョブを実行し、状態と結果をSQLiteに保持します。"""
+
+    def __init__(self, db_path=DEFAULT_DB_PATH, max_workers=JOB_MAX_WORKERS, result_ttl=JOB_RESULT_TTL,
+                 heartbeat_interval=JOB_HEARTBEAT_INTERVAL):
+        self.db_path = db_path
+        self.result_ttl = result_ttl
+        self.heartbeat_interval = heartbeat_interval
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='job')
+        self._lock = threading.Lock()
+        self._conn = None
+        self._heartbeat_pid = None
+
+    def _connect(self):
+        if self._conn is None:
+            os.makedirs(os.path.dirname(self.db_path), exist_ok=True)
+            conn = sqlite3.connect(self.db_path, timeout=10, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.executescript('''
+            CREATE TABLE IF NOT EXISTS jobs (
+                id TEXT PRIMARY KEY,
+                status TEXT NOT NULL,
+                result TEXT,
+                error TEXT,
+                details TEXT,
+                worker TEXT,
+                created_at REAL NOT NULL,
+                heartbeat_at REAL,
+                finished_at REAL
+            );
+            CREATE INDEX IF NOT EXISTS idx_jobs_finished ON jobs (finished_at);
+            ''')
+            self._conn = conn
+        return self._conn
+
+    @staticmethod
+    def _worker_id():
+        # fork後のワーカーごとに異なるIDにするため、呼び出し時のプロセスIDから作る
+        return f"{socket.gethostname()}:{os.getpid()}"
+
+    def submit(self, func, *args, **kwargs):
+        """
+        ジョブを登録してバックグラウンドで実行します。
+
+        パラメータ:
+        func (callable): 実行する関数。戻り値（JSONに変換できる値）がジョブの結果になります。
+
+        戻り値:
+        str: ジョブID。
+        """
+        self._start_heartbeat()
+        job_id = uuid.uuid4().hex
+        now = time.time()
+        with self._lock:
+            conn = self._connect()
+            with conn:
+                conn.execute(
+                    "INSERT INTO jobs (id, status, worker, created_at, heartbeat_at) VALUES (?, 'pending', ?, ?, ?)",
+                    (job_id, self._worker_id(), now, now)
+                )
+        self._executor.submit(self._run, job_id, func, args, kwargs)
+        return job_id
+
+    def get(self, job_id):
+        """
+        ジョブの状態を取得します。
+
+        パラメータ:
+        job_id (str): ジョブID。
+
+        戻り値:
+        dict or None: {id, status(pending/running/done/failed), result, error, ...}
+        """
+        with self._lock:
+            row = self._connect().execute(
+                "SELECT id, status, result, error, details, created_at, heartbeat_at, finished_at FROM jobs WHERE id = ?",
+                (job_id,)
+            ).fetchone()
+        if row is None:
+            return None
+        job = {
+            'id': row[0],
+            'status': row[1],
+            'result': json.loads(row[2]) if row[2] is not None else None,
+            'error': row[3],
+            'details': row[4],
+            'created_at': row[5],
+            'finished_at': row[7]
+        }
+        now = time.time()
+        if job['finished_at'] is not None and job['finished_at'] < now - self.result_ttl:
+            return None
+        if job['status'] in ('pending', 'running') and row[6] < now - 3 * self.heartbeat_interval:
+            # 実行していたプロセスが終了している
+            job.update(status='failed', error="ジョブを実行していたプロセスが終了しました。もう一度実行してください。")
+            self._update(job_id, status='failed', error=job['error'], finished_at=now)
+        return job
+
+    def _run(self, job_id, func, args, kwargs):
+        self._update(job_id, status='running')
+        try:
+            result = json.dumps(func(*args, **kwargs), ensure_ascii=False)
+        except Exception as e:
+            self._update(job_id, status='failed', error=str(e), details=traceback.format_exc(),
+                         finished_at=time.time())
+        else:
+            self._update(job_id, status='done', result=result, finished_at=time.time())
+
+    def _update(self, job_id, **fields):
+        columns = ", ".join(f"{name} = ?" for name in fields)
+        with self._lock:
+            conn = self._connect()
+            with conn:
+                conn.execute(f"UPDATE jobs SET {columns} WHERE id = ?", (*fields.values(), job_id))
+
+    def _start_heartbeat(self):
+        # ワーカープロセスごとに1つだけハートビートのスレッドを起動する
+        with self._lock:
+            if self._heartbeat_pid == os.getpid():
+                return
+            self._heartbeat_pid = os.getpid()
+        threading.Thread(target=self._heartbeat_loop, name='job-heartbeat', daemon=True).start()
+
+    def _heartbeat_loop(self):
+        while True:
+            try:
+                self._heartbeat()
+            except sqlite3.Error as e:
+                print(f"ジョブのハートビートの記録に失敗しました: {str(e)}")
+            time.sleep(self.heartbeat_interval)
+
+    def _heartbeat(self):
+        # このプロセスで実行中のジョブのハートビートを更新し、期限切れの結果を削除する
+        now = time.time()
+        with self._lock:
+            conn = self._connect()
+            with conn:
+                conn.execute(
+                    "UPDATE jobs SET heartbeat_at = ? WHERE worker = ? AND status IN ('pending', 'running')",
+                    (now, self._worker_id())
+                )
+                conn.execute("DELETE FROM jobs WHERE finished_at < ?", (now - self.result_ttl,))
+
+
+job_manager = JobManager(db_path=os.getenv("JOB_DB_PATH", DEFAULT_DB_PATH))
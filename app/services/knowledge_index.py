@@ -0,0 +1,170 @@
+"""
+チャットボットの農業ナレッジベース（埋め込み済みのベクトルインデックス）を作成・読み込むモジュール
+
+インデックスは事前に次のコマンドで作成・更新し、ディレクトリに保存しておきます（埋め込みAPIを使用）。
+
+    python -m app.services.knowledge_index              # Webの文書とローカルの文書
+    python -m app.services.knowledge_index --local-only # ローカルの文書のみ（ネットワーク不要）
+
+ローカルの文書は NDVI_MAPPING の推奨事項・作物別・季節別の説明と、農作業カレンダーです。
+更新時は内容が変わったチャンクだけを埋め込み直します。
+アプリケーションはこのインデックスを読み込むだけなので、起動時にネットワークや埋め込みの呼び出しは発生しません。
+"""
+import os
+
+from langchain_core.documents import Document
+
+from app.services.vector_store import LocalVectorStore
+from app.services.ndvi_mapping import NDVI_MAPPING
+from app.services.farming_calendar import FARMING_CALENDARS, SEASON_TIPS, CROP_LABELS, SEASON_LABELS
+
+DEFAULT_INDEX_DIR = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.dirname(__file__))), 'instance', 'knowledge_index'
+)
+KNOWLEDGE_INDEX_DIR = os.getenv("KNOWLEDGE_INDEX_DIR", DEFAULT_INDEX_DIR)
+
+# ナレッジベースの取得元
+KNOWLEDGE_SOURCES = (
+    "https://www.sciencedirect.com/science/article/abs/pii/S0034425719304717",
+)
+# 埋め込みモデル（検索時のクエリも同じモデルで埋め込む必要がある）
+EMBEDDING_MODEL = "models/text-embedding-004"
+CHUNK_SIZE = 1000
+CHUNK_OVERLAP = 200
+
+
+def _health_label(health):
+    min_val, max_val = NDVI_MAPPING["health"][health]
+    return f"健康状態 {health}（NDVI {min_val}〜{max_val}）"
+
+
+def local_documents():
+    """
+    ローカルの農業知識（NDVI_MAPPING と農作業カレンダー）をチャンクに分けて返します。
+
+    戻り値:
+    dict: {取得元の名前: Documentのリスト}
+    """
+    mapping_docs = []
+    for health, recommendations in NDVI_MAPPING["recommendations"].items():
+        mapping_docs.append(Document(
+            page_content=f"{_health_label(health)}の推奨事項:\n" + "\n".join(recommendations),
+            metadata={'chunk_key': f"recommendations/{health}", 'source': 'ndvi_mapping', 'health': health}
+        ))
+    for crop, texts in NDVI_MAPPING["crops"].items():
+        for health, text in texts.items():
+            mapping_docs.append(Document(
+                page_content=f"{CROP_LABELS.get(crop, crop)}（{crop}）の{_health_label(health)}: {text}",
+                metadata={'chunk_key': f"crops/{crop}/{health}", 'source': 'ndvi_mapping',
+                          'crop_type': crop, 'health': health}
+            ))
+    for season, texts in NDVI_MAPPING["seasonal"].items():
+        for health, text in texts.items():
+            mapping_docs.append(Document(
+                page_content=f"{SEASON_LABELS[season]}（{season}）の{_health_label(health)}: {text}",
+                metadata={'chunk_key': f"seasonal/{season}/{health}", 'source': 'ndvi_mapping',
+                          'season': season, 'health': health}
+            ))
+
+    calendar_docs = []
+    for crop, regions in FARMING_CALENDARS.items():
+        for region, months in regions.items():
+            lines = [f"{month}: {'、'.join(tasks)}" for month, tasks in months.items()]
+            calendar_docs.append(Document(
+                page_content=f"{CROP_LABELS.get(crop, crop)}（{crop}）の{region}の農作業カレンダー:\n" + "\n".join(lines),
+                metadata={'chunk_key': f"calendar/{crop}/{region}", 'source': 'farming_calendar',
+                          'crop_type': crop, 'region': region}
+            ))
+    for season, tips in SEASON_TIPS.items():
+        for crop, tip in tips.items():
+            calendar_docs.append(Document(
+                page_content=f"{SEASON_LABELS[season]}の{CROP_LABELS.get(crop, crop)}（{crop}）栽培のヒント: {tip}",
+                metadata={'chunk_key': f"season_tips/{season}/{crop}", 'source': 'farming_calendar',
+                          'season': season, 'crop_type': crop}
+            ))
+
+    return {'ndvi_mapping': mapping_docs, 'farming_calendar': calendar_docs}
+
+
+def web_documents():
+    """
+    取得元のWeb文書を読み込んでチャンクに分けて返します（ネットワークを使用）。
+
+    戻り値:
+    dict: {取得元のURL: Documentのリスト}
+    """
+    import bs4
+    from langchain_community.document_loaders import WebBaseLoader
+    from langchain_text_splitters import RecursiveCharacterTextSplitter
+
+    text_splitter = RecursiveCharacterTextSplitter(chunk_size=CHUNK_SIZE, chunk_overlap=CHUNK_OVERLAP)
+    documents = {}
+    for url in KNOWLEDGE_SOURCES:
+        loader = WebBaseLoader(
+            web_paths=(url,),
+            bs_kwargs=dict(
+                parse_only=bs4.SoupStrainer(
+                    class_=("post-content", "post-title", "post-header")
+                )
+            ),
+        )
+        documents[url] = text_splitter.split_documents(loader.load())
+    return documents
+
+
+def build_knowledge_index(embedding, index_dir=KNOWLEDGE_INDEX_DIR, include_web=True):
+    """
+    ローカルの文書（と取得元のWeb文書）をインデックスに登録します。
+    内容が変わっていないチャンクは埋め込み直しません。
+
+    パラメータ:
+    embedding (Embeddings): 埋め込みモデル。
+    index_dir (str): インデックスの保存先ディレクトリ。
+    include_web (bool): Falseの場合はローカルの文書のみ登録します。
+
+    戻り値:
+    dict: {取得元: {'embedded', 'unchanged', 'removed'}}
+    """
+    store = LocalVectorStore(index_dir, embedding, EMBEDDING_MODEL)
+    sources = local_documents()
+    if include_web:
+        sources.update(web_documents())
+    return {source: store.upsert_documents(source, docs) for source, docs in sources.items()}
+
+
+def load_knowledge_index(embedding, index_dir=KNOWLEDGE_INDEX_DIR):
+    """
+    保存済みのインデックスを読み込みます（埋め込みの呼び出しは行いません）。
+    インデックスがない場合は空のインデックスを返します。
+
+    パラメータ:
+    embedding (Embeddings): 検索時にクエリを埋め込むモデル。
+    index_dir (str): インデックスのディレクトリ。
+
+    戻り値:
+    LocalVectorStore: ベクトルインデックス
+    """
+    store = LocalVectorStore(index_dir, embedding, EMBEDDING_MODEL)
+    if not len(store):
+        print(f"ナレッジインデックスが見つかりません（{index_dir}）。"
+              "python -m app.services.knowledge_index で作成してください。")
+    return store
+
+
+if __name__ == "__main__":
+    import argparse
+    from dotenv import load_dotenv
+    from langchain_google_genai import GoogleGenerativeAIEmbeddings
+    from app.services.embedding_cache import CachedEmbeddings, embedding_cache
+
+    parser = argparse.ArgumentParser(description="農業ナレッジベースのインデックスを作成・更新します")
+    parser.add_argument("--local-only", action="store_true", help="ローカルの文書のみ登録する（ネットワーク不要）")
+    args = parser.parse_args()
+
+    load_dotenv()
+    embedding = CachedEmbeddings(GoogleGenerativeAIEmbeddings(model=EMBEDDING_MODEL), EMBEDDING_MODEL)
+    results = build_knowledge_index(embedding, include_web=not args.local_only)
+    for source, counts in results.items():
+        print(f"{source}: 埋め込み {counts['embedded']}件 / 変更なし {counts['unchanged']}件 / 削除 {counts['removed']}件")
+    print(f"ナレッジインデックスを更新しました: {KNOWLEDGE_INDEX_DIR}")
+    print(f"埋め込みキャッシュのヒット率: {embedding_cache.stats()['hit_rate']:.1%}")
@@ -0,0 +1,378 @@
+"""
+複数の農場のNDVI時系列をまとめて分析するモジュール
+
+農場ごとの履歴を (農場数, 日付数) の2次元配列に並べ、平滑化・トレンド推定・季節の平年値との比較を
+NumPyの配列演算で全農場に対して一度に行います。観測日は不規則でもよく、欠測はNaNで表します。
+"""
+import os
+import time
+import threading
+from collections import OrderedDict
+
+import numpy as np
+from scipy.signal import savgol_filter
+
+from app.services import ndvi_history
+
+# Savitzky-Golayフィルタの窓幅（観測回数）と多項式の次数
+SMOOTHING_WINDOW = 5
+SMOOTHING_POLYORDER = 2
+
+# トレンドを推定する直近の日数と、トレンドと判定する30日あたりの最小変化量・t値
+TREND_WINDOW_DAYS = 60
+TREND_MIN_CHANGE_PER_30_DAYS = 0.02
+TREND_MIN_T_VALUE = 2.0
+
+# 作成したパネルを使い回す秒数（他のワーカーが保存した観測はパネルを作り直すまで反映されない）
+PANEL_CACHE_TTL = int(os.getenv("NDVI_PANEL_CACHE_TTL", "600"))
+
+# 季節の平年値を集計する通年日の区切り（日）と、平年値に必要な観測数
+SEASON_BIN_DAYS = 16
+SEASON_MIN_SAMPLES = 3
+
+TREND_LABELS = {
+    "unknown": "不明（十分なデータがありません）",
+    "up": "上昇傾向（植生の健康状態が改善しています）",
+    "down": "下降傾向（植生の健康状態が悪化しています）",
+    "stable": "安定（植生の健康状態は安定しています）"
+}
+
+
+def to_days(dates):
+    """日付（YYYY-MM-DD）の配列を1970-01-01からの日数（int64）に変換します。"""
+    return np.asarray(dates, dtype='datetime64[D]').astype(np.int64)
+
+
+class NdviPanel:
+    """
+    農場ごとの平均NDVIを (農場数, 日付数) の配列で保持します。
+    日付は昇順で、新しい観測日の追加（update）は配列の末尾への書き込みだけで済みます。
+    """
+
+    def __init__(self, farm_ids, capacity=64):
+        self.farm_ids = list(farm_ids)
+        self._rows = {farm_id: i for i, farm_id in enumerate(self.farm_ids)}
+        self._days = np.empty(capacity, dtype=np.int64)
+        self._values = np.full((len(self.farm_ids), capacity), np.nan, dtype=np.float32)
+        self._size = 0
+
+    @classmethod
+    def from_history(cls, farm_ids, start_date=None, end_date=None):
+        """
+        履歴データベースから農場のパネルを作成します。
+
+        パラメータ:
+        farm_ids (list): 農場IDのリスト。
+        start_date (str): 開始日（YYYY-MM-DD）。
+        end_date (str): 終了日（YYYY-MM-DD）。
+
+        戻り値:
+        NdviPanel: 作成したパネル
+        """
+        rows = ndvi_history.get_ndvi_history_for_farms(farm_ids, start_date, end_date)
+        panel = cls(farm_ids)
+        if not rows:
+            return panel
+
+        row_farms, row_dates, row_values = zip(*rows)
+        days, columns = np.unique(to_days(row_dates), return_inverse=True)
+        panel._reserve(len(days))
+        panel._days[:len(days)] = days
+        panel._size = len(days)
+        farm_rows = np.array([panel._rows[farm_id] for farm_id in row_farms], dtype=np.int64)
+        panel._values[farm_rows, columns] = np.array(row_values, dtype=np.float64)
+        return panel
+
+    @property
+    def days(self):
+        return self._days[:self._size]
+
+    @property
+    def values(self):
+        return self._values[:, :self._size]
+
+    def _reserve(self, size):
+        capacity = self._days.shape[0]
+        if size <= capacity:
+            return
+        capacity = max(size, capacity * 2)
+        days = np.empty(capacity, dtype=np.int64)
+        days[:self._size] = self.days
+        values = np.full((len(self.farm_ids), capacity), np.nan, dtype=np.float32)
+        values[:, :self._size] = self.values
+        self._days, self._values = days, values
+
+    def update(self, date, farm_values):
+        """
+        観測日のNDVIを追加します（同じ日付があれば上書きします）。
+
+        パラメータ:
+        date (str): 日付（YYYY-MM-DD）。
+        farm_values (dict): {farm_id: 平均NDVI}。パネルにない農場は無視します。
+        """
+        day = int(to_days([date])[0])
+        column = int(np.searchsorted(self.days, day))
+        if column == self._size or self._days[column] != day:
+            self._reserve(self._size + 1)
+            if column < self._size:
+                # 過去の日付の追加（まれ）は後ろをずらして挿入する
+                self._days[column + 1:self._size + 1] = self._days[column:self._size]
+                self._values[:, column + 1:self._size + 1] = self._values[:, column:self._size]
+            self._days[column] = day
+            self._values[:, column] = np.nan
+            self._size += 1
+
+        for farm_id, value in farm_values.items():
+            row = self._rows.get(farm_id)
+            if row is not None:
+                self._values[row, column] = value
+
+
+class NdviPanelCache:
+    """
+    農場の集合と開始日ごとにパネルを保持し、新しい観測は履歴を読み直さずに update で追加します。
+    他のワーカーが保存した観測を取り込むため、パネルは ttl 秒で作り直します。
+    """
+
+    def __init__(self, max_entries=64, ttl=PANEL_CACHE_TTL):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._panels = OrderedDict()  # (farm_ids, start_date) -> (NdviPanel, created_at)
+        self._lock = threading.Lock()
+
+    def report(self, farm_ids, start_date=None, window_days=TREND_WINDOW_DAYS):
+        """
+        農場のトレンドをまとめます（trend_report と同じ形式）。パネルがなければ履歴から作成します。
+
+        パラメータ:
+        farm_ids (list): 農場IDのリスト。
+        start_date (str): 開始日（YYYY-MM-DD）。
+        window_days (int): トレンドを推定する直近の日数。
+
+        戻り値:
+        dict: {farm_id: トレンドの情報}
+        """
+        key = (tuple(farm_ids), start_date)
+        with self._lock:
+            entry = self._panels.get(key)
+            if entry is None or entry[1] < time.time() - self.ttl:
+                entry = (NdviPanel.from_history(farm_ids, start_date), time.time())
+                self._panels[key] = entry
+                while len(self._panels) > self.max_entries:
+                    self._panels.popitem(last=False)
+            self._panels.move_to_end(key)
+            return trend_report(entry[0], window_days)
+
+    def update(self, farm_id, date, mean_ndvi):
+        """
+        保存した観測を、その農場を含むパネルに追加します。
+
+        パラメータ:
+        farm_id (int): 農場ID。
+        date (str): 日付（YYYY-MM-DD）。
+        mean_ndvi (float): 平均NDVI。
+        """
+        with self._lock:
+            for (farm_ids, start_date), (panel, _) in self._panels.items():
+                if farm_id in farm_ids and (start_date is None or date >= start_date):
+                    panel.update(date, {farm_id: mean_ndvi})
+
+
+def fill_gaps(days, values):
+    """
+    欠測（NaN）を前後の観測から日数に応じて線形補間します（先頭・末尾は最も近い観測値）。
+
+    パラメータ:
+    days (ndarray): (日付数,) の日数。
+    values (ndarray): (農場数, 日付数) のNDVI。
+
+    戻り値:
+    ndarray: 補間した配列（観測が1つもない農場はNaNのまま）
+    """
+    values = np.asarray(values, dtype=np.float32)
+    valid = ~np.isnan(values)
+    n_dates = values.shape[1]
+    index = np.arange(n_dates)
+
+    # 各位置の直前・直後の観測位置
+    prev_index = np.maximum.accumulate(np.where(valid, index, -1), axis=1)
+    next_index = np.minimum.accumulate(np.where(valid, index, n_dates)[:, ::-1], axis=1)[:, ::-1]
+    has_prev = prev_index >= 0
+    has_next = next_index < n_dates
+    prev_index = np.where(has_prev, prev_index, next_index).clip(0, n_dates - 1)
+    next_index = np.where(has_next, next_index, prev_index).clip(0, n_dates - 1)
+
+    rows = np.arange(values.shape[0])[:, None]
+    prev_values = values[rows, prev_index]
+    next_values = values[rows, next_index]
+    span = (days[next_index] - days[prev_index]).astype(np.float32)
+    weight = np.divide(days[None, :] - days[prev_index], span, out=np.zeros_like(span), where=span > 0)
+    return prev_values + (next_values - prev_values) * weight
+
+
+def smooth(days, values, window=SMOOTHING_WINDOW, polyorder=SMOOTHING_POLYORDER):
+    """
+    欠測を補間したうえで、Savitzky-Golayフィルタで全農場を一度に平滑化します。
+    観測間隔の違いは補間で吸収し、フィルタは観測の並びに対して適用します。
+
+    パラメータ:
+    days (ndarray): (日付数,) の日数。
+    values (ndarray): (農場数, 日付数) のNDVI。
+    window (int): 窓幅（奇数）。日付数より大きい場合は日付数に合わせて小さくします。
+    polyorder (int): 多項式の次数。
+
+    戻り値:
+    ndarray: 平滑化した (農場数, 日付数) の配列
+    """
+    filled = fill_gaps(days, values)
+    window = min(window, filled.shape[1] if filled.shape[1] % 2 else filled.shape[1] - 1)
+    if window <= polyorder:
+        return filled
+    empty = np.isnan(filled).all(axis=1)
+    smoothed = savgol_filter(np.nan_to_num(filled), window, polyorder, axis=1, mode='interp')
+    smoothed[empty] = np.nan
+    return smoothed.astype(np.float32)
+
+
+def fit_trends(days, values):
+    """
+    欠測を除いて、農場ごとに日数に対するNDVIの回帰直線を一度に求めます（不規則な観測間隔に対応）。
+
+    パラメータ:
+    days (ndarray): (日付数,) の日数。
+    values (ndarray): (農場数, 日付数) のNDVI。
+
+    戻り値:
+    dict: 農場ごとの配列 slope（1日あたりの変化量）, stderr（傾きの標準誤差）, count（観測数）
+    """
+    valid = ~np.isnan(values)
+    weight = valid.astype(np.float64)
+    y = np.where(valid, values, 0).astype(np.float64)
+    # 数値誤差を抑えるため最新日を原点にする
+    x = (days - days[-1]).astype(np.float64) if len(days) else days.astype(np.float64)
+
+    count = weight.sum(axis=1)
+    n = np.maximum(count, 1)
+    mean_x = (weight * x).sum(axis=1) / n
+    mean_y = y.sum(axis=1) / n
+    dx = (x[None, :] - mean_x[:, None]) * weight
+    dy = (y - mean_y[:, None]) * weight
+    sxx = (dx * dx).sum(axis=1)
+    sxy = (dx * dy).sum(axis=1)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        slope = np.where(sxx > 0, sxy / sxx, np.nan)
+        residual = dy - slope[:, None] * dx
+        dof = count - 2
+        variance = np.where(dof > 0, (residual * residual).sum(axis=1) / dof, np.nan)
+        stderr = np.sqrt(variance / sxx)
+    return {'slope': slope, 'stderr': stderr, 'count': count.astype(np.int64)}
+
+
+def classify_trends(trends):
+    """
+    回帰の結果をトレンドの種類（up, down, stable, unknown）に分類します。
+    変化量が TREND_MIN_CHANGE_PER_30_DAYS 以上で、かつ t値が TREND_MIN_T_VALUE 以上の場合だけ上昇・下降とします。
+
+    戻り値:
+    ndarray: 農場ごとのトレンドの種類（文字列）
+    """
+    slope, stderr = trends['slope'], trends['stderr']
+    change = slope * 30
+    with np.errstate(divide='ignore', invalid='ignore'):
+        t_value = np.abs(slope) / stderr
+    # 残差が0（完全に直線上）の場合は t値を無限大とみなす
+    significant = (t_value >= TREND_MIN_T_VALUE) | ((stderr == 0) & (slope != 0))
+    kinds = np.full(slope.shape, "stable", dtype=object)
+    kinds[significant & (change >= TREND_MIN_CHANGE_PER_30_DAYS)] = "up"
+    kinds[significant & (change <= -TREND_MIN_CHANGE_PER_30_DAYS)] = "down"
+    kinds[(trends['count'] < 3) | np.isnan(slope)] = "unknown"
+    return kinds
+
+
+def seasonal_anomalies(days, values, bin_days=SEASON_BIN_DAYS, min_samples=SEASON_MIN_SAMPLES):
+    """
+    農場ごとに通年日の区間ごとの平年値（平均・標準偏差）を求め、各観測の偏差をzスコアで返します。
+
+    パラメータ:
+    days (ndarray): (日付数,) の日数。
+    values (ndarray): (農場数, 日付数) のNDVI。
+    bin_days (int): 通年日の区間の日数。
+    min_samples (int): 平年値に必要な観測数（足りない区間のzスコアはNaN）。
+
+    戻り値:
+    ndarray: (農場数, 日付数) のzスコア
+    """
+    dates = days.astype('datetime64[D]')
+    day_of_year = (dates - dates.astype('datetime64[Y]')).astype(np.int64)
+    bins = np.minimum(day_of_year // bin_days, 365 // bin_days)
+    n_bins = 365 // bin_days + 1
+
+    # 区間ごとの合計を (日付数, 区間数) の対応行列との積で一度に求める
+    onehot = np.zeros((len(days), n_bins), dtype=np.float64)
+    onehot[np.arange(len(days)), bins] = 1
+    valid = ~np.isnan(values)
+    y = np.where(valid, values, 0).astype(np.float64)
+    count = valid.astype(np.float64) @ onehot
+    total = y @ onehot
+    total_sq = (y * y) @ onehot
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        mean = total / count
+        std = np.sqrt(np.maximum(total_sq / count - mean * mean, 0) * count / (count - 1))
+        enough = count >= min_samples
+        mean = np.where(enough, mean, np.nan)
+        std = np.where(enough & (std > 0), std, np.nan)
+        return ((values - mean[:, bins]) / std[:, bins]).astype(np.float32)
+
+
+def trend_report(panel, window_days=TREND_WINDOW_DAYS):
+    """
+    パネルの全農場について、平滑化した最新値・直近のトレンド（観測値の回帰）・平年値との偏差をまとめます。
+
+    パラメータ:
+    panel (NdviPanel): 農場のパネル。
+    window_days (int): トレンドを推定する直近の日数。
+
+    戻り値:
+    dict: {farm_id: {'latest_date', 'latest', 'smoothed', 'change_per_30_days', 'trend',
+                     'trend_label', 'anomaly', 'observations'}}
+    """
+    days, values = panel.days, panel.values
+    if not len(days):
+        return {
+            farm_id: {'trend': 'unknown', 'trend_label': TREND_LABELS['unknown'], 'observations': 0}
+            for farm_id in panel.farm_ids
+        }
+
+    # 平滑化した値は表示用。平滑化すると残差に相関が生じて標準誤差が小さくなり、
+    # t値が過大になるため、トレンドは実際の観測値（欠測は除く）で推定する
+    smoothed = smooth(days, values)
+    recent = days >= days[-1] - window_days
+    trends = fit_trends(days[recent], values[:, recent])
+    kinds = classify_trends(trends)
+    anomalies = seasonal_anomalies(days, values)
+
+    # 農場ごとの最新の観測位置
+    valid = ~np.isnan(values)
+    last = np.where(valid.any(axis=1), values.shape[1] - 1 - np.argmax(valid[:, ::-1], axis=1), -1)
+    dates = days.astype('datetime64[D]').astype(str)
+
+    report = {}
+    for row, farm_id in enumerate(panel.farm_ids):
+        column = last[row]
+        has_data = column >= 0
+        report[farm_id] = {
+            'latest_date': str(dates[column]) if has_data else None,
+            'latest': float(values[row, column]) if has_data else None,
+            'smoothed': float(smoothed[row, column]) if has_data else None,
+            'change_per_30_days': None if np.isnan(trends['slope'][row]) else float(trends['slope'][row] * 30),
+            'trend': kinds[row],
+            'trend_label': TREND_LABELS[kinds[row]],
+            'anomaly': float(anomalies[row, column]) if has_data and not np.isnan(anomalies[row, column]) else None,
+            'observations': int(valid[row].sum())
+        }
+    return report
+
+
+panel_cache = NdviPanelCache()
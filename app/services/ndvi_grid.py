@@ -0,0 +1,213 @@
+"""
+日本全体のNDVIグリッドを生成するモジュール（暫定データ）
+
+陸地マスクは固定シードで一度だけ作成し、NDVI値は日付をシードにして生成するため、
+同じ日付・グリッドサイズなら何度呼んでも同じ結果になり、日付ごとにメモ化できます。
+"""
+import gzip
+import struct
+from datetime import datetime
+from functools import lru_cache
+
+import numpy as np
+
+# 日本全体をカバーする範囲
+JAPAN_BOUNDS = {
+    "north": 45.8,  # 北海道の北端
+    "south": 24.0,  # 沖縄の南端
+    "east": 146.0,  # 小笠原諸島の東端
+    "west": 122.0   # 与那国島の西端
+}
+
+# 簡易的な陸地判定の範囲と陸地の割合 (south, north, west, east, 割合)。先に書いたものが優先
+LAND_REGIONS = [
+    (41.0, 45.8, 140.0, 146.0, 0.6),  # 北海道
+    (33.0, 41.0, 130.0, 142.0, 0.7),  # 本州
+    (30.0, 34.5, 129.0, 135.0, 0.6),  # 四国・九州
+    (24.0, 27.0, 122.0, 129.0, 0.3),  # 沖縄
+]
+SEA_LAND_RATIO = 0.1  # 海の部分はほとんどデータなし
+
+GRID_SIZE = 50
+LAND_MASK_SEED = 20240101
+
+# 最新日からの日数に対する変動幅（30日で最大±0.1）
+VARIATION_PER_30_DAYS = 0.1
+
+
+def _readonly(array):
+    array.setflags(write=False)
+    return array
+
+
+def _date_seed(date_str):
+    return int(datetime.strptime(date_str, "%Y%m%d").strftime("%Y%m%d"))
+
+
+@lru_cache(maxsize=8)
+def get_grid_axes(grid_size=GRID_SIZE):
+    """
+    グリッドの各行の緯度と各列の経度を返します。
+
+    パラメータ:
+    grid_size (int): グリッドの一辺のセル数。
+
+    戻り値:
+    tuple: (緯度の配列, 経度の配列)
+    """
+    lat_step = (JAPAN_BOUNDS["north"] - JAPAN_BOUNDS["south"]) / grid_size
+    lng_step = (JAPAN_BOUNDS["east"] - JAPAN_BOUNDS["west"]) / grid_size
+    lats = JAPAN_BOUNDS["south"] + np.arange(grid_size) * lat_step
+    lngs = JAPAN_BOUNDS["west"] + np.arange(grid_size) * lng_step
+    return _readonly(lats), _readonly(lngs)
+
+
+@lru_cache(maxsize=8)
+def get_land_mask(grid_size=GRID_SIZE):
+    """
+    陸地マスクを作成します（固定シードのため常に同じ結果）。
+
+    パラメータ:
+    grid_size (int): グリッドの一辺のセル数。
+
+    戻り値:
+    ndarray: (grid_size, grid_size) のbool配列。行が緯度、列が経度に対応。
+    """
+    lats, lngs = get_grid_axes(grid_size)
+    lat_grid = lats[:, None]
+    lng_grid = lngs[None, :]
+
+    ratio = np.full((grid_size, grid_size), SEA_LAND_RATIO)
+    # 優先度の低い範囲から上書きする
+    for south, north, west, east, land_ratio in reversed(LAND_REGIONS):
+        inside = (lat_grid >= south) & (lat_grid <= north) & (lng_grid >= west) & (lng_grid <= east)
+        ratio[inside] = land_ratio
+
+    rng = np.random.default_rng(LAND_MASK_SEED)
+    return _readonly(rng.random((grid_size, grid_size)) < ratio)
+
+
+@lru_cache(maxsize=32)
+def get_base_ndvi_grid(date_str, grid_size=GRID_SIZE):
+    """
+    指定日のNDVIグリッドを生成します（陸地以外はNaN）。
+
+    パラメータ:
+    date_str (str): 日付（YYYYMMDD）。
+    grid_size (int): グリッドの一辺のセル数。
+
+    戻り値:
+    ndarray: (grid_size, grid_size) のfloat32配列。
+    """
+    rng = np.random.default_rng(_date_seed(date_str))
+    values = rng.random((grid_size, grid_size), dtype=np.float32)
+    values[~get_land_mask(grid_size)] = np.nan
+    return _readonly(values)
+
+
+@lru_cache(maxsize=32)
+def get_ndvi_grid_for_date(date_str, latest_date, grid_size=GRID_SIZE):
+    """
+    最新日のグリッドを基準に、指定日のNDVIグリッドを作成します。
+    最新日から離れるほど大きな変動（日付をシードにした一様乱数）を加えます。
+
+    パラメータ:
+    date_str (str): 日付（YYYYMMDD）。
+    latest_date (str): 最新日（YYYYMMDD）。
+    grid_size (int): グリッドの一辺のセル数。
+
+    戻り値:
+    ndarray: (grid_size, grid_size) のfloat32配列。
+    """
+    base = get_base_ndvi_grid(latest_date, grid_size)
+    if date_str == latest_date:
+        return base
+
+    days_diff = (datetime.strptime(latest_date, "%Y%m%d") - datetime.strptime(date_str, "%Y%m%d")).days
+    rng = np.random.default_rng(_date_seed(date_str))
+    variation = rng.uniform(-VARIATION_PER_30_DAYS, VARIATION_PER_30_DAYS, base.shape).astype(np.float32)
+    variation *= days_diff / 30
+    values = base + variation
+    np.clip(values, 0.0, 1.0, out=values)
+    return _readonly(values)
+
+
+def grid_to_points(values, grid_size=GRID_SIZE):
+    """
+    グリッドを {lat, lng, ndvi} のリストに変換します（陸地のセルのみ）。
+
+    パラメータ:
+    values (ndarray): (grid_size, grid_size) のNDVIグリッド。
+    grid_size (int): グリッドの一辺のセル数。
+
+    戻り値:
+    list: [{'lat': float, 'lng': float, 'ndvi': float}, ...]
+    """
+    lats, lngs = get_grid_axes(grid_size)
+    rows, cols = np.nonzero(get_land_mask(grid_size))
+    return [
+        {"lat": lat, "lng": lng, "ndvi": ndvi}
+        for lat, lng, ndvi in zip(lats[rows].tolist(), lngs[cols].tolist(), values[rows, cols].tolist())
+    ]
+
+
+# バイナリ形式（map_routesで Accept または ?format=grid の場合に使用）
+#   ヘッダー（リトルエンディアン、64バイト）:
+#     magic "NDVG", version(u8), dtype(u8: 0=float32, 1=uint8), 予約(u16),
+#     rows(u32), cols(u32), south, west, lat_step, lng_step (f64),
+#     scale, offset (f32: 値 = 格納値 * scale + offset), date (8バイトのASCII, YYYYMMDD)
+#   続いて陸地のビットマスク（行優先、ceil(rows * cols / 8) バイト、MSBが先頭）と、
+#   陸地のセルだけの値の配列（行優先）
+GRID_MIMETYPE = "application/vnd.agristar.ndvi-grid"
+GRID_FORMAT_VERSION = 1
+GRID_DTYPES = {
+    "float32": (0, 1.0, 0.0),
+    "uint8": (1, 2 / 255, -1.0),  # -1〜1 を 0〜255 に量子化
+}
+_GRID_HEADER = struct.Struct("<4sBBHII4d2f8s")
+
+
+def encode_grid(values, date_str, grid_size=GRID_SIZE, dtype="float32"):
+    """
+    NDVIグリッドをバイナリ形式にエンコードします。
+
+    パラメータ:
+    values (ndarray): (grid_size, grid_size) のNDVIグリッド。
+    date_str (str): 日付（YYYYMMDD）。
+    grid_size (int): グリッドの一辺のセル数。
+    dtype (str): 値の型（float32 または uint8）。
+
+    戻り値:
+    bytes: エンコードされたグリッド。
+    """
+    if dtype not in GRID_DTYPES:
+        raise ValueError(f"未対応の型です: {dtype}")
+    code, scale, offset = GRID_DTYPES[dtype]
+
+    land = get_land_mask(grid_size)
+    land_values = values[land]
+    if dtype == "uint8":
+        land_values = np.rint((np.clip(land_values, -1, 1) - offset) / scale).astype(np.uint8)
+    else:
+        land_values = land_values.astype("<f4")
+
+    lats, lngs = get_grid_axes(grid_size)
+    lat_step = (JAPAN_BOUNDS["north"] - JAPAN_BOUNDS["south"]) / grid_size
+    lng_step = (JAPAN_BOUNDS["east"] - JAPAN_BOUNDS["west"]) / grid_size
+    header = _GRID_HEADER.pack(
+        b"NDVG", GRID_FORMAT_VERSION, code, 0, grid_size, grid_size,
+        float(lats[0]), float(lngs[0]), lat_step, lng_step, scale, offset, date_str.encode("ascii")
+    )
+    return header + np.packbits(land).tobytes() + land_values.tobytes()
+
+
+@lru_cache(maxsize=32)
+def get_encoded_grid(date_str, latest_date, grid_size=GRID_SIZE, dtype="float32"):
+    """
+    指定日のグリッドをバイナリ形式にエンコードし、gzip圧縮したものと合わせて返します（メモ化されます）。
+
+    戻り値:
+    tuple: (エンコードされたグリッド, gzip圧縮したもの)
+    """
+    data = encode_grid(get_ndvi_grid_for_date(date_str, latest_date, grid_size), date_str, grid_size, dtype)
+    return data, gzip.compress(data, compresslevel=6, mtime=0)
@@ -0,0 +1,246 @@
+"""
+農場のNDVI履歴（farm_ndvi_historyテーブル）を保存・取得するモジュール
+
+接続はスレッドごとに1つ作成して使い回し、WALモードで読み込みと書き込みが互いを待たないようにします。
+(farm_id, date) には一意インデックスがあり、保存はUPSERT（同じ日付のデータは新しい統計で更新）です。
+"""
+import os
+import sqlite3
+import threading
+
+DB_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.dirname(__file__))), 'instance', 'farms.db')
+
+# 書き込みがロックされている場合に待つ時間（ミリ秒）
+BUSY_TIMEOUT_MS = 10000
+# save_ndvi_records で1トランザクションにまとめる件数
+BATCH_SIZE = 500
+
+_local = threading.local()
+_schema_lock = threading.Lock()
+_schema_ready = set()
+
+_UPSERT_SQL = (
+    "INSERT INTO farm_ndvi_history (farm_id, date, min_ndvi, max_ndvi, mean_ndvi, median_ndvi, crop_type) "
+    "VALUES (?, ?, ?, ?, ?, ?, ?) "
+    "ON CONFLICT(farm_id, date) DO UPDATE SET "
+    "min_ndvi = excluded.min_ndvi, max_ndvi = excluded.max_ndvi, mean_ndvi = excluded.mean_ndvi, "
+    "median_ndvi = excluded.median_ndvi, crop_type = COALESCE(excluded.crop_type, farm_ndvi_history.crop_type)"
+)
+
+
+def _ensure_schema(conn, db_path):
+    with _schema_lock:
+        if db_path in _schema_ready:
+            return
+        conn.executescript('''
+        CREATE TABLE IF NOT EXISTS farm_ndvi_history (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            farm_id INTEGER NOT NULL,
+            date TEXT NOT NULL,
+            min_ndvi REAL,
+            max_ndvi REAL,
+            mean_ndvi REAL,
+            median_ndvi REAL,
+            crop_type TEXT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        );
+        ''')
+        has_index = conn.execute(
+            "SELECT 1 FROM sqlite_master WHERE type = 'index' AND name = 'idx_farm_ndvi_history_farm_date'"
+        ).fetchone()
+        if not has_index:
+            # 一意インデックスを作る前に、以前のバージョンで保存された重複を取り除く（最初の行を残す）
+            with conn:
+                conn.execute(
+                    "DELETE FROM farm_ndvi_history WHERE id NOT IN "
+                    "(SELECT MIN(id) FROM farm_ndvi_history GROUP BY farm_id, date)"
+                )
+                conn.execute(
+                    "CREATE UNIQUE INDEX IF NOT EXISTS idx_farm_ndvi_history_farm_date "
+                    "ON farm_ndvi_history (farm_id, date)"
+                )
+        _schema_ready.add(db_path)
+
+
+def get_connection(db_path=DB_PATH):
+    """
+    現在のスレッドのデータベース接続を返します（初回は接続してテーブルとインデックスを作成します）。
+    接続はスレッド内で使い回すため、呼び出し側で閉じないでください。
+
+    パラメータ:
+    db_path (str): データベースファイルのパス。
+
+    戻り値:
+    sqlite3.Connection: データベース接続。
+    """
+    connections = getattr(_local, 'connections', None)
+    if connections is None:
+        connections = _local.connections = {}
+
+    conn = connections.get(db_path)
+    if conn is None:
+        os.makedirs(os.path.dirname(db_path), exist_ok=True)
+        conn = sqlite3.connect(db_path, timeout=BUSY_TIMEOUT_MS / 1000)
+        conn.row_factory = sqlite3.Row
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute(f"PRAGMA busy_timeout={BUSY_TIMEOUT_MS}")
+        _ensure_schema(conn, db_path)
+        connections[db_path] = conn
+    return conn
+
+
+def _record_params(farm_id, date, ndvi_stats, crop_type=None):
+    return (
+        farm_id,
+        date,
+        ndvi_stats['min'],
+        ndvi_stats['max'],
+        ndvi_stats['mean'],
+        ndvi_stats['median'],
+        crop_type
+    )
+
+
+def save_ndvi_record(farm_id, date, ndvi_stats, crop_type=None, db_path=DB_PATH):
+    """
+    NDVIの統計を履歴に保存します（同じ日付のデータがあれば新しい統計で更新します）。
+
+    パラメータ:
+    farm_id (int): 農場ID。
+    date (str): 日付（YYYY-MM-DD）。
+    ndvi_stats (dict): min, max, mean, median を持つ統計情報。
+    crop_type (str): 作物の種類。
+    db_path (str): データベースファイルのパス。
+    """
+    conn = get_connection(db_path)
+    with conn:
+        conn.execute(_UPSERT_SQL, _record_params(farm_id, date, ndvi_stats, crop_type))
+
+
+def save_ndvi_records(records, db_path=DB_PATH):
+    """
+    複数のNDVI統計をまとめて保存します（BATCH_SIZE件ごとに1トランザクション）。
+
+    パラメータ:
+    records (iterable): (farm_id, date, ndvi_stats, crop_type) のタプル。
+    db_path (str): データベースファイルのパス。
+
+    戻り値:
+    int: 保存した件数。
+    """
+    conn = get_connection(db_path)
+    batch = []
+    saved = 0
+    for record in records:
+        batch.append(_record_params(*record))
+        if len(batch) >= BATCH_SIZE:
+            with conn:
+                conn.executemany(_UPSERT_SQL, batch)
+            saved += len(batch)
+            batch = []
+    if batch:
+        with conn:
+            conn.executemany(_UPSERT_SQL, batch)
+        saved += len(batch)
+    return saved
+
+
+def _to_record(row):
+    return {
+        'date': row['date'],
+        'min': row['min_ndvi'],
+        'max': row['max_ndvi'],
+        'mean': row['mean_ndvi'],
+        'median': row['median_ndvi'],
+        'crop_type': row['crop_type']
+    }
+
+
+def get_ndvi_history(farm_id, start_date=None, end_date=None, db_path=DB_PATH):
+    """
+    期間内のNDVI履歴を日付順に返します。
+
+    パラメータ:
+    farm_id (int): 農場ID。
+    start_date (str): 開始日（YYYY-MM-DD）。省略時は制限なし。
+    end_date (str): 終了日（YYYY-MM-DD）。省略時は制限なし。
+    db_path (str): データベースファイルのパス。
+
+    戻り値:
+    list: [{'date', 'min', 'max', 'mean', 'median', 'crop_type'}, ...]
+    """
+    query = "SELECT * FROM farm_ndvi_history WHERE farm_id = ?"
+    params = [farm_id]
+    if start_date:
+        query += " AND date >= ?"
+        params.append(start_date)
+    if end_date:
+        query += " AND date <= ?"
+        params.append(end_date)
+    rows = get_connection(db_path).execute(query + " ORDER BY date", params).fetchall()
+    return [_to_record(row) for row in rows]
+
+
+def get_latest_ndvi_history(farm_id, limit=10, before=None, db_path=DB_PATH):
+    """
+    最新のNDVI履歴を limit 件、日付順（古い順）に返します。
+
+    パラメータ:
+    farm_id (int): 農場ID。
+    limit (int): 件数。
+    before (str): この日付（YYYY-MM-DD）以前の履歴のみ。省略時は制限なし。
+    db_path (str): データベースファイルのパス。
+
+    戻り値:
+    list: [{'date', 'min', 'max', 'mean', 'median', 'crop_type'}, ...]
+    """
+    query = "SELECT * FROM farm_ndvi_history WHERE farm_id = ?"
+    params = [farm_id]
+    if before:
+        query += " AND date <= ?"
+        params.append(before)
+    query += " ORDER BY date DESC LIMIT ?"
+    params.append(limit)
+    rows = get_connection(db_path).execute(query, params).fetchall()
+    return [_to_record(row) for row in reversed(rows)]
+
+
+def get_ndvi_history_for_farms(farm_ids, start_date=None, end_date=None, db_path=DB_PATH):
+    """
+    複数の農場の平均NDVIの履歴を1回の問い合わせで返します。
+
+    パラメータ:
+    farm_ids (list): 農場IDのリスト。
+    start_date (str): 開始日（YYYY-MM-DD）。省略時は制限なし。
+    end_date (str): 終了日（YYYY-MM-DD）。省略時は制限なし。
+    db_path (str): データベースファイルのパス。
+
+    戻り値:
+    list: (farm_id, date, mean_ndvi) のタプルのリスト（日付順）
+    """
+    farm_ids = list(farm_ids)
+    if not farm_ids:
+        return []
+    conditions = ""
+    date_params = []
+    if start_date:
+        conditions += " AND date >= ?"
+        date_params.append(start_date)
+    if end_date:
+        conditions += " AND date <= ?"
+        date_params.append(end_date)
+
+    # 古いSQLiteはバインド変数が999個までのため、500件ずつ問い合わせる
+    conn = get_connection(db_path)
+    rows = []
+    for start in range(0, len(farm_ids), 500):
+        batch = farm_ids[start:start + 500]
+        rows += conn.execute(
+            f"SELECT farm_id, date, mean_ndvi FROM farm_ndvi_history WHERE farm_id IN ({','.join('?' * len(batch))})"
+            + conditions + " ORDER BY date",
+            batch + date_params
+        ).fetchall()
+    if len(farm_ids) > 500:
+        rows.sort(key=lambda row: row[1])
+    return [tuple(row) for row in rows]
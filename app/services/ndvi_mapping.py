@@ -1,6 +1,7 @@
 """
 NDVIデータと作物健康状態をマッピングするための定義モジュール
 """
+import numpy as np
 
 # NDVIのマッピングルール
 NDVI_MAPPING = {
@@ -130,6 +131,72 @@ def evaluate_ndvi_health(ndvi_value):
             return health
     return "unknown"
 
+# 健康状態の区分（NDVIの低い順）と、区分の境界値
+HEALTH_CLASSES = sorted(NDVI_MAPPING["health"], key=lambda health: NDVI_MAPPING["health"][health][0])
+HEALTH_CLASS_EDGES = np.array([NDVI_MAPPING["health"][health][0] for health in HEALTH_CLASSES[1:]])
+# クラスラスタでデータのない画素の値
+HEALTH_NODATA = 255
+
+# NDVI配列の画素ごとに健康状態を分類する関数
+def classify_ndvi_pixels(ndvi, mask=None, pixel_area_m2=None, return_raster=False):
+    """
+    NDVI配列の各画素を evaluate_ndvi_health と同じ閾値で分類し、区分ごとの画素数と面積の割合を求める
+    （境界値はevaluate_ndvi_healthと同じく上の区分に含めます）
+    
+    Parameters:
+    ndvi (ndarray): NDVIマップ（データのない画素はNaN）
+    mask (ndarray): 農場ポリゴン内の画素がTrueのbool配列。指定した場合はその画素だけを集計
+    pixel_area_m2 (float): 1画素の面積（平方メートル）。指定した場合は区分ごとの面積（ha）も返す
+    return_raster (bool): Trueの場合は区分番号（HEALTH_CLASSESの添字）のuint8ラスタも返す
+    
+    Returns:
+    dict: counts, fractions, dominant, pixel_count（area_ha, raster は指定時のみ）
+    """
+    valid = ~np.isnan(ndvi)
+    if mask is not None:
+        valid &= mask
+    
+    if return_raster:
+        # 全画素を一度に分類し、集計にはそのラスタを使う
+        raster = np.digitize(np.where(valid, ndvi, 0), HEALTH_CLASS_EDGES).astype(np.uint8)
+        raster[~valid] = HEALTH_NODATA
+        classes = raster[valid]
+    else:
+        classes = np.digitize(ndvi[valid], HEALTH_CLASS_EDGES)
+    
+    counts = np.bincount(classes, minlength=len(HEALTH_CLASSES))
+    total = int(counts.sum())
+    result = {
+        "counts": {health: int(count) for health, count in zip(HEALTH_CLASSES, counts)},
+        "fractions": {health: (float(count) / total if total else 0.0) for health, count in zip(HEALTH_CLASSES, counts)},
+        "dominant": HEALTH_CLASSES[int(np.argmax(counts))] if total else None,
+        "pixel_count": total
+    }
+    if pixel_area_m2 is not None:
+        result["area_ha"] = {health: float(count) * pixel_area_m2 / 10000 for health, count in zip(HEALTH_CLASSES, counts)}
+    if return_raster:
+        result["raster"] = raster
+    return result
+
+# 低い区分の面積の割合から、平均値だけでは分からない圃場内のばらつきを判断する関数
+def summarize_health_zones(health_zones, threshold=0.2):
+    """
+    健康状態の区分の割合から、注意が必要な区域の説明を作成する
+    
+    Parameters:
+    health_zones (dict): classify_ndvi_pixels の戻り値
+    threshold (float): 注意が必要とする面積の割合
+    
+    Returns:
+    str or None: 説明（注意が必要な区域がない場合は None）
+    """
+    fractions = health_zones.get("fractions", {})
+    weak = sum(fractions.get(health, 0.0) for health in ("poor", "very_poor", "stressed"))
+    if not health_zones.get("pixel_count") or weak < threshold:
+        return None
+    return (f"圃場の約{weak * 100:.0f}%で生育が不良（NDVI 0.4未満）です。"
+            "平均値が良好でも生育にむらがあるため、該当する区域の排水・施肥・病害虫を重点的に確認してください。")
+
 # 季節を判断する関数
 def get_current_season():
     """
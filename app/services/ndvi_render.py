@@ -0,0 +1,213 @@
+"""
+NDVI画像・RGB画像を描画してエンコードするモジュール
+
+カラーマップは事前に計算した256色のuint8ルックアップテーブルで適用し、cv2でPNG/WebPにエンコードします。
+エンコード済みの画像は内容のハッシュをIDとしてディスクに保存し、専用のエンドポイントから配信します。
+"""
+import os
+import re
+import hashlib
+import threading
+from functools import lru_cache
+
+import cv2
+import numpy as np
+
+DEFAULT_IMAGE_DIR = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.dirname(__file__))), 'instance', 'rendered'
+)
+
+# 出力形式（png または webp）とエンコードのパラメータ
+IMAGE_FORMAT = os.getenv("NDVI_IMAGE_FORMAT", "png")
+PNG_COMPRESSION = int(os.getenv("NDVI_PNG_COMPRESSION", "3"))  # 0〜9（小さいほど高速）
+WEBP_QUALITY = int(os.getenv("NDVI_WEBP_QUALITY", "101"))  # 101以上はロスレス
+
+MIMETYPES = {
+    "png": "image/png",
+    "webp": "image/webp"
+}
+
+# RGB画像の明るさ調整の倍率
+RGB_BRIGHTNESS = 3.5
+
+_IMAGE_ID_PATTERN = re.compile(r'[0-9a-f]{40}\.(png|webp)')
+
+
+@lru_cache(maxsize=None)
+def get_colormap_lut(name='RdYlGn'):
+    """
+    matplotlibのカラーマップから257色のBGRAルックアップテーブルを作成します。
+    0〜255がNDVI -1〜1 に対応し、256はデータのない画素用の透明色です。
+
+    パラメータ:
+    name (str): matplotlibのカラーマップ名。
+
+    戻り値:
+    ndarray: (257, 4) のuint8配列（BGRA順）。
+    """
+    import matplotlib
+    cmap = matplotlib.colormaps[name].resampled(256)
+    rgba = (cmap(np.arange(256)) * 255).astype(np.uint8)
+    lut = np.zeros((257, 4), dtype=np.uint8)
+    lut[:256] = rgba[:, [2, 1, 0, 3]]
+    return lut
+
+
+@lru_cache(maxsize=None)
+def _brightness_lut(factor):
+    return np.clip(np.arange(256) * factor, 0, 255).astype(np.uint8)
+
+
+def colorize_ndvi(ndvi, cmap='RdYlGn'):
+    """
+    NDVI配列にカラーマップを適用します。
+
+    パラメータ:
+    ndvi (ndarray): NDVIマップ（データのない画素はNaN）。
+    cmap (str): matplotlibのカラーマップ名。
+
+    戻り値:
+    ndarray: (高さ, 幅, 4) のuint8配列（BGRA順、cv2でそのままエンコード可能）。
+    """
+    scaled = np.clip(ndvi, -1, 1)
+    nodata = np.isnan(scaled)
+    scaled[nodata] = -1
+    scaled += 1
+    scaled *= 127.5
+    index = scaled.astype(np.uint16)
+    index[nodata] = 256
+    return get_colormap_lut(cmap)[index]
+
+
+def brighten_rgb(rgb, factor=RGB_BRIGHTNESS):
+    """
+    RGB画像の明るさを調整します。
+
+    パラメータ:
+    rgb (ndarray): (高さ, 幅, 3) のuint8配列（RGB順）。
+    factor (float): 明るさの倍率。
+
+    戻り値:
+    ndarray: (高さ, 幅, 3) のuint8配列（BGR順、cv2でそのままエンコード可能）。
+    """
+    return _brightness_lut(factor)[rgb[:, :, ::-1]]
+
+
+def encode_image(image, fmt=None):
+    """
+    cv2で画像をエンコードします。
+
+    パラメータ:
+    image (ndarray): BGRまたはBGRAのuint8配列。
+    fmt (str): png または webp。省略時は IMAGE_FORMAT。
+
+    戻り値:
+    bytes: エンコードされた画像。
+    """
+    fmt = fmt or IMAGE_FORMAT
+    if fmt == "png":
+        params = [cv2.IMWRITE_PNG_COMPRESSION, PNG_COMPRESSION]
+    elif fmt == "webp":
+        params = [cv2.IMWRITE_WEBP_QUALITY, WEBP_QUALITY]
+    else:
+        raise ValueError(f"未対応の画像形式です: {fmt}")
+
+    ok, buffer = cv2.imencode(f".{fmt}", image, params)
+    if not ok:
+        raise ValueError("画像のエンコードに失敗しました。")
+    return buffer.tobytes()
+
+
+class ImageStore:
+    """
+    エンコード済み画像を内容のハッシュをIDとして保存します。
+    同じIDの内容は変わらないため、ブラウザで長期間キャッシュできます。
+    """
+
+    def __init__(self, image_dir=DEFAULT_IMAGE_DIR, max_bytes=512 * 1024 ** 2):
+        self.image_dir = image_dir
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+
+    def put(self, data, fmt):
+        """
+        画像を保存します。
+
+        パラメータ:
+        data (bytes): エンコードされた画像。
+        fmt (str): png または webp。
+
+        戻り値:
+        str: 画像ID（<sha1>.<fmt>）。
+        """
+        image_id = f"{hashlib.sha1(data).hexdigest()}.{fmt}"
+        path = os.path.join(self.image_dir, image_id)
+        with self._lock:
+            if os.path.exists(path):
+                os.utime(path)
+                return image_id
+            os.makedirs(self.image_dir, exist_ok=True)
+            tmp_path = f"{path}.{os.getpid()}.tmp"
+            with open(tmp_path, 'wb') as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+            self._evict()
+        return image_id
+
+    def path_for(self, image_id):
+        """
+        画像IDに対応するファイルのパスを返します。
+
+        パラメータ:
+        image_id (str): 画像ID。
+
+        戻り値:
+        str or None: ファイルのパス。IDが不正、またはファイルがない場合は None。
+        """
+        if not _IMAGE_ID_PATTERN.fullmatch(image_id):
+            return None
+        path = os.path.join(self.image_dir, image_id)
+        return path if os.path.exists(path) else None
+
+    def _evict(self):
+        entries = []
+        for name in os.listdir(self.image_dir):
+            path = os.path.join(self.image_dir, name)
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            entries.append((st.st_mtime, st.st_size, path))
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            total -= size
+
+
+image_store = ImageStore(
+    image_dir=os.getenv("NDVI_IMAGE_DIR", DEFAULT_IMAGE_DIR),
+    max_bytes=int(os.getenv("NDVI_IMAGE_STORE_MB", "512")) * 1024 ** 2
+)
+
+
+def render_ndvi_images(ndvi, rgb, fmt=None):
+    """
+    NDVI画像とRGB画像を描画・エンコードしてimage_storeに保存します。
+
+    パラメータ:
+    ndvi (ndarray): NDVIマップ。
+    rgb (ndarray): (高さ, 幅, 3) のuint8配列（RGB順）。
+    fmt (str): png または webp。省略時は IMAGE_FORMAT。
+
+    戻り値:
+    tuple: (NDVI画像のID, RGB画像のID)
+    """
+    fmt = fmt or IMAGE_FORMAT
+    ndvi_id = image_store.put(encode_image(colorize_ndvi(ndvi), fmt), fmt)
+    rgb_id = image_store.put(encode_image(brighten_rgb(rgb), fmt), fmt)
+    return ndvi_id, rgb_id
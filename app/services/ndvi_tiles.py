@@ -0,0 +1,245 @@
+"""
+Leaflet用のNDVIタイル（XYZ / Web Mercator）を生成・キャッシュするモジュール
+
+タイルはキャッシュ済みの農場ラスタから必要になった時点で生成し、ディスクに保存します。
+"""
+import os
+import math
+import time
+import hashlib
+import threading
+from functools import lru_cache
+from datetime import datetime, timedelta
+
+import numpy as np
+
+from app.services.satellite_service import get_cached_farm_ndvi, get_farm_bbox, latest_acquisition_date_range
+from app.services.ndvi_render import colorize_ndvi, encode_image
+
+TILE_SIZE = 256
+MAX_ZOOM = 22
+
+DEFAULT_TILE_DIR = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.dirname(__file__))), 'instance', 'tiles'
+)
+# 新しい農場ラスタが取得されるとタイルの内容が変わるため、保存したタイルの有効期間を設ける
+TILE_TTL = int(os.getenv("NDVI_TILE_TTL", "3600"))
+# タイルのURLでこの日付を指定すると、農場ごとの最新の撮影日（農場画面の既定と同じ期間）を使う
+LATEST = "latest"
+
+
+def tile_bounds(z, x, y):
+    """
+    XYZタイルの範囲を返します。
+
+    パラメータ:
+    z (int): ズームレベル。
+    x (int): タイルのX番号。
+    y (int): タイルのY番号。
+
+    戻り値:
+    tuple: WGS84形式の座標 (min_lon, min_lat, max_lon, max_lat)
+    """
+    n = 2 ** z
+    min_lon = x / n * 360.0 - 180.0
+    max_lon = (x + 1) / n * 360.0 - 180.0
+    max_lat = math.degrees(math.atan(math.sinh(math.pi * (1 - 2 * y / n))))
+    min_lat = math.degrees(math.atan(math.sinh(math.pi * (1 - 2 * (y + 1) / n))))
+    return (min_lon, min_lat, max_lon, max_lat)
+
+
+def validate_tile(z, x, y):
+    """
+    タイル番号が範囲内か確認します。範囲外の場合は ValueError を送出します。
+    """
+    if not 0 <= z <= MAX_ZOOM or not (0 <= x < 2 ** z and 0 <= y < 2 ** z):
+        raise ValueError("タイル番号が範囲外です。")
+
+
+def _intersects(a, b):
+    return a[0] < b[2] and b[0] < a[2] and a[1] < b[3] and b[1] < a[3]
+
+
+def render_ndvi_tile(z, x, y, farm_layers):
+    """
+    農場ごとのNDVIラスタをタイルに再投影して描画します（最近傍補間）。
+
+    パラメータ:
+    z, x, y (int): タイル番号。
+    farm_layers (list): (バウンディングボックス, NDVI配列) のリスト。
+
+    戻り値:
+    ndarray or None: (256, 256, 4) のBGRA配列。タイルに掛かる農場がない場合は None。
+    """
+    bounds = tile_bounds(z, x, y)
+    n = 2 ** z
+
+    # タイルの各列の経度と各行の緯度（画素中心）
+    pixel = (np.arange(TILE_SIZE) + 0.5) / TILE_SIZE
+    lons = (x + pixel) / n * 360.0 - 180.0
+    lats = np.degrees(np.arctan(np.sinh(np.pi * (1 - 2 * (y + pixel) / n))))
+
+    tile = np.full((TILE_SIZE, TILE_SIZE), np.nan, dtype=np.float32)
+    drawn = False
+    for bbox, ndvi in farm_layers:
+        if not _intersects(bounds, bbox):
+            continue
+        height, width = ndvi.shape
+        cols = np.floor((lons - bbox[0]) / (bbox[2] - bbox[0]) * width).astype(np.int64)
+        rows = np.floor((bbox[3] - lats) / (bbox[3] - bbox[1]) * height).astype(np.int64)
+        col_valid = np.nonzero((cols >= 0) & (cols < width))[0]
+        row_valid = np.nonzero((rows >= 0) & (rows < height))[0]
+        if not len(col_valid) or not len(row_valid):
+            continue
+
+        sampled = ndvi[np.ix_(rows[row_valid], cols[col_valid])]
+        target = tile[np.ix_(row_valid, col_valid)]
+        has_value = ~np.isnan(sampled)
+        target[has_value] = sampled[has_value]
+        tile[np.ix_(row_valid, col_valid)] = target
+        drawn = drawn or bool(has_value.any())
+
+    return colorize_ndvi(tile) if drawn else None
+
+
+def date_to_range(date_str):
+    """
+    タイルの日付（YYYYMMDD または YYYY-MM-DD）を農場画面と同じ5日間の日付範囲に変換します。
+    """
+    date_obj = datetime.strptime(date_str.replace('-', ''), '%Y%m%d')
+    return ((date_obj - timedelta(days=5)).strftime('%Y-%m-%d'), date_obj.strftime('%Y-%m-%d'))
+
+
+class TileCache:
+    """生成したタイルをディスクに保存し、有効期間とバイト数の上限で削除します。"""
+
+    def __init__(self, tile_dir=DEFAULT_TILE_DIR, ttl=TILE_TTL, max_bytes=256 * 1024 ** 2):
+        self.tile_dir = tile_dir
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._written_bytes = 0
+
+    def _path(self, layer_key, date_str, z, x, y):
+        return os.path.join(self.tile_dir, layer_key, date_str, str(z), str(x), f"{y}.png")
+
+    def get(self, layer_key, date_str, z, x, y):
+        path = self._path(layer_key, date_str, z, x, y)
+        try:
+            if time.time() - os.path.getmtime(path) > self.ttl:
+                return None
+            with open(path, 'rb') as f:
+                return f.read()
+        except OSError:
+            return None
+
+    def put(self, layer_key, date_str, z, x, y, data):
+        path = self._path(layer_key, date_str, z, x, y)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+        with self._lock:
+            self._written_bytes += len(data)
+            # 書き込み量が上限の1割を超えるごとにディレクトリを走査して削除する
+            if self._written_bytes > self.max_bytes // 10:
+                self._written_bytes = 0
+                self._evict()
+
+    def _evict(self):
+        now = time.time()
+        entries = []
+        for root, _, names in os.walk(self.tile_dir):
+            for name in names:
+                path = os.path.join(root, name)
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                if now - st.st_mtime > self.ttl:
+                    self._remove(path)
+                    continue
+                entries.append((st.st_mtime, st.st_size, path))
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            self._remove(path)
+            total -= size
+
+    @staticmethod
+    def _remove(path):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+
+tile_cache = TileCache(
+    tile_dir=os.getenv("NDVI_TILE_DIR", DEFAULT_TILE_DIR),
+    max_bytes=int(os.getenv("NDVI_TILE_CACHE_MB", "256")) * 1024 ** 2
+)
+
+
+def farms_layer_key(farms):
+    """
+    タイルの内容を決める農場の集合からキャッシュ用のキーを作成します。
+    """
+    payload = "|".join(
+        f"{farm['id']}:{farm.get('bbox')}" for farm in sorted(farms, key=lambda f: f['id'])
+    )
+    return hashlib.sha1(payload.encode('utf-8')).hexdigest()[:16]
+
+
+@lru_cache(maxsize=1)
+def empty_tile():
+    """農場が掛からないタイル用の透明なPNG画像を返します。"""
+    return encode_image(np.zeros((TILE_SIZE, TILE_SIZE, 4), dtype=np.uint8), "png")
+
+
+def get_ndvi_tile(date_str, z, x, y, farms):
+    """
+    NDVIタイルを取得します。保存済みのタイルがなければ生成して保存します。
+
+    パラメータ:
+    date_str (str): 日付（YYYYMMDD または YYYY-MM-DD）、または "latest"（農場ごとの最新の撮影日）。
+    z, x, y (int): タイル番号。
+    farms (list): 農場データのリスト [{id, coordinates, bbox, mask}, ...]
+
+    戻り値:
+    bytes or None: PNG画像。タイルに掛かる農場がない場合は None。
+    """
+    validate_tile(z, x, y)
+
+    date_range = None if date_str == LATEST else date_to_range(date_str)
+    bounds = tile_bounds(z, x, y)
+    visible = [farm for farm in farms if farm.get('bbox') and _intersects(bounds, farm['bbox'])]
+    if not visible:
+        return None
+
+    if date_range:
+        date_ranges = [date_range] * len(visible)
+        date_key = date_range[1]
+    else:
+        # 農場画面（get_farm_ndvi_image）と同じく、農場ごとに最新の撮影日までの期間のラスタを使う
+        date_ranges = [latest_acquisition_date_range(get_farm_bbox(farm['coordinates'])) for farm in visible]
+        date_key = f"{LATEST}-{hashlib.sha1(repr(date_ranges).encode('utf-8')).hexdigest()[:12]}"
+
+    layer_key = farms_layer_key(visible)
+    data = tile_cache.get(layer_key, date_key, z, x, y)
+    if data is not None:
+        return data
+
+    farm_layers = []
+    for farm, farm_date_range in zip(visible, date_ranges):
+        cached = get_cached_farm_ndvi(farm['coordinates'], farm_date_range, farm.get('mask'))
+        if cached is not None:
+            farm_layers.append(cached)
+
+    image = render_ndvi_tile(z, x, y, farm_layers)
+    if image is None:
+        return None
+    data = encode_image(image, "png")
+    tile_cache.put(layer_key, date_key, z, x, y, data)
+    return data
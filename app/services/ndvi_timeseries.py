@@ -0,0 +1,142 @@
+"""
+農場のNDVI時系列を取得し、履歴に保存するモジュール
+
+期間を観測ウィンドウに分割して並列に取得し、完了したものから順に履歴へ保存します。
+"""
+from datetime import datetime, timedelta
+
+from app.services.satellite_service import (
+    get_farm_bbox, create_bbox_and_size, calculate_ndvi_stats, create_index_evalscript,
+    process_index_data, iter_sentinel_images, INDEX_SAMPLE_TYPE, DOWNLOAD_MAX_WORKERS,
+    FARM_RESOLUTION, FARM_MAXCC, DEFAULT_MAX_CLOUD_COVER, date_catalog
+)
+from app.services import ndvi_history
+from app.services.farm_mask import get_farm_mask
+
+# Sentinel-2の再訪周期（日）
+REVISIT_DAYS = 5
+# 履歴への保存をまとめる件数
+HISTORY_FLUSH_SIZE = 8
+
+
+def split_date_range(start_date, end_date, window_days=REVISIT_DAYS):
+    """
+    期間を観測ウィンドウに分割します。
+
+    パラメータ:
+    start_date (str): 開始日（YYYY-MM-DD）。
+    end_date (str): 終了日（YYYY-MM-DD）。
+    window_days (int): 1ウィンドウの日数。
+
+    戻り値:
+    list: 日付範囲 (start_date, end_date) のリスト。
+    """
+    start = datetime.strptime(start_date, '%Y-%m-%d')
+    end = datetime.strptime(end_date, '%Y-%m-%d')
+    if start > end:
+        raise ValueError("開始日は終了日より前の日付を指定してください。")
+
+    windows = []
+    window_start = start
+    while window_start <= end:
+        window_end = min(window_start + timedelta(days=window_days - 1), end)
+        windows.append((window_start.strftime('%Y-%m-%d'), window_end.strftime('%Y-%m-%d')))
+        window_start = window_end + timedelta(days=1)
+    return windows
+
+
+def acquisition_date(date_range, acquisitions):
+    """
+    ウィンドウの画像の撮影日を返します。
+    画像は雲量の上限以下の撮影のうち最新のものを優先して合成されるため、ウィンドウ内の最新の撮影日を使います。
+
+    パラメータ:
+    date_range (tuple): ウィンドウの日付範囲 (start_date, end_date)
+    acquisitions (list): 撮影日カタログの撮影日（新しい順） [{'date': 'YYYY-MM-DD', ...}, ...]
+
+    戻り値:
+    str: 撮影日（YYYY-MM-DD）。カタログにウィンドウ内の撮影日がない場合はウィンドウの終了日。
+    """
+    start_date, end_date = date_range
+    for item in acquisitions:
+        if start_date <= item['date'] <= end_date:
+            return item['date']
+    return end_date
+
+
+def get_farm_ndvi_timeseries(farm, start_date, end_date, window_days=REVISIT_DAYS,
+                             max_workers=DOWNLOAD_MAX_WORKERS, store=True, on_result=None):
+    """
+    農場のNDVI時系列を取得します。
+
+    パラメータ:
+    farm (dict): 農場データ {id, coordinates, crop_type(任意)}
+    start_date (str): 開始日（YYYY-MM-DD）。
+    end_date (str): 終了日（YYYY-MM-DD）。
+    window_days (int): 1ウィンドウの日数。
+    max_workers (int): 同時に実行するダウンロード数の上限。
+    store (bool): 取得した統計をfarm_ndvi_historyに保存するかどうか（HISTORY_FLUSH_SIZE件ごとにまとめて保存）。
+    on_result (callable): ウィンドウごとの結果を受け取るコールバック（完了順に呼ばれます）。
+
+    戻り値:
+    list: 日付順の結果 [{'date': str, 'date_range': tuple, 'ndvi_stats': dict}, ...]
+          date は撮影日カタログによるウィンドウ内の撮影日です（acquisition_date を参照）。
+          有効なデータがなかったウィンドウは含まれません。
+    """
+    resolution = FARM_RESOLUTION
+    bbox = get_farm_bbox(farm['coordinates'])
+    aoi_bbox, aoi_size = create_bbox_and_size(bbox, resolution)
+    evalscript = create_index_evalscript(("ndvi",), INDEX_SAMPLE_TYPE)
+
+    windows = split_date_range(start_date, end_date, window_days)
+    acquisitions = date_catalog.get_acquisitions(bbox, DEFAULT_MAX_CLOUD_COVER)
+    jobs = [
+        {
+            'bbox': bbox,
+            'aoi_bbox': aoi_bbox,
+            'aoi_size': aoi_size,
+            'date_range': window,
+            'evalscript': evalscript,
+            'resolution': resolution,
+            'maxcc': FARM_MAXCC
+        }
+        for window in windows
+    ]
+
+    mask = None
+    results = []
+    pending = []
+    try:
+        for index, images in iter_sentinel_images(jobs, max_workers):
+            if isinstance(images, Exception) or not images:
+                continue
+            try:
+                ndvi = process_index_data(images, ("ndvi",), INDEX_SAMPLE_TYPE)['ndvi']
+            except ValueError:
+                # 雲や欠測で有効なデータがないウィンドウは飛ばす
+                continue
+            if mask is None:
+                mask = get_farm_mask(farm['coordinates'], bbox, ndvi.shape, farm.get('mask'))
+            ndvi_stats = calculate_ndvi_stats(ndvi, mask)
+            if 'mean' not in ndvi_stats:
+                continue
+
+            result = {
+                'date': acquisition_date(windows[index], acquisitions),
+                'date_range': windows[index],
+                'ndvi_stats': ndvi_stats
+            }
+            if store:
+                pending.append((farm['id'], result['date'], ndvi_stats, farm.get('crop_type')))
+                if len(pending) >= HISTORY_FLUSH_SIZE:
+                    ndvi_history.save_ndvi_records(pending)
+                    pending = []
+            if on_result:
+                on_result(result)
+            results.append(result)
+    finally:
+        # 途中で失敗しても取得済みの統計は保存する
+        if pending:
+            ndvi_history.save_ndvi_records(pending)
+
+    return sorted(results, key=lambda item: item['date'])
@@ -0,0 +1,175 @@
+"""
+チャットボットの質問を意図ごとに振り分けるモジュール
+
+キーワードから質問の意図（農作業カレンダー・NDVIの履歴・NDVI・天気・農場管理）を判定し、回答の経路を決めます。
+
+- template: 短く意図が1つの質問は、農作業カレンダー・NDVI_MAPPING・NDVIの履歴からテンプレートで回答します
+  （LLMも衛星データの取得も行わない。データが足りない場合は assisted として扱います）
+- assisted: 意図は分かるが説明や判断を求める質問は、意図に対応するツールを先に実行し、LLMを1回だけ呼びます
+- agent: 意図が分からない質問は、LLMがツールを選ぶエージェントで回答します
+
+経路ごとの応答時間は route_latency に集計します。
+"""
+import threading
+
+from app.services.farming_calendar import CROP_LABELS
+
+# 質問の補足（農場情報の付加）に使うキーワード
+NDVI_KEYWORDS = ['ndvi', '植生指数', '生育状況', '健康状態', '畑の状態', '作物の状態',
+                 '畑', '田んぼ', '農場', '作物', '生育', '肥料', '農薬', '栄養', '収穫']
+WEATHER_KEYWORDS = ['天気', '気象', '雨', '晴れ', '気温', '湿度', '予報']
+MANAGEMENT_KEYWORDS = ['管理', '施肥', '灌水', '病害虫', '除草', '間引き', '収穫時期']
+
+# 経路の判定に使う意図ごとのキーワード（判定の優先順）
+INTENT_KEYWORDS = {
+    "calendar": ['カレンダー', '農作業', '今月の作業', '来月の作業', '作業は', 'スケジュール', 'やること'],
+    "history": ['推移', '履歴', 'トレンド', '傾向', 'これまで', '過去'],
+    "ndvi": ['ndvi', '植生指数', '生育', '健康状態', '畑の状態', '田んぼの状態', '作物の状態', '農場の状態'],
+    "weather": WEATHER_KEYWORDS,
+    "management": MANAGEMENT_KEYWORDS,
+}
+# テンプレートで回答できる意図
+TEMPLATE_INTENTS = ("calendar", "history", "ndvi")
+# 理由や比較など、テンプレートでは答えられない質問の目印
+REASONING_KEYWORDS = ['なぜ', 'どうして', '理由', '原因', '比較', '比べ', '違い', 'どう思']
+# テンプレートで回答する質問の長さの上限（文字数）
+TEMPLATE_MAX_LENGTH = 40
+
+
+def is_ndvi_query(question):
+    """NDVIや農場の状態に関する質問かどうか"""
+    return any(keyword in question.lower() for keyword in NDVI_KEYWORDS)
+
+
+def detect_intents(question):
+    """
+    質問の意図を判定する
+
+    Parameters:
+    question (str): 質問
+
+    Returns:
+    list: 意図（calendar, history, ndvi, weather, management）のリスト
+    """
+    text = question.lower()
+    intents = [intent for intent, keywords in INTENT_KEYWORDS.items()
+               if any(keyword in text for keyword in keywords)]
+    # 履歴の質問はNDVIの質問を含む
+    if "history" in intents and "ndvi" in intents:
+        intents.remove("ndvi")
+    return intents
+
+
+def classify_question(question):
+    """
+    質問の回答経路を判定する
+
+    Parameters:
+    question (str): 質問
+
+    Returns:
+    tuple: (経路（template, assisted, agent）, 意図のリスト)
+    """
+    intents = detect_intents(question)
+    if not intents:
+        return "agent", intents
+    text = question.strip()
+    if (len(intents) == 1 and intents[0] in TEMPLATE_INTENTS and len(text) <= TEMPLATE_MAX_LENGTH
+            and not any(keyword in text for keyword in REASONING_KEYWORDS)):
+        return "template", intents
+    return "assisted", intents
+
+
+def render_calendar_answer(calendar, month):
+    """
+    農作業カレンダー（farming_calendar.get_calendarの戻り値）から回答を作成する
+
+    Parameters:
+    calendar (dict): 農作業カレンダーのデータ
+    month (int): 今月（1〜12）
+
+    Returns:
+    str: 回答
+    """
+    next_month = month + 1 if month < 12 else 1
+    crop = CROP_LABELS.get(calendar["crop_type"], calendar["crop_type"])
+    return (
+        f"{crop}（{calendar['region']}）の農作業カレンダーです。\n"
+        f"今月（{month}月）の作業: {'、'.join(calendar['current_tasks'])}\n"
+        f"来月（{next_month}月）の作業: {'、'.join(calendar['next_month_tasks'])}\n"
+        f"この時期のポイント: {calendar['crop_specific_tip']}"
+    )
+
+
+def render_ndvi_answer(ndvi_data):
+    """
+    NDVIデータ（get_farm_ndvi_dataツールの戻り値と同じ形式）から回答を作成する
+
+    Parameters:
+    ndvi_data (dict): NDVIデータと分析結果
+
+    Returns:
+    str: 回答
+    """
+    analysis = ndvi_data["analysis"]
+    lines = [
+        f"{ndvi_data['farm_name']}の{ndvi_data['date']}時点の平均NDVIは{ndvi_data['ndvi_stats']['mean']:.2f}で、"
+        f"健康状態は「{analysis['health_status']}」です。",
+        f"傾向: {analysis['trend']}",
+        "推奨事項:",
+    ]
+    lines += [f"・{recommendation}" for recommendation in analysis["recommendations"]]
+    if analysis.get("crop_specific_advice"):
+        lines.append(f"作物のアドバイス: {analysis['crop_specific_advice']}")
+    lines.append(f"季節のアドバイス: {analysis['seasonal_advice']}")
+    return "\n".join(lines)
+
+
+def render_history_answer(farm_name, history, trend):
+    """
+    NDVIの履歴から回答を作成する
+
+    Parameters:
+    farm_name (str): 農場名
+    history (list): [{'date', 'value'}, ...]（日付順）
+    trend (str): トレンドの説明（analyze_ndvi_trendの戻り値）
+
+    Returns:
+    str: 回答
+    """
+    lines = [f"{farm_name}の平均NDVIの推移（直近{len(history)}件）です。"]
+    lines += [f"・{item['date']}: {item['value']:.2f}" for item in history]
+    lines.append(f"傾向: {trend}")
+    return "\n".join(lines)
+
+
+class RouteLatency:
+    """回答経路ごとの応答時間の集計"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._stats = {}  # route -> [count, total_seconds, max_seconds]
+
+    def record(self, route, seconds):
+        """経路の応答時間（秒）を記録する"""
+        with self._lock:
+            stats = self._stats.setdefault(route, [0, 0.0, 0.0])
+            stats[0] += 1
+            stats[1] += seconds
+            stats[2] = max(stats[2], seconds)
+
+    def stats(self):
+        """
+        経路ごとの統計を返す
+
+        Returns:
+        dict: {経路: {'count', 'mean_ms', 'max_ms'}}
+        """
+        with self._lock:
+            return {
+                route: {'count': count, 'mean_ms': total / count * 1000, 'max_ms': longest * 1000}
+                for route, (count, total, longest) in self._stats.items()
+            }
+
+
+route_latency = RouteLatency()
@@ -0,0 +1,217 @@
+"""
+Sentinel Hubから取得したラスタデータの2層キャッシュモジュール
+
+1層目はメモリ上のLRUキャッシュ、2層目はディスク上の.npyファイル（メモリマップで読み込み）です。
+どちらの層もバイト数の上限を超えると古いものから削除されます。
+"""
+import os
+import json
+import time
+import hashlib
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+DEFAULT_CACHE_DIR = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.dirname(__file__))), 'instance', 'raster_cache'
+)
+
+
+class RasterCache:
+    """
+    (bbox, time_interval, evalscript, resolution, maxcc) をキーとするラスタキャッシュ。
+
+    値はSentinelHubRequest.get_data()が返す画像のリストで、ディスク上では
+    1つのバンドスタック（np.stack済みの配列）として保存されます。
+    """
+
+    def __init__(self, cache_dir=DEFAULT_CACHE_DIR, memory_max_bytes=256 * 1024 ** 2,
+                 disk_max_bytes=2 * 1024 ** 3):
+        self.cache_dir = cache_dir
+        self.memory_max_bytes = memory_max_bytes
+        self.disk_max_bytes = disk_max_bytes
+        self._memory = OrderedDict()  # key -> (images, nbytes, expires_at)
+        self._memory_bytes = 0
+        self._lock = threading.Lock()
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def make_key(bbox, time_interval, evalscript, resolution, maxcc):
+        """
+        キャッシュキーを作成します。
+
+        パラメータ:
+        bbox (tuple): WGS84形式の座標 (min_lon, min_lat, max_lon, max_lat)。
+        time_interval (tuple): 日付範囲 (start_date, end_date)。
+        evalscript (str): 使用するevalscript。
+        resolution (int): メートル単位の解像度。
+        maxcc (float): クラウドカバー率の最大値。
+
+        戻り値:
+        str: キャッシュキー（SHA-1の16進文字列）。
+        """
+        payload = json.dumps(
+            [[round(float(v), 7) for v in bbox], list(time_interval), evalscript, resolution, maxcc]
+        )
+        return hashlib.sha1(payload.encode('utf-8')).hexdigest()
+
+    def get(self, key):
+        """
+        キャッシュから画像リストを取得します。メモリ、ディスクの順に探します。
+
+        パラメータ:
+        key (str): make_keyで作成したキー。
+
+        戻り値:
+        list or None: 画像のリスト。キャッシュにない場合は None。
+        """
+        now = time.time()
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry is not None:
+                images, nbytes, expires_at = entry
+                if expires_at is None or expires_at > now:
+                    self._memory.move_to_end(key)
+                    self.memory_hits += 1
+                    return images
+                self._drop_memory(key)
+
+        images, expires_at = self._load_from_disk(key, now)
+        with self._lock:
+            if images is None:
+                self.misses += 1
+                return None
+            self.disk_hits += 1
+            self._store_memory(key, images, expires_at)
+        return images
+
+    def put(self, key, images, ttl=None):
+        """
+        画像リストをキャッシュに保存します。
+
+        パラメータ:
+        key (str): make_keyで作成したキー。
+        images (list): SentinelHubRequest.get_data()が返した画像のリスト。
+        ttl (float): 有効期間（秒）。Noneの場合は無期限。
+        """
+        if not images:
+            return
+        expires_at = time.time() + ttl if ttl else None
+        stack = np.stack(images)
+        self._save_to_disk(key, stack, expires_at)
+        with self._lock:
+            self._store_memory(key, list(stack), expires_at)
+
+    def stats(self):
+        """
+        キャッシュの統計情報を返します。
+
+        戻り値:
+        dict: ヒット数、ミス数、ヒット率、各層の使用バイト数。
+        """
+        with self._lock:
+            lookups = self.memory_hits + self.disk_hits + self.misses
+            return {
+                'memory_hits': self.memory_hits,
+                'disk_hits': self.disk_hits,
+                'misses': self.misses,
+                'hit_rate': (self.memory_hits + self.disk_hits) / lookups if lookups else 0.0,
+                'memory_entries': len(self._memory),
+                'memory_bytes': self._memory_bytes,
+                'disk_bytes': self._disk_usage()[0],
+            }
+
+    def clear(self):
+        """メモリとディスクのキャッシュをすべて削除します。"""
+        with self._lock:
+            self._memory.clear()
+            self._memory_bytes = 0
+            for _, _, path in self._disk_usage()[1]:
+                self._remove_disk_entry(path[:-len('.npy')])
+
+    # --- メモリ層 ---
+
+    def _store_memory(self, key, images, expires_at):
+        nbytes = sum(image.nbytes for image in images)
+        if nbytes > self.memory_max_bytes:
+            return
+        if key in self._memory:
+            self._drop_memory(key)
+        self._memory[key] = (images, nbytes, expires_at)
+        self._memory_bytes += nbytes
+        while self._memory_bytes > self.memory_max_bytes:
+            oldest_key = next(iter(self._memory))
+            self._drop_memory(oldest_key)
+
+    def _drop_memory(self, key):
+        _, nbytes, _ = self._memory.pop(key)
+        self._memory_bytes -= nbytes
+
+    # --- ディスク層 ---
+
+    def _entry_path(self, key):
+        return os.path.join(self.cache_dir, key)
+
+    def _load_from_disk(self, key, now):
+        base = self._entry_path(key)
+        try:
+            with open(base + '.json', 'r') as f:
+                meta = json.load(f)
+            expires_at = meta.get('expires_at')
+            if expires_at is not None and expires_at <= now:
+                self._remove_disk_entry(base)
+                return None, None
+            stack = np.load(base + '.npy', mmap_mode='r')
+            os.utime(base + '.npy')  # LRU判定用に最終アクセス時刻を更新
+        except (OSError, ValueError):
+            return None, None
+        return list(stack), expires_at
+
+    def _save_to_disk(self, key, stack, expires_at):
+        if stack.nbytes > self.disk_max_bytes:
+            return
+        os.makedirs(self.cache_dir, exist_ok=True)
+        base = self._entry_path(key)
+        tmp_path = f"{base}.{os.getpid()}.{threading.get_ident()}.tmp"
+        # 書き込み途中のファイルを読まないよう、一時ファイルに書いてから置き換える
+        with open(tmp_path, 'wb') as f:
+            np.save(f, stack)
+        os.replace(tmp_path, base + '.npy')
+        with open(base + '.json', 'w') as f:
+            json.dump({'expires_at': expires_at, 'shape': list(stack.shape), 'dtype': str(stack.dtype)}, f)
+        self._evict_disk()
+
+    def _disk_usage(self):
+        """ディスク層の合計バイト数と (mtime, size, path) のリストを返します。"""
+        if not os.path.isdir(self.cache_dir):
+            return 0, []
+        entries = []
+        for name in os.listdir(self.cache_dir):
+            if not name.endswith('.npy'):
+                continue
+            path = os.path.join(self.cache_dir, name)
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            entries.append((st.st_mtime, st.st_size, path))
+        return sum(size for _, size, _ in entries), entries
+
+    def _evict_disk(self):
+        total, entries = self._disk_usage()
+        for _, size, path in sorted(entries):
+            if total <= self.disk_max_bytes:
+                break
+            self._remove_disk_entry(path[:-len('.npy')])
+            total -= size
+
+    @staticmethod
+    def _remove_disk_entry(base):
+        for suffix in ('.npy', '.json'):
+            try:
+                os.remove(base + suffix)
+            except OSError:
+                pass
@@ -0,0 +1,164 @@
+"""
+チャットボットの回答キャッシュモジュール
+
+キーは (正規化した質問, 農場ID, 農場の状態, 日付) です。農場の状態はNDVIの区分・健康状態・最新の撮影日・
+天気の区分からなるため、新しい撮影でNDVIが変わった場合や天気が変わった場合は別のキーになり、
+古い回答は使われません（古いエントリはTTLとLRUで削除されます）。
+
+similarity_threshold を指定すると、完全一致しない場合に同じ農場の状態の中から
+埋め込みのコサイン類似度が閾値以上の質問（言い回しだけが違う質問）の回答も返します。
+"""
+import os
+import time
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+from app.services.embedding_cache import normalize_text
+
+
+class ResponseCache:
+    """農場の状態をキーに含む回答のLRUキャッシュ（TTL付き）"""
+
+    def __init__(self, max_entries=1024, ttl=6 * 3600, similarity_threshold=None):
+        """
+        パラメータ:
+        max_entries (int): 保持する回答数の上限。
+        ttl (float): 回答の有効期間（秒）。
+        similarity_threshold (float): 類似質問の検索に使うコサイン類似度の閾値。Noneの場合は完全一致のみ。
+        """
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.similarity_threshold = similarity_threshold
+        self._entries = OrderedDict()  # key -> (answer, expires_at, question_vector)
+        self._by_context = {}  # (農場ID, 農場の状態, 日付) -> set(key)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.similar_hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def make_key(question, farm_id, farm_state, date):
+        """
+        キャッシュキーを作成します。
+
+        パラメータ:
+        question (str): 質問。
+        farm_id (int): 農場ID。
+        farm_state (tuple): NDVIの区分・健康状態・撮影日・天気の区分など、回答が依存する農場の状態。
+        date (str): 日付（YYYY-MM-DD）。
+
+        戻り値:
+        tuple: キャッシュキー。
+        """
+        return (normalize_text(question).lower(), str(farm_id) if farm_id else None, tuple(farm_state), date)
+
+    def get(self, key, question_vector=None):
+        """
+        回答を取得します。
+
+        パラメータ:
+        key (tuple): make_keyで作成したキー。
+        question_vector (list): 質問の埋め込み。指定した場合は類似質問の回答も探します。
+
+        戻り値:
+        str or None: 回答。キャッシュにない場合は None。
+        """
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[1] > now:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[0]
+            if entry is not None:
+                self._drop(key)
+
+            if question_vector is not None and self.similarity_threshold is not None:
+                similar_key = self._find_similar(key[1:], question_vector, now)
+                if similar_key is not None:
+                    self._entries.move_to_end(similar_key)
+                    self.similar_hits += 1
+                    return self._entries[similar_key][0]
+
+            self.misses += 1
+            return None
+
+    def put(self, key, answer, question_vector=None):
+        """
+        回答を保存します。
+
+        パラメータ:
+        key (tuple): make_keyで作成したキー。
+        answer (str): 回答。
+        question_vector (list): 質問の埋め込み（類似質問の検索用）。
+        """
+        vector = None
+        if question_vector is not None:
+            vector = np.asarray(question_vector, dtype=np.float32)
+            vector = vector / (np.linalg.norm(vector) or 1)
+        with self._lock:
+            if key in self._entries:
+                self._drop(key)
+            self._entries[key] = (answer, time.time() + self.ttl, vector)
+            self._by_context.setdefault(key[1:], set()).add(key)
+            while len(self._entries) > self.max_entries:
+                self._drop(next(iter(self._entries)))
+
+    def invalidate_farm(self, farm_id):
+        """農場の回答をすべて削除します。"""
+        farm_id = str(farm_id)
+        with self._lock:
+            for key in [key for key in self._entries if key[1] == farm_id]:
+                self._drop(key)
+
+    def stats(self):
+        """
+        キャッシュの統計情報を返します。
+
+        戻り値:
+        dict: ヒット数（うち類似質問）、ミス数、ヒット率、件数。
+        """
+        with self._lock:
+            hits = self.hits + self.similar_hits
+            lookups = hits + self.misses
+            return {
+                'hits': self.hits,
+                'similar_hits': self.similar_hits,
+                'misses': self.misses,
+                'hit_rate': hits / lookups if lookups else 0.0,
+                'entries': len(self._entries),
+            }
+
+    def _find_similar(self, context, question_vector, now):
+        query = np.asarray(question_vector, dtype=np.float32)
+        query = query / (np.linalg.norm(query) or 1)
+        best_key, best_score = None, self.similarity_threshold
+        for key in list(self._by_context.get(context, ())):
+            answer, expires_at, vector = self._entries[key]
+            if expires_at <= now:
+                self._drop(key)
+                continue
+            if vector is None:
+                continue
+            score = float(vector @ query)
+            if score >= best_score:
+                best_key, best_score = key, score
+        return best_key
+
+    def _drop(self, key):
+        self._entries.pop(key)
+        keys = self._by_context.get(key[1:])
+        if keys is not None:
+            keys.discard(key)
+            if not keys:
+                del self._by_context[key[1:]]
+
+
+_similarity = os.getenv("RESPONSE_CACHE_SIMILARITY")
+response_cache = ResponseCache(
+    max_entries=int(os.getenv("RESPONSE_CACHE_SIZE", 1024)),
+    ttl=float(os.getenv("RESPONSE_CACHE_TTL", 6 * 3600)),
+    similarity_threshold=float(_similarity) if _similarity else None
+)
@@ -1,105 +1,90 @@
 import os
 import json
 from datetime import datetime, timedelta
+from functools import lru_cache
 from flask import current_app
-import random
 import cv2
 import numpy as np
 import matplotlib.pyplot as plt
 from skimage import exposure
 import scipy.ndimage
 import pandas as pd
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from sentinelhub import SHConfig, BBox, CRS, bbox_to_dimensions, SentinelHubRequest, DataCollection, MimeType
 from dotenv import load_dotenv
+from app.services.raster_cache import RasterCache, DEFAULT_CACHE_DIR
+from app.services.farm_mask import get_farm_mask
+from app.services.ndvi_render import render_ndvi_images
+from app.services.ndvi_mapping import classify_ndvi_pixels
+from app.services.ndvi_grid import (
+    JAPAN_BOUNDS, GRID_SIZE, get_base_ndvi_grid, get_ndvi_grid_for_date, grid_to_points, get_encoded_grid
+)
+from app.services.date_catalog import DateCatalog, DEFAULT_DB_PATH as DEFAULT_CATALOG_DB_PATH
 
 # Load environment variables from .env file
 load_dotenv()
 
 # 暫定的な実装 - 後で実際の衛星データ処理に置き換え
-def get_latest_ndvi_data():
-    """最新のNDVIデータを取得する暫定実装"""
-    # 日本全体をカバーする範囲を定義
-    japan_bounds = {
-        "north": 45.8,  # 北海道の北端
-        "south": 24.0,  # 沖縄の南端
-        "east": 146.0,  # 小笠原諸島の東端
-        "west": 122.0   # 与那国島の西端
-    }
-    
-    # 暫定的なNDVIデータを生成
-    grid_size = 50
-    lat_step = (japan_bounds["north"] - japan_bounds["south"]) / grid_size
-    lng_step = (japan_bounds["east"] - japan_bounds["west"]) / grid_size
-    
-    ndvi_data = []
-    for i in range(grid_size):
-        for j in range(grid_size):
-            lat = japan_bounds["south"] + i * lat_step
-            lng = japan_bounds["west"] + j * lng_step
-            
-            # 日本の陸地っぽい場所だけにデータを生成（簡易的な判定）
-            if is_likely_land(lat, lng):
-                # 0.0 から 1.0 の範囲でランダムなNDVI値を生成
-                ndvi_value = random.uniform(0.0, 1.0)
-                ndvi_data.append({
-                    "lat": lat,
-                    "lng": lng,
-                    "ndvi": ndvi_value
-                })
-    
+def get_latest_ndvi_data(grid_size=GRID_SIZE):
+    """最新のNDVIデータを取得する暫定実装（日付ごとに決定的で、結果はメモ化されます）"""
+    latest_date = get_available_dates()[0]
     return {
-        "date": get_available_dates()[0],
-        "data": ndvi_data
+        "date": latest_date,
+        "data": grid_to_points(get_base_ndvi_grid(latest_date, grid_size), grid_size)
     }
 
-def get_ndvi_data_by_date(date_str):
+def get_ndvi_data_by_date(date_str, grid_size=GRID_SIZE):
     """指定された日付のNDVIデータを取得する暫定実装"""
-    # 基本データを取得して日付だけ変更
-    data = get_latest_ndvi_data()
-    data["date"] = date_str
-    
-    # 日付が古いほど値を少し変える（ランダム変動を加える）
-    latest_date = datetime.strptime(get_available_dates()[0], "%Y%m%d")
-    target_date = datetime.strptime(date_str, "%Y%m%d")
-    days_diff = (latest_date - target_date).days
-    
-    # 日付の差に応じてデータを少し変化させる
-    for point in data["data"]:
-        # 最大10%の変動を加える（古いほど変動大）
-        variation = random.uniform(-0.1, 0.1) * (days_diff / 30)
-        point["ndvi"] = max(0.0, min(1.0, point["ndvi"] + variation))
-    
-    return data
+    # 最新日のグリッドを基準に、日付が古いほど大きな変動を加える
+    latest_date = get_available_dates()[0]
+    values = get_ndvi_grid_for_date(date_str, latest_date, grid_size)
+    return {
+        "date": date_str,
+        "data": grid_to_points(values, grid_size)
+    }
 
-def get_available_dates():
-    """利用可能な衛星画像の日付リストを取得する暫定実装"""
-    # 現在から過去30日間で、5日ごとにデータがあると仮定
-    today = datetime.now()
-    dates = []
-    
-    for i in range(0, 31, 5):
-        date = today - timedelta(days=i)
-        dates.append(date.strftime("%Y%m%d"))
-    
-    return dates
-
-def is_likely_land(lat, lng):
-    """簡易的な日本の陸地判定（実際の実装では地理データを使用）"""
-    # 非常に簡易的な判定ロジック
-    # 北海道
-    if 41.0 <= lat <= 45.8 and 140.0 <= lng <= 146.0:
-        return random.random() < 0.6
-    # 本州
-    elif 33.0 <= lat <= 41.0 and 130.0 <= lng <= 142.0:
-        return random.random() < 0.7
-    # 四国・九州
-    elif 30.0 <= lat <= 34.5 and 129.0 <= lng <= 135.0:
-        return random.random() < 0.6
-    # 沖縄
-    elif 24.0 <= lat <= 27.0 and 122.0 <= lng <= 129.0:
-        return random.random() < 0.3
+def get_encoded_ndvi_grid(date_str=None, grid_size=GRID_SIZE, dtype="float32"):
+    """
+    NDVIグリッドをバイナリ形式（ndvi_grid.encode_grid）で取得する暫定実装
+
+    パラメータ:
+    date_str (str): 日付（YYYYMMDD）。省略時は最新日。
+    grid_size (int): グリッドの一辺のセル数。
+    dtype (str): 値の型（float32 または uint8）。
+
+    戻り値:
+    tuple: (日付, エンコードされたグリッド, gzip圧縮したもの)
+    """
+    latest_date = get_available_dates()[0]
+    date_str = date_str or latest_date
+    data, compressed = get_encoded_grid(date_str, latest_date, grid_size, dtype)
+    return date_str, data, compressed
+
+def get_available_dates(bbox=None, max_cloud_cover=None):
+    """
+    利用可能な衛星画像の日付リストを新しい順に取得します。
+    撮影日カタログ（メモリ・SQLite）から返すため、Sentinel Hubへの問い合わせは初回とTTL切れの更新時だけです。
+
+    パラメータ:
+    bbox (tuple): WGS84形式の座標 (min_lon, min_lat, max_lon, max_lat)。省略時は日本全体。
+    max_cloud_cover (float): 雲量（%）の上限。
+
+    戻り値:
+    list: 日付（YYYYMMDD）のリスト
+    """
+    if bbox is None:
+        # 日本全体は件数が多いため、初回もバックグラウンドで取得し、それまでは暫定の日付を返す
+        bbox = (JAPAN_BOUNDS["west"], JAPAN_BOUNDS["south"], JAPAN_BOUNDS["east"], JAPAN_BOUNDS["north"])
+        dates = date_catalog.get_dates(bbox, max_cloud_cover, block=False)
     else:
-        return random.random() < 0.1  # 海の部分はほとんどデータなし
+        dates = date_catalog.get_dates(bbox, max_cloud_cover)
+    return dates or list(_fallback_dates(datetime.now().strftime("%Y%m%d")))
+
+@lru_cache(maxsize=1)
+def _fallback_dates(today_str):
+    """カタログを利用できない場合の暫定の日付リスト（過去30日間で5日ごと）"""
+    today = datetime.strptime(today_str, "%Y%m%d")
+    return tuple((today - timedelta(days=i)).strftime("%Y%m%d") for i in range(0, 31, 5))
 
 # Sentinel Hubのアクセス情報を設定
 config = SHConfig()
@@ -109,6 +94,54 @@ config.sh_token_url = "https://identity.dataspace.copernicus.eu/auth/realms/CDSE
 config.sh_base_url = "https://sh.dataspace.copernicus.eu"
 config.save("cdse")
 
+# 範囲ごとの実際の撮影日と雲量のカタログ
+date_catalog = DateCatalog(config, db_path=os.getenv("DATE_CATALOG_DB", DEFAULT_CATALOG_DB_PATH))
+# 農場の既定の期間を選ぶときに使う雲量（%）の上限（fetch_sentinel_imagesのmaxccと同じ）
+DEFAULT_MAX_CLOUD_COVER = 50
+
+# 農場のNDVIを取得する解像度（メートル）と雲量の上限（0〜1）。
+# ラスタのキャッシュキーに含まれるため、取得とキャッシュの参照（タイルなど）で必ずこの値を使う
+FARM_RESOLUTION = 10
+FARM_MAXCC = DEFAULT_MAX_CLOUD_COVER / 100
+
+# 取得済みラスタのキャッシュ（同じ農場・期間の再取得でProcessing Unitを消費しないため）
+raster_cache = RasterCache(
+    cache_dir=os.getenv("RASTER_CACHE_DIR", DEFAULT_CACHE_DIR),
+    memory_max_bytes=int(os.getenv("RASTER_CACHE_MEMORY_MB", "256")) * 1024 ** 2,
+    disk_max_bytes=int(os.getenv("RASTER_CACHE_DISK_MB", "2048")) * 1024 ** 2
+)
+
+# この日数より新しい期間は新しい観測が追加される可能性があるため、短時間だけキャッシュする
+RECENT_WINDOW_DAYS = 7
+RECENT_WINDOW_TTL = 3600
+
+# evalscriptのモード（"index": 指数をSentinel Hub側で計算, "bands": 生バンドを取得してローカルで計算）
+EVALSCRIPT_MODE = os.getenv("SATELLITE_EVALSCRIPT_MODE", "index")
+# indexモードの出力形式（FLOAT32, UINT16, UINT8）
+# 取得したNDVIは統計・履歴・トレンドの検定にも使うため、既定は UINT16（約0.00003刻み）とする。
+# UINT8 は転送量が半分になるが、NDVIが約0.008刻みに量子化される
+INDEX_SAMPLE_TYPE = os.getenv("SATELLITE_INDEX_SAMPLE_TYPE", "UINT16")
+
+# bandsモードでローカル計算できる指数と、1ブロックあたりの行数
+BAND_INDICES = ("ndvi", "evi", "fapar", "allplus")
+INDEX_BLOCK_ROWS = 256
+
+# 並列ダウンロード数の上限（Sentinel Hubのレート制限を超えないようにする）
+DOWNLOAD_MAX_WORKERS = int(os.getenv("SATELLITE_DOWNLOAD_MAX_WORKERS", "4"))
+
+# 量子化時のスケール（-1〜1の指数値を 0〜最大値 に割り当てる）
+INDEX_QUANTIZATION_SCALE = {
+    "UINT8": 127.5,
+    "UINT16": 32767.5
+}
+
+# Sentinel Hub側で計算する指数の式（サンプルは反射率）
+INDEX_FORMULAS = {
+    "ndvi": "(s.B08 - s.B04) / (s.B08 + s.B04 + 1e-10)",
+    "evi": "2.5 * (s.B08 - s.B04) / (s.B08 + 6.0 * s.B04 - 7.5 * s.B02 + 1.0 + 1e-10)",
+    "fapar": "Math.min(Math.max(1.24 * (s.B08 - s.B04) / (s.B08 + s.B04 + 1e-10) - 0.168, 0), 1)"
+}
+
 def create_bbox_and_size(coords, resolution):
     """
     バウンディングボックスを作成し、その寸法を計算します。
@@ -159,6 +192,58 @@ def create_evalscript():
     }
     """
 
+def create_index_evalscript(indices=("ndvi",), sample_type="FLOAT32", include_rgb=False):
+    """
+    指数をSentinel Hub側で計算するevalscriptを作成します。
+
+    出力バンドは 指定した指数 → (RGB) → dataMask の順です。
+    UINT8/UINT16の場合、指数は -1〜1 を 0〜最大値 に量子化して返されます。
+
+    パラメータ:
+    indices (tuple): 計算する指数（ndvi, evi, fapar）。
+    sample_type (str): 出力形式（FLOAT32, UINT16, UINT8）。
+    include_rgb (bool): 可視化用のRGBバンド（0〜255）を含めるかどうか。
+
+    戻り値:
+    str: evalscript。
+    """
+    unknown = [name for name in indices if name not in INDEX_FORMULAS]
+    if unknown:
+        raise ValueError(f"未対応の指数です: {', '.join(unknown)}")
+    if sample_type != "FLOAT32" and sample_type not in INDEX_QUANTIZATION_SCALE:
+        raise ValueError(f"未対応の出力形式です: {sample_type}")
+
+    if sample_type == "FLOAT32":
+        encode = "v"
+    else:
+        scale = INDEX_QUANTIZATION_SCALE[sample_type]
+        encode = f"Math.round((Math.min(Math.max(v, -1), 1) + 1) * {scale})"
+
+    values = [INDEX_FORMULAS[name] for name in indices]
+    rgb = "Math.min(255, s.B04 * 255), Math.min(255, s.B03 * 255), Math.min(255, s.B02 * 255), " if include_rgb else ""
+    band_count = len(indices) + (3 if include_rgb else 0) + 1
+
+    return f"""
+    //VERSION=3
+    function setup() {{
+        return {{
+            input: [{{
+                bands: ["B08", "B04", "B03", "B02", "dataMask"]
+            }}],
+            output: {{
+                bands: {band_count},
+                sampleType: "{sample_type}"
+            }}
+        }};
+    }}
+    function encode(v) {{
+        return {encode};
+    }}
+    function evaluatePixel(s) {{
+        return [{", ".join(f"encode({value})" for value in values)}, {rgb}s.dataMask];
+    }}
+    """
+
 def create_sentinel_request(aoi_bbox, aoi_size, config):
     """
     EVIデータ用のSentinelHubRequestを作成します。
@@ -189,6 +274,90 @@ def create_sentinel_request(aoi_bbox, aoi_size, config):
         size=aoi_size,
         config=config
     )
+def build_sentinel_request(aoi_bbox, aoi_size, date_range, evalscript, maxcc=0.5):
+    """
+    Sentinel-2 L2A用のSentinelHubRequestを作成します。
+
+    パラメータ:
+    aoi_bbox (BBox): 関心領域のバウンディングボックス。
+    aoi_size (tuple): バウンディングボックスの寸法。
+    date_range (tuple): 日付範囲 (start_date, end_date)。
+    evalscript (str): 使用するevalscript。
+    maxcc (float): クラウドカバー率の最大値。
+
+    戻り値:
+    SentinelHubRequest: Sentinel Hub用に設定されたリクエスト。
+    """
+    return SentinelHubRequest(
+        evalscript=evalscript,
+        input_data=[
+            SentinelHubRequest.input_data(
+                data_collection=DataCollection.SENTINEL2_L2A.define_from(
+                    name="s2",
+                    service_url="https://sh.dataspace.copernicus.eu"
+                ),
+                time_interval=date_range,
+                maxcc=maxcc  # クラウドカバー率の最大値
+            )
+        ],
+        responses=[SentinelHubRequest.output_response("default", MimeType.TIFF)],
+        bbox=aoi_bbox,
+        size=aoi_size,
+        config=config
+    )
+
+def fetch_sentinel_images(bbox, aoi_bbox, aoi_size, date_range, evalscript, resolution, maxcc=0.5):
+    """
+    Sentinel Hubから画像を取得します。取得結果はraster_cacheにキャッシュされます。
+
+    パラメータ:
+    bbox (tuple): WGS84形式の座標 (min_lon, min_lat, max_lon, max_lat)。キャッシュキーに使用。
+    aoi_bbox (BBox): 関心領域のバウンディングボックス。
+    aoi_size (tuple): バウンディングボックスの寸法。
+    date_range (tuple): 日付範囲 (start_date, end_date)。
+    evalscript (str): 使用するevalscript。
+    resolution (int): メートル単位の解像度。
+    maxcc (float): クラウドカバー率の最大値。
+
+    戻り値:
+    list: SentinelHubRequest.get_data()が返す画像のリスト。
+    """
+    cache_key = RasterCache.make_key(bbox, date_range, evalscript, resolution, maxcc)
+    images = raster_cache.get(cache_key)
+    if images is not None:
+        return images
+
+    request = build_sentinel_request(aoi_bbox, aoi_size, date_range, evalscript, maxcc)
+    images = request.get_data()
+
+    # 直近の期間は後から観測が追加されるため有効期限を付ける
+    end_date = datetime.strptime(date_range[1][:10], '%Y-%m-%d')
+    is_recent = end_date >= datetime.now() - timedelta(days=RECENT_WINDOW_DAYS)
+    raster_cache.put(cache_key, images, ttl=RECENT_WINDOW_TTL if is_recent else None)
+    return images
+
+def iter_sentinel_images(jobs, max_workers=DOWNLOAD_MAX_WORKERS):
+    """
+    複数の取得ジョブを並列に実行し、完了した順に結果を返します。
+
+    パラメータ:
+    jobs (list): fetch_sentinel_imagesの引数を持つ辞書のリスト
+                 {bbox, aoi_bbox, aoi_size, date_range, evalscript, resolution, maxcc(任意)}。
+    max_workers (int): 同時に実行するダウンロード数の上限。
+
+    戻り値:
+    generator: (ジョブのインデックス, 画像のリスト または 例外) のタプル。
+    """
+    if not jobs:
+        return
+    with ThreadPoolExecutor(max_workers=min(max_workers, len(jobs))) as executor:
+        futures = {executor.submit(fetch_sentinel_images, **job): i for i, job in enumerate(jobs)}
+        for future in as_completed(futures):
+            try:
+                yield futures[future], future.result()
+            except Exception as e:
+                yield futures[future], e
+
 def is_black_image(image, threshold=10):
     """
     画像データが黒画像かどうかを判定します。
@@ -203,6 +372,93 @@ def is_black_image(image, threshold=10):
     max_pixel_value = np.max(image)
     return max_pixel_value <= threshold
 
+def _first_valid_image(evi_images):
+    """返された画像リストの先頭を検証して返します。"""
+    if not evi_images:
+        raise ValueError("データが返されませんでした。日付範囲またはバウンディングボックスの設定を確認してください。")
+
+    image = evi_images[0]
+    # 黒画像チェックを追加
+    if is_black_image(image):
+        raise ValueError("黒画像が返されました。指定された条件では有効なデータがありません。")
+    return image
+
+def _index_block(nir, red, blue, indices):
+    """
+    1ブロック分の指数を計算します。nir, red, blueはfloat32の一時配列で、上書きされることがあります。
+    """
+    layers = {}
+    if "ndvi" in indices or "fapar" in indices or "allplus" in indices:
+        ndvi = nir - red
+        denom = nir + red
+        denom += 1e-10
+        ndvi /= denom
+        layers["ndvi"] = ndvi
+
+    if "evi" in indices or "allplus" in indices:
+        # G * (nir - red) * s / ((nir + C1 * red - C2 * blue) * s + L)  (s = 1 / scale_factor)
+        G, C1, C2, L = 2.5, 6.0, 7.5, 1.0
+        scale = np.float32(1.0 / 10000.0)
+        denom = red * np.float32(C1)
+        denom += nir
+        blue *= np.float32(C2)
+        denom -= blue
+        denom *= scale
+        denom += np.float32(L + 1e-10)
+        evi = nir - red
+        evi *= np.float32(G) * scale
+        evi /= denom
+        layers["evi"] = evi
+
+    if "fapar" in indices or "allplus" in indices:
+        fapar = layers["ndvi"] * np.float32(1.24)
+        fapar -= np.float32(0.168)
+        np.clip(fapar, 0, 1, out=fapar)
+        layers["fapar"] = fapar
+
+    if "allplus" in indices:
+        allplus = layers["evi"] * np.float32(40)
+        allplus += layers["fapar"]
+        allplus += layers["ndvi"]
+        layers["allplus"] = allplus
+
+    return layers
+
+def compute_indices(image, indices=("ndvi",), block_rows=INDEX_BLOCK_ROWS):
+    """
+    生バンド画像（NIR, Red, Green, Blue）から指定された指数だけをfloat32で計算します。
+
+    画像を行方向のブロックに分けて計算するため、一時配列は1ブロック分しか確保しません。
+
+    パラメータ:
+    image (ndarray): create_evalscriptで取得した画像 (高さ, 幅, 4)。
+    indices (tuple): 計算する指数（ndvi, evi, fapar, allplus）。
+    block_rows (int): 1ブロックの行数。
+
+    戻り値:
+    tuple: 指数名をキーとするfloat32配列の辞書と、計算中の最大確保バイト数の見積もり。
+    """
+    unknown = [name for name in indices if name not in BAND_INDICES]
+    if unknown:
+        raise ValueError(f"未対応の指数です: {', '.join(unknown)}")
+
+    height, width = image.shape[:2]
+    layers = {name: np.empty((height, width), dtype=np.float32) for name in indices}
+
+    block_peak = 0
+    for row in range(0, height, block_rows):
+        rows = slice(row, min(row + block_rows, height))
+        nir = image[rows, :, 0].astype(np.float32)
+        red = image[rows, :, 1].astype(np.float32)
+        blue = image[rows, :, 3].astype(np.float32)
+        block_layers = _index_block(nir, red, blue, indices)
+        for name in indices:
+            layers[name][rows] = block_layers[name]
+        block_peak = max(block_peak, nir.nbytes * (3 + 2 * len(block_layers)))
+
+    output_bytes = sum(layer.nbytes for layer in layers.values())
+    return layers, output_bytes + block_peak
+
 def process_image_data(evi_images):
     """
     画像データを処理してNDVI、EVI、FAPAR、Allplusを計算します。
@@ -213,31 +469,47 @@ def process_image_data(evi_images):
     戻り値:
     tuple: 処理されたNDVI、EVI、FAPAR、Allplus、およびRGB画像。
     """
-    if not evi_images:
-        raise ValueError("データが返されませんでした。日付範囲またはバウンディングボックスの設定を確認してください。")
+    image = _first_valid_image(evi_images)
+    layers, _ = compute_indices(image, BAND_INDICES)
 
-    image = evi_images[0]
-    # 黒画像チェックを追加
-    if is_black_image(image):
-        raise ValueError("黒画像が返されました。指定された条件では有効なデータがありません。")
-    nir, red, green, blue = [image[:, :, i].astype(float) for i in range(4)]
+    image_rgb = image[:, :, [1, 2, 3]].astype(np.uint8)
 
-    ndvi = (nir - red) / (nir + red + 1e-10)
+    return layers["ndvi"], layers["evi"], layers["fapar"], layers["allplus"], image_rgb
 
-    scale_factor = 10000.0
-    nir_scaled, red_scaled, green_scaled, blue_scaled = [band / scale_factor for band in (nir, red, green, blue)]
+def process_index_data(index_images, indices=("ndvi",), sample_type="FLOAT32", include_rgb=False):
+    """
+    create_index_evalscriptで取得した画像を指数ごとの配列に変換します。
 
-    G, C1, C2, L = 2.5, 6.0, 7.5, 1.0
-    evi = G * (nir_scaled - red_scaled) / (nir_scaled + C1 * red_scaled - C2 * blue_scaled + L + 1e-10)
+    パラメータ:
+    index_images (list): SentinelHubRequestから返された画像のリスト。
+    indices (tuple): evalscriptで指定した指数。
+    sample_type (str): evalscriptで指定した出力形式。
+    include_rgb (bool): evalscriptでRGBバンドを含めたかどうか。
 
-    fapar = 1.24 * ndvi - 0.168
-    fapar_clipped = np.clip(fapar, 0, 1)
+    戻り値:
+    dict: 指数名をキーとするfloat32配列（データのない画素はNaN）と、include_rgbの場合は 'rgb'（uint8）。
+    """
+    if not index_images:
+        raise ValueError("データが返されませんでした。日付範囲またはバウンディングボックスの設定を確認してください。")
 
-    Allplus = fapar_clipped + evi * 40 + ndvi
+    image = index_images[0]
+    data_mask = image[:, :, -1] > 0
+    if not data_mask.any():
+        raise ValueError("黒画像が返されました。指定された条件では有効なデータがありません。")
 
-    image_rgb = image[:, :, [1, 2, 3]].astype(np.uint8)
+    layers = {}
+    for i, name in enumerate(indices):
+        band = image[:, :, i].astype(np.float32)
+        if sample_type != "FLOAT32":
+            band /= INDEX_QUANTIZATION_SCALE[sample_type]
+            band -= 1.0
+        band[~data_mask] = np.nan
+        layers[name] = band
 
-    return ndvi, evi, fapar_clipped, Allplus, image_rgb
+    if include_rgb:
+        layers['rgb'] = image[:, :, len(indices):len(indices) + 3].astype(np.uint8)
+
+    return layers
 
 def plot_maps(ndvi, evi, fapar_clipped, Allplus, image_rgb):
     """
@@ -310,6 +582,66 @@ def get_farm_bbox(coordinates):
         max_lat + lat_padding   # max_lat
     )
 
+def default_date_range(days=5):
+    """
+    日付範囲が指定されていない場合に使用する直近の期間を返します。
+
+    パラメータ:
+    days (int): 期間の日数。
+
+    戻り値:
+    tuple: 日付範囲 (start_date, end_date)
+    """
+    end_date = datetime.now().strftime('%Y-%m-%d')
+    start_date = (datetime.now() - timedelta(days=days)).strftime('%Y-%m-%d')
+    return (start_date, end_date)
+
+def latest_acquisition_date_range(bbox, days=5, max_cloud_cover=DEFAULT_MAX_CLOUD_COVER):
+    """
+    範囲の最新の撮影日（雲量が上限以下）で終わる期間を返します。
+    撮影日が分からない場合は default_date_range と同じ直近の期間を返します。
+    カタログにない範囲はリクエストを待たせないようにバックグラウンドで調べ始め、
+    それまでは直近の期間を返します（日本全体の get_available_dates と同じ扱い）。
+
+    パラメータ:
+    bbox (tuple): WGS84形式の座標 (min_lon, min_lat, max_lon, max_lat)
+    days (int): 期間の日数。
+    max_cloud_cover (float): 雲量（%）の上限。
+
+    戻り値:
+    tuple: 日付範囲 (start_date, end_date)
+    """
+    acquisitions = date_catalog.get_acquisitions(bbox, max_cloud_cover, block=False)
+    if not acquisitions:
+        return default_date_range(days)
+    end = datetime.strptime(acquisitions[0]['date'], '%Y-%m-%d')
+    return ((end - timedelta(days=days)).strftime('%Y-%m-%d'), end.strftime('%Y-%m-%d'))
+
+def calculate_ndvi_stats(ndvi, mask=None):
+    """
+    NDVI配列の統計情報を計算します。
+
+    パラメータ:
+    ndvi (ndarray): NDVIマップ（データのない画素はNaN）。
+    mask (ndarray): 農場ポリゴン内の画素がTrueのbool配列。指定した場合はその画素だけを集計。
+
+    戻り値:
+    dict: min, max, mean, median, pixel_count。有効な画素がない場合は message のみ。
+    """
+    values = ndvi[mask] if mask is not None else ndvi.ravel()
+    ndvi_valid = values[~np.isnan(values)]  # NaN値を除外
+    if len(ndvi_valid) > 0:
+        return {
+            'min': float(np.min(ndvi_valid)),
+            'max': float(np.max(ndvi_valid)),
+            'mean': float(np.mean(ndvi_valid, dtype=np.float64)),
+            'median': float(np.median(ndvi_valid)),
+            'pixel_count': int(ndvi_valid.size)
+        }
+    return {
+        'message': "利用可能なデータが存在しません。"
+    }
+
 def validate_farm_area(coordinates, max_resolution=10):
     """
     農場の面積が処理可能かどうかを検証します。
@@ -359,13 +691,16 @@ def validate_farm_area(coordinates, max_resolution=10):
             'size': None
         }
 
-def get_farm_ndvi_image(coordinates, date_range=None):
+def get_farm_ndvi_image(coordinates, date_range=None, mode=None, farm_mask=None, stats_only=False):
     """
     農場のNDVI画像を取得します。
     
     パラメータ:
     coordinates (list): 農場の座標リスト [{lat, lng}, ...]
     date_range (tuple): 日付範囲 (start_date, end_date)
+    mode (str): evalscriptのモード（"index" または "bands"）。省略時は EVALSCRIPT_MODE
+    farm_mask (dict): 農場に保存されたポリゴンマスク（farm_mask.encode_maskの戻り値）
+    stats_only (bool): Trueの場合は画像の描画・エンコードを行わず、統計情報だけを返す
     
     戻り値:
     dict: 処理結果
@@ -375,39 +710,35 @@ def get_farm_ndvi_image(coordinates, date_range=None):
         bbox = get_farm_bbox(coordinates)
         
         # 解像度を設定（メートル単位）
-        resolution = 10
+        resolution = FARM_RESOLUTION
         
         # バウンディングボックスとサイズを計算
         aoi_bbox, aoi_size = create_bbox_and_size(bbox, resolution)
         
-        # 日付範囲が指定されていない場合は最近5日間を使用
+        # 日付範囲が指定されていない場合は最新の撮影日までの5日間を使用
         if not date_range:
-            end_date = datetime.now().strftime('%Y-%m-%d')
-            start_date = (datetime.now() - timedelta(days=5)).strftime('%Y-%m-%d')
-            date_range = (start_date, end_date)
+            date_range = latest_acquisition_date_range(bbox)
         
-        # Sentinel Hubリクエストを作成
-        evalscript = create_evalscript()
-        request = SentinelHubRequest(
-            evalscript=evalscript,
-            input_data=[
-                SentinelHubRequest.input_data(
-                    data_collection=DataCollection.SENTINEL2_L2A.define_from(
-                        name="s2",
-                        service_url="https://sh.dataspace.copernicus.eu"
-                    ),
-                    time_interval=date_range,
-                    maxcc=0.5  # クラウドカバー率の最大値（20%以下のデータのみを使用）
-                )
-            ],
-            responses=[SentinelHubRequest.output_response("default", MimeType.TIFF)],
-            bbox=aoi_bbox,
-            size=aoi_size,
-            config=config
-        )
+        mode = mode or EVALSCRIPT_MODE
+        include_rgb = True
+        images = None
+        # bandsモードで指数の計算中に確保した最大バイト数の見積もり（indexモードは None）
+        peak_bytes = None
+        if mode == "index":
+            # NDVIとRGBだけをSentinel Hub側で計算・量子化して取得
+            evalscript = create_index_evalscript(("ndvi",), INDEX_SAMPLE_TYPE, include_rgb=True)
+            if stats_only:
+                # 画像表示用に取得済みのデータがあればそれを使い、なければNDVIだけを取得する
+                images = raster_cache.get(RasterCache.make_key(bbox, date_range, evalscript, resolution, FARM_MAXCC))
+                if images is None:
+                    include_rgb = False
+                    evalscript = create_index_evalscript(("ndvi",), INDEX_SAMPLE_TYPE)
+        else:
+            evalscript = create_evalscript()
         
-        # データを取得
-        images = request.get_data()
+        # データを取得（キャッシュにあればSentinel Hubへのリクエストは行わない）
+        if images is None:
+            images = fetch_sentinel_images(bbox, aoi_bbox, aoi_size, date_range, evalscript, resolution, FARM_MAXCC)
         
         if not images:
             return {
@@ -417,56 +748,48 @@ def get_farm_ndvi_image(coordinates, date_range=None):
             }
         
         # 画像データを処理
-        ndvi, evi, fapar, allplus, rgb = process_image_data(images)
-        
-        # NDVIの統計情報を計算
-        ndvi_valid = ndvi[~np.isnan(ndvi)]  # NaN値を除外
-        if len(ndvi_valid) > 0:
-            ndvi_stats = {
-                'min': float(np.nanmin(ndvi)),
-                'max': float(np.nanmax(ndvi)),
-                'mean': float(np.nanmean(ndvi)),
-                'median': float(np.nanmedian(ndvi))
-            }
+        if mode == "index":
+            layers = process_index_data(images, ("ndvi",), INDEX_SAMPLE_TYPE, include_rgb=include_rgb)
+            ndvi, rgb = layers['ndvi'], layers.get('rgb')
         else:
-            ndvi_stats = {
-                'message': "利用可能なデータが存在しません。"
-            }
-        
-        # NDVIデータをBase64エンコード
-        ndvi_normalized = (np.clip(ndvi, -1, 1) + 1) / 2 * 255  # -1〜1の範囲を0〜255に正規化
-        ndvi_img = np.uint8(ndvi_normalized)
+            image = _first_valid_image(images)
+            layers, peak_bytes = compute_indices(image, ("ndvi",))
+            ndvi = layers["ndvi"]
+            rgb = image[:, :, [1, 2, 3]].astype(np.uint8)
         
-        # カラーマップを適用
-        cmap = plt.get_cmap('RdYlGn')
-        ndvi_colored = cmap(ndvi_img / 255.0) * 255
-        ndvi_colored = ndvi_colored.astype(np.uint8)
+        # NDVIの統計情報を計算（農場ポリゴン内の画素のみ）
+        mask = get_farm_mask(coordinates, bbox, ndvi.shape, farm_mask)
+        ndvi_stats = calculate_ndvi_stats(ndvi, mask)
+        # 画素ごとの健康状態の区分と面積（平均値だけでは分からない圃場内のむら）
+        health_zones = classify_ndvi_pixels(ndvi, mask, pixel_area_m2=resolution ** 2)
         
-        # 画像をエンコード
-        import io
-        import base64
-        from PIL import Image
-        
-        # NDVI画像
-        ndvi_pil = Image.fromarray(ndvi_colored)
-        ndvi_buffer = io.BytesIO()
-        ndvi_pil.save(ndvi_buffer, format='PNG')
-        ndvi_base64 = base64.b64encode(ndvi_buffer.getvalue()).decode('utf-8')
+        if stats_only:
+            return {
+                'success': True,
+                'message': "NDVI統計を取得しました。",
+                'data': {
+                    'ndvi_stats': ndvi_stats,
+                    'health_zones': health_zones,
+                    'peak_bytes': peak_bytes,
+                    'bbox': bbox,
+                    'date_range': date_range,
+                    'start_date': date_range[0],
+                    'end_date': date_range[1]
+                }
+            }
         
-        # RGB画像
-        rgb_normalized = np.clip(rgb * 3.5, 0, 255).astype(np.uint8)  # 明るさ調整
-        rgb_pil = Image.fromarray(rgb_normalized)
-        rgb_buffer = io.BytesIO()
-        rgb_pil.save(rgb_buffer, format='PNG')
-        rgb_base64 = base64.b64encode(rgb_buffer.getvalue()).decode('utf-8')
+        # NDVI画像・RGB画像を描画して保存（JSONには画像IDだけを含める）
+        ndvi_image_id, rgb_image_id = render_ndvi_images(ndvi, rgb)
         
         return {
             'success': True,
             'message': "NDVI画像を取得しました。",
             'data': {
                 'ndvi_stats': ndvi_stats,
-                'ndvi_image': ndvi_base64,
-                'rgb_image': rgb_base64,
+                'health_zones': health_zones,
+                'peak_bytes': peak_bytes,
+                'ndvi_image_id': ndvi_image_id,
+                'rgb_image_id': rgb_image_id,
                 'bbox': bbox,
                 'date_range': date_range,
                 'start_date': date_range[0] if date_range else datetime.now().strftime('%Y-%m-%d'), # 開始日を追加
@@ -485,6 +808,52 @@ def get_farm_ndvi_image(coordinates, date_range=None):
             'data': None
         }
 
+def get_farm_ndvi_stats(coordinates, date_range=None, farm_mask=None):
+    """
+    農場のNDVI統計だけを取得します（画像の描画・エンコードを行わない高速版）。
+    
+    パラメータ:
+    coordinates (list): 農場の座標リスト [{lat, lng}, ...]
+    date_range (tuple): 日付範囲 (start_date, end_date)
+    farm_mask (dict): 農場に保存されたポリゴンマスク（farm_mask.encode_maskの戻り値）
+    
+    戻り値:
+    dict: 処理結果（data には ndvi_stats, bbox, date_range, start_date, end_date）
+    """
+    return get_farm_ndvi_image(coordinates, date_range, farm_mask=farm_mask, stats_only=True)
+
+def get_cached_farm_ndvi(coordinates, date_range=None, farm_mask=None):
+    """
+    キャッシュ済みのラスタから農場のNDVIを取得します（Sentinel Hubへのリクエストは行いません）。
+    
+    パラメータ:
+    coordinates (list): 農場の座標リスト [{lat, lng}, ...]
+    date_range (tuple): 日付範囲 (start_date, end_date)。省略時は get_farm_ndvi_image と同じく
+        農場の最新の撮影日までの5日間
+    farm_mask (dict): 農場に保存されたポリゴンマスク（farm_mask.encode_maskの戻り値）
+    
+    戻り値:
+    tuple or None: (バウンディングボックス, 農場外の画素をNaNにしたNDVI配列)。キャッシュにない場合は None。
+    """
+    bbox = get_farm_bbox(coordinates)
+    if not date_range:
+        date_range = latest_acquisition_date_range(bbox)
+    candidates = [
+        (create_index_evalscript(("ndvi",), INDEX_SAMPLE_TYPE, include_rgb=True), True),
+        (create_index_evalscript(("ndvi",), INDEX_SAMPLE_TYPE), False)
+    ]
+    for evalscript, include_rgb in candidates:
+        images = raster_cache.get(RasterCache.make_key(bbox, date_range, evalscript, FARM_RESOLUTION, FARM_MAXCC))
+        if images is None:
+            continue
+        try:
+            ndvi = process_index_data(images, ("ndvi",), INDEX_SAMPLE_TYPE, include_rgb=include_rgb)['ndvi']
+        except ValueError:
+            return None
+        ndvi[~get_farm_mask(coordinates, bbox, ndvi.shape, farm_mask)] = np.nan
+        return bbox, ndvi
+    return None
+
 if __name__ == "__main__":
     aoi_coords_wgs84 = (141.05090, 38.437358, 141.090760, 38.468906)  # 左上と右下の座標
     resolution = 10  # 解像度10m
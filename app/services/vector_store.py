@@ -0,0 +1,263 @@
+"""
+チャットボットのナレッジベース用の永続ベクトルインデックス
+
+埋め込みベクトルは正規化して float32 の連続した行列としてファイルに保存し、メモリマップで読み込みます。
+チャンクの本文・メタデータ・内容のハッシュはSQLiteに保存し、行列の行番号で対応付けます。
+検索はクエリベクトルと行列の積（コサイン類似度）から上位k件を選ぶだけなので、
+チャンクが数千件に増えても1回の行列演算で済みます。
+
+登録（upsert_documents）はチャンクごとに内容のハッシュを比較し、変更・追加されたチャンクだけを埋め込みます。
+"""
+import os
+import json
+import hashlib
+import sqlite3
+import threading
+
+import numpy as np
+from langchain_core.documents import Document
+
+VECTORS_FILE = 'vectors.f32'
+METADATA_FILE = 'chunks.db'
+# 行列ファイルを拡張するときの最小行数
+MIN_CAPACITY = 1024
+# 1回の埋め込み呼び出しで送るチャンク数
+EMBED_BATCH_SIZE = 100
+
+
+def content_hash(text, model=''):
+    """チャンクの内容と埋め込みモデルのハッシュ（モデルが変わった場合も埋め込み直す）"""
+    return hashlib.sha256(f"{model}\n{text}".encode('utf-8')).hexdigest()
+
+
+def _normalize(vectors):
+    vectors = np.asarray(vectors, dtype=np.float32)
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    norms[norms == 0] = 1
+    return vectors / norms
+
+
+class LocalVectorStore:
+    """メモリマップした埋め込み行列とSQLiteのメタデータによるベクトルインデックス"""
+
+    def __init__(self, index_dir, embedding, model_name=''):
+        """
+        パラメータ:
+        index_dir (str): インデックスを保存するディレクトリ。
+        embedding (Embeddings): 埋め込みモデル（embed_documents と embed_query を持つもの）。
+        model_name (str): 埋め込みモデル名（内容のハッシュに含める）。
+        """
+        self.index_dir = index_dir
+        self.embedding = embedding
+        self.model_name = model_name
+        self._vectors_path = os.path.join(index_dir, VECTORS_FILE)
+        self._lock = threading.RLock()
+
+        os.makedirs(index_dir, exist_ok=True)
+        self._conn = sqlite3.connect(os.path.join(index_dir, METADATA_FILE), timeout=10, check_same_thread=False)
+        self._conn.executescript('''
+        CREATE TABLE IF NOT EXISTS store_info (
+            key TEXT PRIMARY KEY,
+            value TEXT
+        );
+        CREATE TABLE IF NOT EXISTS chunks (
+            row INTEGER PRIMARY KEY,
+            chunk_key TEXT UNIQUE,
+            source TEXT,
+            content_hash TEXT,
+            content TEXT,
+            metadata TEXT,
+            active INTEGER NOT NULL DEFAULT 1
+        );
+        CREATE INDEX IF NOT EXISTS idx_chunks_source ON chunks (source);
+        ''')
+        self._matrix = None
+        self._dim = None
+        self._active = np.zeros(0, dtype=bool)
+        self._data_version = None
+        self._load()
+
+    def _load(self):
+        # メタデータと行列ファイルを読み込み直す（他のプロセスが更新した場合にも呼ばれる）
+        row = self._conn.execute("SELECT value FROM store_info WHERE key = 'dim'").fetchone()
+        self._dim = int(row[0]) if row else None
+
+        rows = self._conn.execute("SELECT row, active FROM chunks").fetchall()
+        size = max((r for r, _ in rows), default=-1) + 1
+        self._active = np.zeros(size, dtype=bool)
+        for r, active in rows:
+            self._active[r] = bool(active)
+
+        self._matrix = None
+        if self._dim and os.path.exists(self._vectors_path):
+            capacity = os.path.getsize(self._vectors_path) // (4 * self._dim)
+            if capacity:
+                self._matrix = np.memmap(self._vectors_path, dtype=np.float32, mode='r+',
+                                         shape=(capacity, self._dim))
+        self._data_version = self._conn.execute("PRAGMA data_version").fetchone()[0]
+
+    def _refresh(self):
+        # data_version は他の接続がコミットした場合にだけ変わる
+        if self._conn.execute("PRAGMA data_version").fetchone()[0] != self._data_version:
+            self._load()
+
+    def _ensure_capacity(self, rows):
+        capacity = 0 if self._matrix is None else self._matrix.shape[0]
+        if rows <= capacity:
+            return
+        new_capacity = max(rows, capacity * 2, MIN_CAPACITY)
+        if self._matrix is not None:
+            self._matrix.flush()
+            self._matrix = None
+        with open(self._vectors_path, 'ab') as f:
+            f.truncate(new_capacity * self._dim * 4)
+        self._matrix = np.memmap(self._vectors_path, dtype=np.float32, mode='r+',
+                                 shape=(new_capacity, self._dim))
+
+    def __len__(self):
+        with self._lock:
+            self._refresh()
+            return int(self._active.sum())
+
+    def _embed(self, texts):
+        vectors = []
+        for start in range(0, len(texts), EMBED_BATCH_SIZE):
+            vectors.extend(self.embedding.embed_documents(texts[start:start + EMBED_BATCH_SIZE]))
+        return _normalize(vectors)
+
+    def upsert_documents(self, source, documents):
+        """
+        取得元ごとにチャンクを登録します。内容のハッシュが変わったチャンクだけを埋め込み、
+        前回登録されていて今回含まれないチャンクは削除します。
+
+        パラメータ:
+        source (str): 取得元の名前（URLや 'ndvi_mapping' など）。
+        documents (list): Documentのリスト。metadata['chunk_key'] があればチャンクの識別に使い、
+            なければ取得元内の順番で識別します。
+
+        戻り値:
+        dict: {'embedded': 埋め込んだ件数, 'unchanged': 変更のない件数, 'removed': 削除した件数}
+        """
+        with self._lock:
+            self._refresh()
+            existing = {
+                key: (row, digest) for row, key, digest in self._conn.execute(
+                    "SELECT row, chunk_key, content_hash FROM chunks WHERE source = ? AND active = 1", (source,)
+                )
+            }
+
+            chunks = {}
+            for i, doc in enumerate(documents):
+                chunk_key = doc.metadata.get('chunk_key')
+                key = f"{source}/{chunk_key}" if chunk_key is not None else f"{source}#{i}"
+                chunks[key] = (doc, content_hash(doc.page_content, self.model_name))
+            changed = [key for key, (_, digest) in chunks.items()
+                       if key not in existing or existing[key][1] != digest]
+            removed = [key for key in existing if key not in chunks]
+
+            vectors = self._embed([chunks[key][0].page_content for key in changed]) if changed else None
+            if vectors is not None and self._dim != vectors.shape[1]:
+                if self._dim is not None:
+                    raise ValueError(
+                        f"埋め込みの次元（{vectors.shape[1]}）がインデックス（{self._dim}）と一致しません。"
+                        "インデックスを作り直してください。"
+                    )
+                self._dim = vectors.shape[1]
+                with self._conn:
+                    self._conn.execute("INSERT OR REPLACE INTO store_info (key, value) VALUES ('dim', ?)",
+                                       (str(self._dim),))
+
+            # 削除したチャンクの行は、新しいチャンクで再利用する
+            free_rows = [existing[key][0] for key in removed]
+            free_rows += [row for (row,) in self._conn.execute("SELECT row FROM chunks WHERE active = 0")]
+            next_row = len(self._active)
+            rows = []
+            for key in changed:
+                if key in existing:
+                    rows.append(existing[key][0])
+                elif free_rows:
+                    rows.append(free_rows.pop())
+                else:
+                    rows.append(next_row)
+                    next_row += 1
+
+            if changed:
+                self._ensure_capacity(next_row)
+                self._matrix[rows] = vectors
+                self._matrix.flush()
+
+            with self._conn:
+                for key in removed:
+                    self._conn.execute("UPDATE chunks SET active = 0 WHERE chunk_key = ?", (key,))
+                for key, row in zip(changed, rows):
+                    doc, digest = chunks[key]
+                    # 再利用する行に残っている古いチャンクを置き換える
+                    self._conn.execute("DELETE FROM chunks WHERE row = ? OR chunk_key = ?", (row, key))
+                    self._conn.execute(
+                        "INSERT INTO chunks (row, chunk_key, source, content_hash, content, metadata, active) "
+                        "VALUES (?, ?, ?, ?, ?, ?, 1)",
+                        (row, key, source, digest, doc.page_content, json.dumps(doc.metadata, ensure_ascii=False))
+                    )
+
+            if next_row > len(self._active):
+                self._active = np.concatenate([self._active, np.zeros(next_row - len(self._active), dtype=bool)])
+            self._active[[existing[key][0] for key in removed]] = False
+            self._active[rows] = True
+            self._data_version = self._conn.execute("PRAGMA data_version").fetchone()[0]
+
+            return {'embedded': len(changed), 'unchanged': len(chunks) - len(changed), 'removed': len(removed)}
+
+    def similarity_search_with_score_by_vector(self, embedding, k=4):
+        """
+        ベクトルに類似したチャンクを類似度の高い順に返します。
+
+        パラメータ:
+        embedding (list): クエリの埋め込みベクトル。
+        k (int): 返す件数。
+
+        戻り値:
+        list: (Document, コサイン類似度) のタプルのリスト
+        """
+        with self._lock:
+            self._refresh()
+            count = int(self._active.sum())
+            if self._matrix is None or count == 0:
+                return []
+            query = _normalize(embedding)
+            size = len(self._active)
+            scores = self._matrix[:size] @ query
+            scores[~self._active] = -np.inf
+
+            k = min(k, count)
+            top = np.argpartition(-scores, k - 1)[:k]
+            top = top[np.argsort(-scores[top])]
+
+            found = {
+                row: (content, metadata) for row, content, metadata in self._conn.execute(
+                    f"SELECT row, content, metadata FROM chunks WHERE row IN ({','.join('?' * len(top))})",
+                    [int(row) for row in top]
+                )
+            }
+        return [
+            (Document(page_content=found[row][0], metadata=json.loads(found[row][1])), float(scores[row]))
+            for row in top.tolist() if row in found
+        ]
+
+    def similarity_search_by_vector(self, embedding, k=4):
+        """ベクトルに類似したチャンクを類似度の高い順に返します。"""
+        return [doc for doc, _ in self.similarity_search_with_score_by_vector(embedding, k)]
+
+    def similarity_search(self, query, k=4):
+        """
+        クエリ文に類似したチャンクを類似度の高い順に返します。
+
+        パラメータ:
+        query (str): 検索文。
+        k (int): 返す件数。
+
+        戻り値:
+        list: Documentのリスト
+        """
+        if not len(self):
+            return []
+        return self.similarity_search_by_vector(self.embedding.embed_query(query), k)
@@ -112,31 +112,8 @@ document.addEventListener('DOMContentLoaded', function() {
         // まず質問をUI上に表示
         addMessage(question, 'user');
         
-        // 入力中インジケータを表示
-        const typingIndicator = addTypingIndicator();
-        
-        // その後バックエンドにリクエスト送信
-        fetch('/chatbot/ask', {
-            method: 'POST',
-            headers: {
-                'Content-Type': 'application/json',
-            },
-            body: JSON.stringify({
-                question: question,
-                farm_id: farmId || null
-            })
-        })
-        .then(response => response.json())
-        .then(data => {
-            typingIndicator.remove();
-            addMessage(data.response, 'bot');
-            chatMessages.scrollTop = chatMessages.scrollHeight;
-        })
-        .catch(error => {
-            console.error('エラー:', error);
-            typingIndicator.remove();
-            addMessage('申し訳ありません。農作業カレンダーの取得中にエラーが発生しました。', 'bot');
-        });
+        // その後バックエンドにリクエスト送信（回答は届いた部分から表示）
+        streamQuestion(question, farmId || null, null, '申し訳ありません。農作業カレンダーの取得中にエラーが発生しました。');
     }
     
     // チャットフォームの送信イベント
@@ -156,38 +133,99 @@ document.addEventListener('DOMContentLoaded', function() {
         // 入力フィールドをクリア
         chatInput.value = '';
         
-        // ボットの「入力中...」状態を表示
+        // APIリクエストを送信（回答は届いた部分から表示）
+        streamQuestion(message, farmId, date, '申し訳ありません。エラーが発生しました。後ほど再度お試しください。');
+    });
+    
+    // 質問を送信し、Server-Sent Eventsで届くツールの進捗と回答のトークンを順次表示する関数
+    function streamQuestion(question, farmId, date, errorMessage) {
+        // ボットの「入力中...」状態を表示（ツールの実行中はその内容を表示）
         const typingIndicator = addTypingIndicator();
+        const progressText = typingIndicator.querySelector('p');
+        let botMessage = null;
+        let answer = '';
+        
+        function handleEvent(block) {
+            let event = 'message';
+            const dataLines = [];
+            block.split('\n').forEach(line => {
+                if (line.startsWith('event:')) {
+                    event = line.slice(6).trim();
+                } else if (line.startsWith('data:')) {
+                    dataLines.push(line.slice(5).trim());
+                }
+            });
+            if (dataLines.length === 0) return;
+            const data = JSON.parse(dataLines.join('\n'));
+            
+            if (event === 'tool_start') {
+                progressText.textContent = `${data.label}中...`;
+            } else if (event === 'tool_end') {
+                progressText.textContent = `${data.label}しました。回答を作成中...`;
+            } else if (event === 'token') {
+                // 最初のトークンが届いたらインジケータを回答に置き換える
+                if (!botMessage) {
+                    typingIndicator.remove();
+                    botMessage = addMessage('', 'bot');
+                }
+                answer += data;
+                botMessage.querySelector('.message-content p').innerHTML = answer.replace(/\n/g, '<br>');
+                chatMessages.scrollTop = chatMessages.scrollHeight;
+            } else if (event === 'done') {
+                typingIndicator.remove();
+                if (!botMessage) {
+                    addMessage(data, 'bot');
+                }
+            } else if (event === 'error') {
+                typingIndicator.remove();
+                addMessage(data, 'bot');
+            }
+        }
         
-        // APIリクエストを送信
-        fetch('/chatbot/ask', {
+        fetch('/chatbot/ask/stream', {
             method: 'POST',
             headers: {
                 'Content-Type': 'application/json',
             },
             body: JSON.stringify({
-                question: message,
+                question: question,
                 farm_id: farmId,
                 date: date
             })
         })
-        .then(response => response.json())
-        .then(data => {
-            // 「入力中...」を削除
-            typingIndicator.remove();
-            
-            // ボットの応答をUIに追加
-            addMessage(data.response, 'bot');
+        .then(response => {
+            if (!response.ok || !response.body) {
+                throw new Error(`HTTP ${response.status}`);
+            }
+            const reader = response.body.getReader();
+            const decoder = new TextDecoder();
+            let buffer = '';
             
-            // 最新のメッセージまでスクロール
-            chatMessages.scrollTop = chatMessages.scrollHeight;
+            function read() {
+                return reader.read().then(({ done, value }) => {
+                    if (done) {
+                        if (buffer.trim()) handleEvent(buffer);
+                        typingIndicator.remove();
+                        return;
+                    }
+                    buffer += decoder.decode(value, { stream: true });
+                    // イベントは空行で区切られる
+                    let index;
+                    while ((index = buffer.indexOf('\n\n')) >= 0) {
+                        handleEvent(buffer.slice(0, index));
+                        buffer = buffer.slice(index + 2);
+                    }
+                    return read();
+                });
+            }
+            return read();
         })
         .catch(error => {
             console.error('エラー:', error);
             typingIndicator.remove();
-            addMessage('申し訳ありません。エラーが発生しました。後ほど再度お試しください。', 'bot');
+            addMessage(errorMessage, 'bot');
         });
-    });
+    }
     
     // メッセージをチャットUIに追加する関数
     function addMessage(text, sender) {
@@ -7,30 +7,52 @@ document.addEventListener('DOMContentLoaded', function() {
              attribution: '&copy; <a href="https://www.openstreetmap.org/copyright">OpenStreetMap</a> contributors'
          }).addTo(map);
      
-         // 農場データを取得してマーカー表示
-         fetch('/map/farms') // 新しいエンドポイント
-             .then(response => response.json())
-             .then(farms => {
-                farms.forEach(farm => {
-                    let coord;
-                    if (Array.isArray(farm.coordinates) && farm.coordinates.length > 0) {
-                        // coordinates が配列の場合、最初の要素を使用
-                        coord = farm.coordinates[0];
-                    } else if (farm.coordinates && typeof farm.coordinates === 'object' && farm.coordinates.lat && farm.coordinates.lng) {
-                        // coordinates がオブジェクトで lat, lng を持つ場合
-                        coord = farm.coordinates;
-                    }
-    
-                    if (coord) {
-                        L.marker([coord.lat, coord.lng])
-                            .addTo(map)
-                            .bindPopup(`<strong>${farm.name}</strong> <br><a href="/farm/${farm.id}">詳細を見る</a>`); // ポップアップにリンクを追加
-                    }
-                });
-            　})        
-            .catch(error => {
-                console.error('農場データの取得に失敗しました:', error);
-            });
+         // NDVIタイルレイヤー（キャッシュ済みの農場ラスタから生成）
+         // 日付は農場ごとに異なるため、サーバー側で農場ごとの最新の撮影日を使う
+         const ndviLayer = L.tileLayer('/map/tiles/ndvi/latest/{z}/{x}/{y}.png', {
+             opacity: 0.7,
+             minZoom: 8,
+             maxZoom: 19
+         }).addTo(map);
+         L.control.layers(null, { 'NDVI': ndviLayer }).addTo(map);
+     
+         // 農場データを表示範囲ごとに取得してマーカー表示
+         const farmMarkers = L.layerGroup().addTo(map);
+         let farmRequest = 0;
+         function loadVisibleFarms() {
+             const bounds = map.getBounds();
+             const bbox = [bounds.getWest(), bounds.getSouth(), bounds.getEast(), bounds.getNorth()].join(',');
+             const requestId = ++farmRequest;
+             fetch(`/map/farms?bbox=${bbox}&zoom=${map.getZoom()}`)
+                 .then(response => response.json())
+                 .then(farms => {
+                     // 古いリクエストの結果は捨てる
+                     if (requestId !== farmRequest) return;
+                     farmMarkers.clearLayers();
+                     farms.forEach(farm => {
+                         let coord;
+                         if (Array.isArray(farm.coordinates) && farm.coordinates.length > 0) {
+                             // coordinates が配列の場合、最初の要素を使用
+                             coord = farm.coordinates[0];
+                         } else if (farm.coordinates && typeof farm.coordinates === 'object' && farm.coordinates.lat && farm.coordinates.lng) {
+                             // coordinates がオブジェクトで lat, lng を持つ場合（ズームアウト時は中心点）
+                             coord = farm.coordinates;
+                         }
+     
+                         if (coord) {
+                             L.marker([coord.lat, coord.lng])
+                                 .addTo(farmMarkers)
+                                 .bindPopup(`<strong>${farm.name}</strong> <br><a href="/farm/${farm.id}">詳細を見る</a>`); // ポップアップにリンクを追加
+                         }
+                     });
+                 })
+                 .catch(error => {
+                     console.error('農場データの取得に失敗しました:', error);
+                 });
+         }
+         map.on('moveend', loadVisibleFarms);
+         loadVisibleFarms();
+
     // AIチャットボタンの処理
     document.getElementById('chat-button').addEventListener('click', function() {
         window.location.href = '/chatbot';
@@ -43,4 +65,4 @@ document.addEventListener('DOMContentLoaded', function() {
 
     // 初期データの読み込み
     //loadLayerData('latest');
-});
\ No newline at end of file
+});
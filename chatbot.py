@@ -2,26 +2,40 @@ import google.generativeai as genai
 from langchain_google_genai import ChatGoogleGenerativeAI
 from dotenv import load_dotenv
 import os
+import threading
+import time
+import uuid
+from functools import lru_cache
 from flask import Flask, render_template, request, jsonify, session, g
-from langchain_core.vectorstores import InMemoryVectorStore
-import bs4
-from langchain_community.document_loaders import WebBaseLoader
 from langchain_core.documents import Document
-from langchain_text_splitters import RecursiveCharacterTextSplitter
 from typing_extensions import List, TypedDict
 from langgraph.graph import MessagesState, StateGraph, END
 from langchain_core.tools import tool
 from langchain_google_genai import GoogleGenerativeAIEmbeddings
-from langgraph.prebuilt.tool_node import ToolNode
 from langgraph.prebuilt import tools_condition
-from langchain_core.messages import SystemMessage
+from langchain_core.messages import SystemMessage, HumanMessage, ToolMessage, AIMessage, RemoveMessage
+from langchain_core.runnables import RunnableConfig
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+from contextvars import copy_context
 import json
 from datetime import datetime, timedelta
 import sqlite3
 import numpy as np
 
 # NDVIマッピングモジュールをインポート
-from app.services.ndvi_mapping import NDVI_MAPPING, evaluate_ndvi_health, analyze_ndvi_trend, get_current_season
+from app.services.ndvi_mapping import NDVI_MAPPING, evaluate_ndvi_health, analyze_ndvi_trend, get_current_season, summarize_health_zones
+from app.services.knowledge_index import load_knowledge_index, EMBEDDING_MODEL
+from app.services.farming_calendar import get_calendar
+from app.services.embedding_cache import CachedEmbeddings
+from app.services.response_cache import response_cache
+from app.services.farm_repository import farm_repository, current_owner_id
+from app.services.question_router import (
+    classify_question, is_ndvi_query, render_calendar_answer, render_ndvi_answer, render_history_answer,
+    route_latency
+)
+from app.services import ndvi_history
+from app.services.ndvi_analytics import panel_cache
+from app.services.conversation_store import conversation_store
 
 app = Flask(__name__)
 
@@ -31,41 +45,106 @@ load_dotenv()
 # 環境変数からAPIキーを取得
 google_api_key = os.getenv("GOOGLE_API_KEY")
 
-# Geminiモデルの設定
-genai.configure(api_key=google_api_key)
-model = ChatGoogleGenerativeAI(model="gemini-2.0-flash-exp")
-embedding_model = GoogleGenerativeAIEmbeddings(model="models/text-embedding-004")
-vector_store = InMemoryVectorStore(embedding_model)
-
-# 農業関連のナレッジベース読み込み
-loader = WebBaseLoader(
-    web_paths=("https://www.sciencedirect.com/science/article/abs/pii/S0034425719304717",),
-    bs_kwargs=dict(
-        parse_only=bs4.SoupStrainer(
-            class_=("post-content", "post-title", "post-header")
-        )
-    ),
-)
-docs = loader.load()
+# モデル・ナレッジインデックス・グラフは最初に使われたときに作成する
+# （import時にネットワークや埋め込みの呼び出しが発生しないようにするため）
+_init_lock = threading.Lock()
+_vector_store = None
+_graph = None
 
-text_splitter = RecursiveCharacterTextSplitter(chunk_size=1000, chunk_overlap=200)
-all_splits = text_splitter.split_documents(docs)
-_ = vector_store.add_documents(documents=all_splits)
-graph_builder = StateGraph(MessagesState)
+@lru_cache(maxsize=None)
+def get_model():
+    """Geminiモデルを返す"""
+    genai.configure(api_key=google_api_key)
+    return ChatGoogleGenerativeAI(model="gemini-2.0-flash-exp")
+
+@lru_cache(maxsize=None)
+def get_embedding_model():
+    """埋め込みモデルを返す（同じテキストの埋め込みはキャッシュから返す）"""
+    return CachedEmbeddings(GoogleGenerativeAIEmbeddings(model=EMBEDDING_MODEL), EMBEDDING_MODEL)
+
+def get_vector_store():
+    """事前に作成した農業ナレッジベースのインデックスを読み込んで返す"""
+    global _vector_store
+    if _vector_store is None:
+        with _init_lock:
+            if _vector_store is None:
+                _vector_store = load_knowledge_index(get_embedding_model())
+    return _vector_store
 
 @tool(response_format="content_and_artifact")
 def retrieve(query: str):
     """Retrieve information related to a query."""
-    retrieved_docs = vector_store.similarity_search(query, k=5)
+    retrieved_docs = get_vector_store().similarity_search(query, k=5)
     serialized = "\n\n".join(
         (f"Source: {doc.metadata}\n" f"Content: {doc.page_content}")
         for doc in retrieved_docs
     )
     return serialized, retrieved_docs
 
+def _find_farm(farm_id=None, owner_id=None):
+    """利用者の農場をリポジトリから取得します（IDの指定がなければ最初の農場）。"""
+    if owner_id is None:
+        return None
+    if farm_id:
+        # モデルが渡すIDは数値とは限らない（数値でなければ該当する農場なし）
+        try:
+            return farm_repository.get(int(farm_id), owner_id)
+        except (TypeError, ValueError):
+            return None
+    farms = farm_repository.list(owner_id)
+    return farms[0] if farms else None
+
+def _tool_context(config):
+    """
+    ツールの実行設定から会話の農場コンテキストを取り出します。
+    ツールはリクエスト外のスレッドで実行されるため、Flaskのセッションではなくこの値を使います。
+
+    Returns:
+    tuple: (利用者ID, 質問で選択された農場ID, 質問の日付)
+    """
+    configurable = (config or {}).get("configurable", {})
+    return configurable.get("owner_id"), configurable.get("farm_id"), configurable.get("date")
+
+def _analyze_ndvi(ndvi_data, health_zones=None):
+    """
+    NDVIデータに健康状態の評価・トレンド・NDVI_MAPPINGのアドバイスを付ける
+    
+    Parameters:
+    ndvi_data (dict): ndvi_stats, history, crop_type を持つNDVIデータ
+    health_zones (dict): 画素ごとの健康状態の区分（classify_ndvi_pixels の戻り値）。ない場合は区域の分析を省略
+    
+    Returns:
+    dict: 分析結果
+    """
+    # 健康状態の評価
+    health_status = evaluate_ndvi_health(ndvi_data["ndvi_stats"]["mean"])
+    trend = analyze_ndvi_trend(ndvi_data["history"])
+    season = get_current_season()
+    
+    # レコメンデーションの追加（圃場内に生育不良の区域がある場合はその対策を先頭に）
+    recommendations = NDVI_MAPPING["recommendations"][health_status]
+    zone_advice = summarize_health_zones(health_zones) if health_zones else None
+    if zone_advice:
+        recommendations = [zone_advice] + recommendations
+    
+    # 作物固有のアドバイス
+    crop_advice = NDVI_MAPPING["crops"].get(ndvi_data["crop_type"], {}).get(health_status, "")
+    
+    # 季節に応じたアドバイス
+    seasonal_advice = NDVI_MAPPING["seasonal"][season][health_status]
+    
+    return {
+        "health_status": health_status,
+        "dominant_zone": health_zones['dominant'] if health_zones else None,
+        "trend": trend,
+        "recommendations": recommendations,
+        "crop_specific_advice": crop_advice,
+        "seasonal_advice": seasonal_advice
+    }
+
 # NDVIデータを取得するツール
 @tool
-def get_farm_ndvi_data(farm_id: str = None, date: str = None):
+def get_farm_ndvi_data(farm_id: str = None, date: str = None, config: RunnableConfig = None):
     """
     農場のNDVIデータを取得する
     
@@ -77,76 +156,39 @@ def get_farm_ndvi_data(farm_id: str = None, date: str = None):
     dict: NDVIデータと分析結果
     """
     try:
-        from flask import current_app, g
         from datetime import datetime, timedelta
-        from app.services.satellite_service import get_farm_ndvi_image, validate_farm_area
-        import sqlite3
-        import os
-        import json
-        
-        # データベース接続（なければ作成）
-        db_path = os.path.join(os.path.dirname(os.path.dirname(__file__)), 'instance', 'farms.db')
-        os.makedirs(os.path.dirname(db_path), exist_ok=True)
-        
-        conn = sqlite3.connect(db_path)
-        conn.row_factory = sqlite3.Row
-        cursor = conn.cursor()
+        from app.services.satellite_service import get_farm_ndvi_stats
         
-        # テーブルがなければ作成
-        cursor.execute('''
-        CREATE TABLE IF NOT EXISTS farm_ndvi_history (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            farm_id INTEGER NOT NULL,
-            date TEXT NOT NULL,
-            min_ndvi REAL,
-            max_ndvi REAL,
-            mean_ndvi REAL,
-            median_ndvi REAL,
-            crop_type TEXT,
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-        )
-        ''')
-        conn.commit()
-        
-        # アプリケーションコンテキストでセッションから農場データを取得
-        with current_app.app_context():
-            # まずセッションから農場を取得
-            farms = session.get('farms', [])
-            
-            # 指定されたIDの農場を検索、なければ最初の農場を使用
-            if farm_id:
-                farm = next((f for f in farms if f['id'] == int(farm_id)), None)
-            else:
-                farm = farms[0] if farms else None
+        # 利用者の農場をリポジトリから取得（指定がなければ質問で選択された農場）
+        owner_id, context_farm_id, context_date = _tool_context(config)
+        farm = _find_farm(farm_id or context_farm_id, owner_id)
         
         # 農場がない場合
         if not farm:
             return {"error": "農場データが見つかりません。農場を登録してください。"}
         
-        # 日付が指定されていない場合は最新の日付
+        # 日付が指定されていない場合は質問の日付（なければ今日）
         if not date:
-            date = datetime.now().strftime('%Y-%m-%d')
+            date = context_date or datetime.now().strftime('%Y-%m-%d')
         
         # 日付範囲の設定（指定された日付から5日間）
         end_date = datetime.strptime(date, '%Y-%m-%d')
         start_date = end_date - timedelta(days=5)
         date_range = (start_date.strftime('%Y-%m-%d'), end_date.strftime('%Y-%m-%d'))
         
-        # satellite_serviceを使用してNDVIデータを取得
-        ndvi_result = get_farm_ndvi_image(farm['coordinates'], date_range)
+        # satellite_serviceを使用してNDVI統計を取得（画像は不要なので統計のみ）
+        ndvi_result = get_farm_ndvi_stats(farm['coordinates'], date_range, farm_mask=farm.get('mask'))
         
         if not ndvi_result['success']:
             return {"error": f"NDVIデータの取得に失敗しました: {ndvi_result['message']}"}
+        if 'mean' not in ndvi_result['data']['ndvi_stats']:
+            return {"error": f"NDVIデータの取得に失敗しました: {ndvi_result['data']['ndvi_stats']['message']}"}
         
-        # 履歴データをデータベースから取得
-        cursor.execute(
-            "SELECT date, mean_ndvi as value FROM farm_ndvi_history WHERE farm_id = ? ORDER BY date ASC LIMIT 10",
-            (farm['id'],)
-        )
-        history_records = cursor.fetchall()
+        # 指定日までの最新10件の履歴を取得（日付順）
+        history_records = ndvi_history.get_latest_ndvi_history(farm['id'], 10, before=end_date.strftime('%Y-%m-%d'))
         
         # 履歴データを整形
-        history = [{"date": record['date'], "value": record['value']} for record in history_records]
+        history = [{"date": record['date'], "value": record['mean']} for record in history_records]
         
         # NDVIデータを整形
         ndvi_data = {
@@ -159,89 +201,88 @@ def get_farm_ndvi_data(farm_id: str = None, date: str = None):
                 "mean": ndvi_result['data']['ndvi_stats']['mean'],
                 "median": ndvi_result['data']['ndvi_stats']['median']
             },
-            "images": {
-                "ndvi": ndvi_result['data']['ndvi_image'],
-                "rgb": ndvi_result['data']['rgb_image']
-            },
             "date_range": {
                 "start": ndvi_result['data']['start_date'],
                 "end": ndvi_result['data']['end_date']
             },
+            # 画素ごとの健康状態の区分の割合と面積
+            "health_zones": {
+                "fractions": ndvi_result['data']['health_zones']['fractions'],
+                "area_ha": ndvi_result['data']['health_zones']['area_ha']
+            },
             "history": history,
             # 作物タイプは現在のデータモデルには含まれていないため、デフォルト値または設定から取得
             "crop_type": farm.get('crop_type', "rice"),
         }
         
-        # 新しいNDVIデータを履歴に保存（同じ日付のデータがなければ）
-        cursor.execute(
-            "SELECT id FROM farm_ndvi_history WHERE farm_id = ? AND date = ?",
-            (farm['id'], end_date.strftime('%Y-%m-%d'))
+        # 新しいNDVIデータを履歴に保存（同じ日付のデータがあれば更新）
+        ndvi_history.save_ndvi_record(
+            farm['id'], end_date.strftime('%Y-%m-%d'), ndvi_data['ndvi_stats'], ndvi_data['crop_type']
         )
-        existing_record = cursor.fetchone()
-        
-        if not existing_record:
-            cursor.execute(
-                "INSERT INTO farm_ndvi_history (farm_id, date, min_ndvi, max_ndvi, mean_ndvi, median_ndvi, crop_type) VALUES (?, ?, ?, ?, ?, ?, ?)",
-                (
-                    farm['id'],
-                    end_date.strftime('%Y-%m-%d'),
-                    ndvi_data['ndvi_stats']['min'],
-                    ndvi_data['ndvi_stats']['max'],
-                    ndvi_data['ndvi_stats']['mean'],
-                    ndvi_data['ndvi_stats']['median'],
-                    ndvi_data['crop_type']
-                )
-            )
-            conn.commit()
-        
-        # 健康状態の評価
-        health_status = evaluate_ndvi_health(ndvi_data["ndvi_stats"]["mean"])
-        trend = analyze_ndvi_trend(ndvi_data["history"])
-        season = get_current_season()
-        
-        # レコメンデーションの追加
-        recommendations = NDVI_MAPPING["recommendations"][health_status]
-        
-        # 作物固有のアドバイス
-        crop_advice = NDVI_MAPPING["crops"].get(ndvi_data["crop_type"], {}).get(health_status, "")
-        
-        # 季節に応じたアドバイス
-        seasonal_advice = NDVI_MAPPING["seasonal"][season][health_status]
+        panel_cache.update(farm['id'], end_date.strftime('%Y-%m-%d'), ndvi_data['ndvi_stats']['mean'])
         
         # 結果をまとめる
-        result = {
-            **ndvi_data,
-            "analysis": {
-                "health_status": health_status,
-                "trend": trend,
-                "recommendations": recommendations,
-                "crop_specific_advice": crop_advice,
-                "seasonal_advice": seasonal_advice
-            }
-        }
-        
-        # データベース接続を閉じる
-        conn.close()
-        
-        return result
+        return {**ndvi_data, "analysis": _analyze_ndvi(ndvi_data, ndvi_result['data']['health_zones'])}
     except Exception as e:
         import traceback
         error_details = traceback.format_exc()
         return {"error": f"NDVIデータの取得に失敗しました: {str(e)}", "details": error_details}
 
+# 天気予報は同じ地点（緯度経度の小数2桁）について一定時間使い回す
+WEATHER_CACHE_TTL = 1800
+# 天気APIの応答を待つ時間（秒）
+WEATHER_REQUEST_TIMEOUT = 10
+_weather_cache = {}
+_weather_lock = threading.Lock()
+
+def fetch_weather_forecast(lat=None, lng=None):
+    """
+    指定された緯度経度の天気予報を取得する（WEATHER_CACHE_TTL秒の間は前回の結果を返す）
+    
+    Parameters:
+    lat (float): 緯度
+    lng (float): 経度
+    
+    Returns:
+    dict: 天気予報データ
+    """
+    key = (round(float(lat), 2), round(float(lng), 2)) if lat and lng else None
+    now = time.time()
+    with _weather_lock:
+        cached = _weather_cache.get(key)
+    if cached and cached[1] > now:
+        return cached[0]
+    
+    forecast = _request_weather_forecast(lat, lng)
+    if 'error' not in forecast:
+        with _weather_lock:
+            for expired in [k for k, (_, expires_at) in _weather_cache.items() if expires_at <= now]:
+                del _weather_cache[expired]
+            _weather_cache[key] = (forecast, now + WEATHER_CACHE_TTL)
+    return forecast
+
 # 追加ツール：気象データを取得するツール
 @tool
-def get_weather_forecast(lat: float = None, lng: float = None):
+def get_weather_forecast(lat: float = None, lng: float = None, config: RunnableConfig = None):
     """
     指定された緯度経度の天気予報を取得する
     
     Parameters:
-    lat (float): 緯度
-    lng (float): 経度
+    lat (float): 緯度（指定がない場合は選択中の農場の位置）
+    lng (float): 経度（指定がない場合は選択中の農場の位置）
     
     Returns:
     dict: 天気予報データ
     """
+    if not (lat and lng):
+        owner_id, farm_id, _ = _tool_context(config)
+        farm = _find_farm(farm_id, owner_id)
+        if farm and farm.get('coordinates'):
+            location = farm['coordinates'][0] if isinstance(farm['coordinates'], list) else farm['coordinates']
+            lat, lng = location.get('lat'), location.get('lng')
+    return fetch_weather_forecast(lat, lng)
+
+def _request_weather_forecast(lat=None, lng=None):
     try:
         import requests
         from datetime import datetime, timedelta
@@ -344,7 +385,7 @@ def get_weather_forecast(lat: float = None, lng: float = None):
             "alerts": "yes"
         }
         
-        response = requests.get(forecast_endpoint, params=params)
+        response = requests.get(forecast_endpoint, params=params, timeout=WEATHER_REQUEST_TIMEOUT)
         
         if response.status_code == 200:
             data = response.json()
@@ -416,7 +457,7 @@ def get_weather_forecast(lat: float = None, lng: float = None):
 
 # 追加ツール：農作業カレンダーを取得するツール
 @tool
-def get_farming_calendar(crop_type: str = None, region: str = None):
+def get_farming_calendar(crop_type: str = None, region: str = None, config: RunnableConfig = None):
     """
     特定の作物と地域の農作業カレンダーを取得する
     
@@ -428,191 +469,163 @@ def get_farming_calendar(crop_type: str = None, region: str = None):
     dict: 農作業カレンダーのデータ
     """
     try:
-        # 作物カレンダーのデータ
-        calendars = {
-            "rice": {
-                "北海道": {
-                    "1月": ["休耕期", "来年の生産計画を立てる"],
-                    "2月": ["休耕期", "種子の準備"],
-                    "3月": ["休耕期", "苗床の準備"],
-                    "4月": ["苗床準備", "育苗開始"],
-                    "5月": ["田植え", "肥料散布"],
-                    "6月": ["水管理", "除草"],
-                    "7月": ["水管理", "病害虫防除"],
-                    "8月": ["水管理", "出穂期の管理"],
-                    "9月": ["落水", "刈り取り準備"],
-                    "10月": ["収穫", "乾燥・調製"],
-                    "11月": ["稲わら処理", "土壌改良"],
-                    "12月": ["休耕期", "機械メンテナンス"]
-                },
-                "東北": {
-                    "1月": ["休耕期", "生産計画策定"],
-                    "2月": ["休耕期", "種子消毒"],
-                    "3月": ["育苗準備", "温湯種子消毒"],
-                    "4月": ["育苗", "本田準備"],
-                    "5月": ["田植え", "初期水管理"],
-                    "6月": ["除草", "中干し"],
-                    "7月": ["水管理", "病害虫防除"],
-                    "8月": ["出穂期管理", "水管理"],
-                    "9月": ["落水", "刈り取り準備"],
-                    "10月": ["収穫", "乾燥調製"],
-                    "11月": ["稲わら処理", "土づくり"],
-                    "12月": ["休耕期", "農業機械整備"]
-                },
-                "関東": {
-                    "1月": ["休耕期", "計画策定"],
-                    "2月": ["休耕期", "種子準備"],
-                    "3月": ["育苗準備", "種まき"],
-                    "4月": ["育苗管理", "本田準備"],
-                    "5月": ["田植え", "水管理"],
-                    "6月": ["除草", "中干し"],
-                    "7月": ["水管理", "病害虫防除"],
-                    "8月": ["出穂・開花", "水管理"],
-                    "9月": ["落水", "収穫準備"],
-                    "10月": ["収穫", "乾燥調製"],
-                    "11月": ["わら処理", "土づくり"],
-                    "12月": ["休耕期", "次年度準備"]
-                }
-            },
-            "wheat": {
-                "北海道": {
-                    "1月": ["雪害対策", "排水対策"],
-                    "2月": ["雪害対策", "排水対策"],
-                    "3月": ["融雪対策", "追肥"],
-                    "4月": ["追肥", "病害虫防除"],
-                    "5月": ["病害虫防除", "生育調査"],
-                    "6月": ["穂肥", "赤かび病防除"],
-                    "7月": ["収穫準備", "収穫"],
-                    "8月": ["収穫", "わら処理"],
-                    "9月": ["土づくり", "は種準備"],
-                    "10月": ["は種", "基肥"],
-                    "11月": ["越冬準備", "排水対策"],
-                    "12月": ["越冬管理", "積雪対策"]
-                }
-            },
-            "vegetables": {
-                "関東": {
-                    "1月": ["ハウス栽培", "霜対策"],
-                    "2月": ["育苗", "土壌準備"],
-                    "3月": ["春野菜の植付け", "土壌改良"],
-                    "4月": ["春野菜の管理", "追肥"],
-                    "5月": ["病害虫防除", "収穫開始"],
-                    "6月": ["梅雨対策", "夏野菜の植付け"],
-                    "7月": ["夏野菜の管理", "高温対策"],
-                    "8月": ["かん水", "秋野菜の準備"],
-                    "9月": ["秋野菜の植付け", "台風対策"],
-                    "10月": ["秋野菜の管理", "収穫"],
-                    "11月": ["晩秋野菜の収穫", "土づくり"],
-                    "12月": ["冬野菜の管理", "霜対策"]
-                }
-            },
-            "soybean": {
-                "東北": {
-                    "1月": ["休耕期", "計画策定"],
-                    "2月": ["休耕期", "種子選別"],
-                    "3月": ["休耕期", "土壌診断"],
-                    "4月": ["圃場準備", "土壌改良"],
-                    "5月": ["圃場準備", "播種準備"],
-                    "6月": ["播種", "初期管理"],
-                    "7月": ["中耕・培土", "病害虫防除"],
-                    "8月": ["開花期管理", "病害虫防除"],
-                    "9月": ["莢伸長期管理", "排水対策"],
-                    "10月": ["収穫準備", "収穫"],
-                    "11月": ["収穫", "乾燥調製"],
-                    "12月": ["休耕期", "土づくり"]
-                }
-            }
-        }
-        
-        # デフォルト値を設定
-        if not crop_type:
-            crop_type = "rice"
-        if not region:
-            region = "関東"
-        
-        # 指定された作物と地域のカレンダーを取得
-        if crop_type in calendars:
-            if region in calendars[crop_type]:
-                calendar_data = calendars[crop_type][region]
-            else:
-                # 地域が見つからない場合は最初の地域を使用
-                first_region = next(iter(calendars[crop_type]))
-                calendar_data = calendars[crop_type][first_region]
-                region = first_region
-        else:
-            # 作物が見つからない場合はコメのカレンダーを使用
-            calendar_data = calendars["rice"]["関東"]
-            crop_type = "rice"
-            region = "関東"
-        
-        # 現在の月に基づいて今月と次月の作業を特定
-        current_month = datetime.now().month
-        current_month_str = f"{current_month}月"
-        next_month = current_month + 1 if current_month < 12 else 1
-        next_month_str = f"{next_month}月"
-        
-        # 結果の整形
-        result = {
-            "crop_type": crop_type,
-            "region": region,
-            "calendar": calendar_data,
-            "current_tasks": calendar_data.get(current_month_str, ["データなし"]),
-            "next_month_tasks": calendar_data.get(next_month_str, ["データなし"]),
-            "season_tips": {}
-        }
-        
-        # 季節に応じたヒントを追加
-        season = get_current_season()
-        if season == "spring":
-            result["season_tips"] = {
-                "rice": "苗の健全な生育を促すため、育苗期の温度管理に注意してください。昼夜の温度差が大きい場合は保温対策を。",
-                "wheat": "春の追肥のタイミングは茎立ち期直前が最適です。窒素過多に注意して施肥量を調整してください。",
-                "vegetables": "春野菜の定植後は急な低温に注意。不織布などで保護する準備をしておきましょう。",
-                "soybean": "播種前の土壌水分と地温の確認が重要です。地温が15℃以上になってから播種すると発芽が良好になります。"
-            }
-        elif season == "summer":
-            result["season_tips"] = {
-                "rice": "高温期の水管理が重要です。特に開花期には深水管理を行い、受精障害を防止しましょう。",
-                "wheat": "収穫時期の雨に注意。刈り遅れると品質低下を招きます。天候予報を確認して適期収穫に努めてください。",
-                "vegetables": "夏野菜の収穫適期を逃さないように注意。朝夕の涼しい時間帯に収穫すると鮮度が保たれます。",
-                "soybean": "開花期・莢形成期の水分ストレスは収量に大きく影響します。土壌水分をチェックし、必要に応じて灌水してください。"
-            }
-        elif season == "autumn":
-            result["season_tips"] = {
-                "rice": "収穫時期の判断は籾の黄化率で行います。適期収穫で高品質米を目指しましょう。",
-                "wheat": "播種適期は地域によって異なります。適期内播種で越冬前に十分な生育量を確保しましょう。",
-                "vegetables": "秋野菜の定植後は害虫対策が重要です。防虫ネットの活用や早期発見・早期防除を心がけてください。",
-                "soybean": "収穫時の豆の水分含量は適正値（15%程度）を目安にしてください。刈り遅れると品質低下につながります。"
-            }
-        else:  # winter
-            result["season_tips"] = {
-                "rice": "休閑期の土づくりが翌年の収量・品質に影響します。土壌診断に基づいた土壌改良を計画的に。",
-                "wheat": "積雪地域では雪腐病対策が重要です。根雪前の防除を忘れずに実施してください。",
-                "vegetables": "ハウス栽培では温度管理と換気のバランスに注意。日中の温度上昇と夜間の冷え込みに対応した管理を。",
-                "soybean": "次期作に向けた土壌分析と施肥設計を行う時期です。土壌診断結果に基づいた土づくりを計画しましょう。"
-            }
-        
-        # 作物固有のヒントを追加
-        result["crop_specific_tip"] = result["season_tips"].get(crop_type, "データなし")
-        
-        return result
-    
+        # 質問の日付があればその月の作業を返す
+        _, _, date = _tool_context(config)
+        return get_calendar(crop_type, region, int(date[5:7]) if date else None)
     except Exception as e:
         return {"error": f"農作業カレンダーの取得中にエラーが発生しました: {str(e)}"}
 
+class ChatState(MessagesState):
+    """会話の状態（メッセージに加えて、元の質問・ルーターが選んだ回答経路・古いターンの要約）"""
+    question: str
+    route: str
+    summary: str
+
+# 意図ごとにあらかじめ実行するツール（assisted経路）
+INTENT_TOOLS = {
+    "calendar": "get_farming_calendar",
+    "history": "get_farm_ndvi_data",
+    "ndvi": "get_farm_ndvi_data",
+    "weather": "get_weather_forecast",
+    "management": "retrieve",
+}
+# この日数以内のNDVI履歴があれば、衛星データを取得せずにテンプレートで回答する
+NDVI_HISTORY_MAX_AGE_DAYS = 5
+
+def _template_answer(intent, config):
+    """
+    農作業カレンダー・NDVI_MAPPING・NDVIの履歴からテンプレートで回答する
+    
+    Parameters:
+    intent (str): 質問の意図（calendar, history, ndvi）
+    config (RunnableConfig): 農場のコンテキストを含むグラフの設定
+    
+    Returns:
+    str or None: 回答（データが足りず回答できない場合は None）
+    """
+    owner_id, farm_id, date = _tool_context(config)
+    date = date or datetime.now().strftime('%Y-%m-%d')
+    farm = _find_farm(farm_id, owner_id)
+    
+    if intent == "calendar":
+        month = int(date[5:7])
+        return render_calendar_answer(get_calendar(farm.get('crop_type') if farm else None, None, month), month)
+    if not farm:
+        return None
+    
+    records = [record for record in ndvi_history.get_latest_ndvi_history(farm['id'], 10, before=date)
+               if record['mean'] is not None]
+    history = [{"date": record['date'], "value": record['mean']} for record in records]
+    if intent == "history":
+        if len(history) < 2:
+            return None
+        return render_history_answer(farm['name'], history, analyze_ndvi_trend(history))
+    
+    # 直近の履歴が古い（またはない）場合は衛星データの取得が必要なため、テンプレートでは回答しない
+    # （assisted経路でツールの実行時間の上限付きで取得する）
+    if not records or (datetime.strptime(date, '%Y-%m-%d') - datetime.strptime(records[-1]['date'], '%Y-%m-%d')).days > NDVI_HISTORY_MAX_AGE_DAYS:
+        return None
+    latest = records[-1]
+    ndvi_data = {
+        "farm_name": farm['name'],
+        "date": latest['date'],
+        "ndvi_stats": {key: latest[key] for key in ('min', 'max', 'mean', 'median')},
+        "history": history,
+        "crop_type": farm.get('crop_type') or "rice",
+    }
+    return render_ndvi_answer({**ndvi_data, "analysis": _analyze_ndvi(ndvi_data)})
+
+# Step 0: Route the question before involving the model.
+def route_question(state: ChatState, config: RunnableConfig):
+    """Answer from a template, pre-invoke the tools for a single generate call, or hand over to the agent."""
+    question = state.get("question") or state["messages"][-1].content
+    route, intents = classify_question(question)
+    if route == "template":
+        answer = _template_answer(intents[0], config)
+        if answer is not None:
+            return {"messages": [AIMessage(content=answer)], "route": "template"}
+        route = "assisted"
+    if route == "assisted":
+        tool_names = list(dict.fromkeys(INTENT_TOOLS[intent] for intent in intents))
+        tool_calls = [
+            {"name": name, "args": {"query": question} if name == "retrieve" else {}, "id": f"route_{uuid.uuid4().hex[:12]}"}
+            for name in tool_names
+        ]
+        return {"messages": [AIMessage(content="", tool_calls=tool_calls)], "route": "assisted"}
+    return {"route": "agent"}
+
 # Step 1: Generate an AIMessage that may include a tool-call to be sent.
-def query_or_respond(state: MessagesState):
+def query_or_respond(state: ChatState):
     """Generate tool call for retrieval or respond."""
-    llm_with_tools = model.bind_tools([retrieve, get_farm_ndvi_data, get_weather_forecast, get_farming_calendar])
-    response = llm_with_tools.invoke(state["messages"])
+    llm_with_tools = get_model().bind_tools(TOOLS)
+    summary = state.get("summary")
+    prompt = ([SystemMessage(f"これまでの会話の要約:\n{summary}")] if summary else []) + state["messages"]
+    response = llm_with_tools.invoke(prompt)
     # MessagesState appends messages to state instead of overwriting
     return {"messages": [response]}
 
 # Step 2: Execute the tools.
-tools = ToolNode([retrieve, get_farm_ndvi_data, get_weather_forecast, get_farming_calendar])
+TOOLS = [retrieve, get_farm_ndvi_data, get_weather_forecast, get_farming_calendar]
+TOOLS_BY_NAME = {t.name: t for t in TOOLS}
+
+# ツールごとの実行時間の上限（秒）。超えた場合はそのツールの結果なしで回答を生成する
+TOOL_TIMEOUTS = {
+    "retrieve": 15,
+    "get_farm_ndvi_data": 90,
+    "get_weather_forecast": 15,
+    "get_farming_calendar": 5,
+}
+DEFAULT_TOOL_TIMEOUT = 30
+
+# ツールはネットワークや衛星データの待ちが中心のため、スレッドプールで並行に実行する。
+# 期限を過ぎても実行中のツールは止められないため、プールはツールごとに分け、
+# 遅い衛星データの取得がほかのツールのワーカーを占有しないようにする
+TOOL_WORKERS = {
+    "get_farm_ndvi_data": int(os.getenv("CHATBOT_NDVI_TOOL_WORKERS", 4)),
+}
+DEFAULT_TOOL_WORKERS = int(os.getenv("CHATBOT_TOOL_WORKERS", 4))
+_tool_executors = {
+    name: ThreadPoolExecutor(max_workers=TOOL_WORKERS.get(name, DEFAULT_TOOL_WORKERS),
+                             thread_name_prefix=f"chatbot-{name}")
+    for name in TOOLS_BY_NAME
+}
+
+def run_tools(state: MessagesState, config: RunnableConfig):
+    """Execute the requested tool calls concurrently, each with its own timeout."""
+    tool_calls = state["messages"][-1].tool_calls
+    started = time.monotonic()
+    futures = []
+    for tool_call in tool_calls:
+        selected_tool = TOOLS_BY_NAME.get(tool_call["name"])
+        if selected_tool is None:
+            futures.append(None)
+            continue
+        # 呼び出し元のコンテキスト（コールバックなど）を引き継いで実行する
+        futures.append(_tool_executors[tool_call["name"]].submit(
+            copy_context().run, selected_tool.invoke, {**tool_call, "type": "tool_call"}, config
+        ))
+    
+    messages = []
+    for tool_call, future in zip(tool_calls, futures):
+        name = tool_call["name"]
+        timeout = TOOL_TIMEOUTS.get(name, DEFAULT_TOOL_TIMEOUT)
+        if future is None:
+            content = f"不明なツールです: {name}"
+        else:
+            try:
+                # すべてのツールは同時に開始しているため、期限は開始時刻から数える
+                messages.append(future.result(timeout=max(0, started + timeout - time.monotonic())))
+                continue
+            except FutureTimeoutError:
+                future.cancel()
+                content = f"{name} が {timeout} 秒以内に完了しませんでした。このツールの結果を使わずに回答してください。"
+            except Exception as e:
+                content = f"{name} の実行中にエラーが発生しました: {str(e)}"
+        messages.append(ToolMessage(content=content, name=name, tool_call_id=tool_call["id"], status="error"))
+    return {"messages": messages}
 
 # Step 3: Generate a response using the retrieved content.
-def generate(state: MessagesState):
+def generate(state: ChatState):
     """Generate answer."""
     # Get generated ToolMessages
     recent_tool_messages = []
@@ -633,6 +646,8 @@ def generate(state: MessagesState):
         "\n\n"
         f"{docs_content}"
     )
+    if state.get("summary"):
+        system_message_content += f"\n\nこれまでの会話の要約:\n{state['summary']}"
     conversation_messages = [
         message
         for message in state["messages"]
@@ -642,35 +657,200 @@ def generate(state: MessagesState):
     prompt = [SystemMessage(system_message_content)] + conversation_messages
 
     # Run
-    response = model.invoke(prompt)
+    response = get_model().invoke(prompt)
     return {"messages": [response]}
 
-from langgraph.graph import END
-from langgraph.prebuilt import ToolNode, tools_condition
+# Step 4: Keep the thread within the turn and token caps.
+# 会話スレッドの上限。超えた場合は古いターンを要約し、直近のターンだけを残す
+MAX_HISTORY_TURNS = int(os.getenv("CHATBOT_MAX_HISTORY_TURNS", 10))
+MAX_HISTORY_TOKENS = int(os.getenv("CHATBOT_MAX_HISTORY_TOKENS", 6000))
+KEEP_HISTORY_TURNS = int(os.getenv("CHATBOT_KEEP_HISTORY_TURNS", 4))
+SUMMARY_MAX_CHARS = 800
 
-graph_builder.add_node(query_or_respond)
-graph_builder.add_node(tools)
-graph_builder.add_node(generate)
+def _is_dialogue(message):
+    """農家の質問とAIの回答（ツールの呼び出しと結果以外）かどうか"""
+    return message.type == "human" or (message.type == "ai" and not message.tool_calls)
 
-graph_builder.set_entry_point("query_or_respond")
-graph_builder.add_conditional_edges(
-    "query_or_respond",
-    tools_condition, # 分岐条件を判断する関数
-    {END: "generate", "tools": "tools"},
-)
-graph_builder.add_edge("tools", "generate")
-graph_builder.add_edge("generate", END)
+def _estimate_tokens(message):
+    """メッセージのトークン数の概算（日本語は1文字がおおよそ1トークンのため文字数で数える）"""
+    content = message.content if isinstance(message.content, str) else json.dumps(message.content, ensure_ascii=False)
+    return len(content)
 
-graph = graph_builder.compile()
-from langgraph.checkpoint.memory import MemorySaver
+def _summarize_turns(summary, messages):
+    """これまでの要約と古いターンをまとめて新しい要約を作る（失敗した場合は前の要約を返す）"""
+    conversation = "\n".join(
+        f"{'農家' if message.type == 'human' else 'AI'}: {message.content}"
+        for message in messages if message.content
+    )
+    instruction = (
+        "以下の農家と農業アドバイザーAIの会話を、以降の回答に必要な事実（農場、作物、日付、NDVIの値、助言の要点）を残して、"
+        f"日本語で{SUMMARY_MAX_CHARS // 2}文字程度に要約してください。"
+    )
+    if summary:
+        instruction += f"\n\nこれまでの要約:\n{summary}"
+    try:
+        response = get_model().invoke([SystemMessage(instruction), HumanMessage(conversation)])
+        return response.content[:SUMMARY_MAX_CHARS]
+    except Exception as e:
+        print(f"会話の要約に失敗しました: {str(e)}")
+        return summary
 
-memory = MemorySaver()
-graph = graph_builder.compile(checkpointer=memory)
+def compact_history(state: ChatState):
+    """Drop earlier turns' tool traffic, and summarise the oldest turns once the dialogue exceeds the caps."""
+    messages = state["messages"]
+    turn_starts = [i for i, message in enumerate(messages) if message.type == "human"]
+    if not turn_starts:
+        return {}
+    
+    # 前のターンのツールの呼び出しと結果は回答の生成に使わないため、要約せずに削除する
+    # （上限の判定も質問と回答の文字数だけで行う）
+    removed = [message for message in messages[:turn_starts[-1]] if not _is_dialogue(message)]
+    tokens = [_estimate_tokens(message) if _is_dialogue(message) else 0 for message in messages]
+    if len(turn_starts) <= MAX_HISTORY_TURNS and sum(tokens) <= MAX_HISTORY_TOKENS:
+        return {"messages": [RemoveMessage(id=message.id) for message in removed]} if removed else {}
+    
+    # 直近のターンを残す（残すターンだけで上限を超える場合は、最後のターンまで減らす）
+    keep = min(KEEP_HISTORY_TURNS, len(turn_starts))
+    while keep > 1 and sum(tokens[turn_starts[-keep]:]) > MAX_HISTORY_TOKENS:
+        keep -= 1
+    old_messages = messages[:turn_starts[-keep]]
+    removed_ids = {message.id for message in old_messages} | {message.id for message in removed}
+    if not old_messages:
+        return {"messages": [RemoveMessage(id=message_id) for message_id in removed_ids]} if removed_ids else {}
+    return {
+        "messages": [RemoveMessage(id=message_id) for message_id in removed_ids],
+        "summary": _summarize_turns(state.get("summary", ""), [m for m in old_messages if _is_dialogue(m)]),
+    }
 
-# Specify an ID for the thread
-config = {"configurable": {"thread_id": "abd153"}}
+# 会話はSQLiteに保存し、再起動後やワーカー間でも同じスレッドを続けられるようにする
+memory = conversation_store
 
-def generate_rag_response(user_input, farm_id=None, date=None):
+def _build_graph():
+    graph_builder = StateGraph(ChatState)
+    graph_builder.add_node("router", route_question)
+    graph_builder.add_node(query_or_respond)
+    graph_builder.add_node("tools", run_tools)
+    graph_builder.add_node(generate)
+    graph_builder.add_node(compact_history)
+
+    graph_builder.set_entry_point("router")
+    graph_builder.add_conditional_edges(
+        "router",
+        lambda state: state["route"],
+        {"template": "compact_history", "assisted": "tools", "agent": "query_or_respond"},
+    )
+    graph_builder.add_conditional_edges(
+        "query_or_respond",
+        tools_condition, # 分岐条件を判断する関数
+        {END: "generate", "tools": "tools"},
+    )
+    graph_builder.add_edge("tools", "generate")
+    graph_builder.add_edge("generate", "compact_history")
+    graph_builder.add_edge("compact_history", END)
+
+    return graph_builder.compile(checkpointer=memory)
+
+def get_graph():
+    """LangGraphのグラフを返す（最初の呼び出し時に一度だけコンパイルする）"""
+    global _graph
+    if _graph is None:
+        with _init_lock:
+            if _graph is None:
+                _graph = _build_graph()
+    return _graph
+
+# 回答キャッシュのキーに使うNDVIの区分の幅
+NDVI_BUCKET_WIDTH = 0.05
+
+def _weather_bucket(forecast):
+    """天気予報を回答が変わる程度の区分（3日間の降雨の有無と5℃刻みの気温）にまとめる"""
+    if 'error' in forecast:
+        return None
+    rain = tuple(day['precip_mm'] > 1.0 for day in forecast['forecast'][:3])
+    return rain + (round(forecast['current']['temp_c'] / 5),)
+
+def _farm_state(farm, date):
+    """
+    回答キャッシュのキーに使う農場の状態を返す
+    
+    Parameters:
+    farm (dict): 農場データ（ない場合は None）
+    date (str): 日付（YYYY-MM-DD）
+    
+    Returns:
+    tuple: (NDVIの区分, 健康状態, 最新の撮影日, 天気の区分)
+    """
+    if not farm:
+        return (None, None, None, _weather_bucket(fetch_weather_forecast()))
+    
+    from app.services.satellite_service import date_catalog, DEFAULT_MAX_CLOUD_COVER
+    
+    ndvi_bucket = health = None
+    records = ndvi_history.get_latest_ndvi_history(farm['id'], 1, before=date)
+    if records and records[-1]['mean'] is not None:
+        ndvi_bucket = round(records[-1]['mean'] / NDVI_BUCKET_WIDTH)
+        health = evaluate_ndvi_health(records[-1]['mean'])
+    
+    # 新しい撮影があれば（NDVIの履歴が更新される前でも）別の状態として扱う
+    acquisitions = date_catalog.get_acquisitions(farm['bbox'], DEFAULT_MAX_CLOUD_COVER, block=False)
+    acquired = next((a['date'] for a in acquisitions if a['date'] <= date), None)
+    
+    location = farm['coordinates'][0] if isinstance(farm['coordinates'], list) else farm['coordinates']
+    weather = _weather_bucket(fetch_weather_forecast(location.get('lat'), location.get('lng')))
+    return (ndvi_bucket, health, acquired, weather)
+
+def _prepare_turn(user_input, farm, owner_id, farm_id=None, date=None, thread_id=None):
+    """
+    質問を農場の情報で補い、会話スレッドの設定とともに返す
+    （セッションにスレッドIDを保存するため、リクエストの処理中に呼び出す）
+    
+    Parameters:
+    user_input (str): ユーザーの質問
+    farm (dict): 対象の農場（ない場合は None）
+    owner_id (str): 利用者ID
+    farm_id (str): 指定された農場ID
+    date (str): 日付
+    thread_id (str): 会話スレッドID（省略時はセッションの会話スレッド）
+    
+    Returns:
+    tuple: (グラフに渡すメッセージ, グラフの設定)
+    """
+    from flask import session
+    
+    # ユーザークエリの拡張
+    enhanced_query = user_input
+    
+    # 農場データをコンテキストに追加
+    farm_context = ""
+    if farm:
+        farm_context = f"対象の農場: {farm['name']} (ID: {farm['id']})"
+        if 'coordinates' in farm:
+            location = farm['coordinates'][0] if isinstance(farm['coordinates'], list) else farm['coordinates']
+            farm_context += f", 位置情報: 緯度 {location.get('lat', '不明')}, 経度 {location.get('lng', '不明')}"
+    
+    # NDVI関連の質問に対応する入力の修正
+    if is_ndvi_query(user_input):
+        if farm_id:
+            enhanced_query += f" (農場ID: {farm_id})"
+        if date:
+            enhanced_query += f" (日付: {date})"
+        enhanced_query += f"\n\n{farm_context}"
+    
+    # thread_idを使って会話の状態を維持
+    if thread_id is None:
+        thread_id = session.get('thread_id', f"user_{session.get('user_id', 'anonymous')}_{datetime.now().strftime('%Y%m%d%H%M%S')}")
+        session['thread_id'] = thread_id
+    
+    # ツールは別スレッドで実行されるため、農場のコンテキストは設定で明示的に渡す
+    config = {"configurable": {
+        "thread_id": thread_id,
+        "owner_id": owner_id,
+        "farm_id": farm['id'] if farm else None,
+        "date": date,
+    }}
+    return {"role": "user", "content": enhanced_query}, config
+
+def generate_rag_response(user_input, farm_id=None, date=None, use_cache=False):
     """
     RAGを用いた回答生成関数
     Graphを使用して回答を生成する
@@ -679,90 +859,125 @@ def generate_rag_response(user_input, farm_id=None, date=None):
     user_input (str): ユーザーの質問
     farm_id (str): 農場ID（オプション）
     date (str): 日付（オプション）
+    use_cache (bool): 農場の状態が変わっていなければ保存済みの回答を返す（会話の文脈に依存しない定型の質問用）
     
     Returns:
     str: 生成された回答
     """
     try:
-        from flask import session, current_app
-        import json
-        from app.services.satellite_service import get_farm_ndvi_image
-        
-        # NDVIに関する質問であればフラグを設定
-        is_ndvi_query = any(keyword in user_input.lower() for keyword in 
-                         ['ndvi', '植生指数', '生育状況', '健康状態', '畑の状態', '作物の状態', 
-                          '畑', '田んぼ', '農場', '作物', '生育', '肥料', '農薬', '栄養', '収穫'])
-        
-        # 天気予報に関する質問
-        is_weather_query = any(keyword in user_input.lower() for keyword in 
-                           ['天気', '気象', '雨', '晴れ', '気温', '湿度', '予報'])
-        
-        # 農場管理に関する質問
-        is_management_query = any(keyword in user_input.lower() for keyword in 
-                              ['管理', '施肥', '灌水', '病害虫', '除草', '間引き', '収穫時期'])
-        
-        # ユーザークエリの拡張
-        enhanced_query = user_input
-        
-        # 農場データを取得してコンテキストに追加
-        farm_context = ""
-        with current_app.app_context():
-            farms = session.get('farms', [])
-            
-            # 指定されたIDの農場を検索、なければ最初の農場を使用
-            if farm_id:
-                farm = next((f for f in farms if f['id'] == int(farm_id)), None)
-            else:
-                farm = farms[0] if farms else None
-            
-            if farm:
-                farm_context = f"対象の農場: {farm['name']} (ID: {farm['id']})"
-                if 'coordinates' in farm:
-                    location = farm['coordinates'][0] if isinstance(farm['coordinates'], list) else farm['coordinates']
-                    farm_context += f", 位置情報: 緯度 {location.get('lat', '不明')}, 経度 {location.get('lng', '不明')}"
-        
-        # NDVI関連の質問に対応する入力の修正
-        if is_ndvi_query:
-            if farm_id:
-                enhanced_query += f" (農場ID: {farm_id})"
-            if date:
-                enhanced_query += f" (日付: {date})"
-            enhanced_query += f"\n\n{farm_context}"
-        
-        # 会話履歴を使用して応答を生成
-        # thread_idを使って会話の状態を維持
-        thread_id = session.get('thread_id', f"user_{session.get('user_id', 'anonymous')}_{datetime.now().strftime('%Y%m%d%H%M%S')}")
-        session['thread_id'] = thread_id
-        
-        config = {"configurable": {"thread_id": thread_id}}
+        started = time.monotonic()
+        owner_id = current_owner_id()
+        farm = _find_farm(farm_id, owner_id)
+        
+        # 農場の状態が前回と同じであれば保存済みの回答を返す
+        if use_cache:
+            cache_date = date or datetime.now().strftime('%Y-%m-%d')
+            question_vector = None
+            if response_cache.similarity_threshold is not None:
+                question_vector = get_embedding_model().embed_query(user_input)
+            cached = response_cache.get(
+                response_cache.make_key(user_input, farm and farm['id'], _farm_state(farm, cache_date), cache_date),
+                question_vector
+            )
+            if cached is not None:
+                route_latency.record("cache", time.monotonic() - started)
+                return cached
         
-        # 新しいメッセージを追加
-        new_message = {"role": "user", "content": enhanced_query}
+        # キャッシュする定型の質問は、回答が利用者の会話履歴に左右されず、会話にも残らないように
+        # 使い捨てのスレッドで回答する
+        thread_id = f"cached_{farm and farm['id']}_{uuid.uuid4().hex}" if use_cache else None
+        new_message, config = _prepare_turn(user_input, farm, owner_id, farm_id, date, thread_id)
         
-        # MemorySaverを使って会話履歴を取得・更新
+        # 会話履歴はチェックポインターがスレッドごとに保持しているため、新しいメッセージだけを渡す
         try:
-            # 既存の会話履歴を取得
-            thread_config = {"configurable": {"thread_id": thread_id}}
-            current_state = memory.get(thread_id)
-            
-            if current_state:
-                # 既存の会話履歴に新しいメッセージを追加
-                current_messages = current_state["messages"]
-                current_messages.append(new_message)
-                response = graph.invoke({"messages": current_messages}, config=thread_config)
-            else:
-                # 新しい会話を開始
-                response = graph.invoke({"messages": [new_message]}, config=thread_config)
-        except Exception as e:
-            # 会話履歴の取得に失敗した場合は新しい会話を開始
-            print(f"会話履歴の取得に失敗しました: {str(e)}")
-            response = graph.invoke({"messages": [new_message]}, config=thread_config)
+            response = get_graph().invoke({"messages": [new_message], "question": user_input}, config=config)
+        finally:
+            if use_cache:
+                memory.delete_thread(thread_id)
         
         # 最後のAIメッセージを取得
         ai_message = response["messages"][-1].content
+        route_latency.record(response.get("route", "agent"), time.monotonic() - started)
+        
+        # 回答中にツールがNDVIの履歴を更新した場合があるため、状態を取り直してから保存する
+        if use_cache:
+            response_cache.put(
+                response_cache.make_key(user_input, farm and farm['id'], _farm_state(farm, cache_date), cache_date),
+                ai_message, question_vector
+            )
         
         return ai_message
     except Exception as e:
         import traceback
         error_details = traceback.format_exc()
-        return f"申し訳ありません。応答の生成中にエラーが発生しました: {str(e)}"
\ No newline at end of file
+        return f"申し訳ありません。応答の生成中にエラーが発生しました: {str(e)}"
+
+# ストリーミングで進捗を通知するツール名の表示名
+TOOL_LABELS = {
+    "retrieve": "農業ナレッジベースを検索",
+    "get_farm_ndvi_data": "衛星データからNDVIを取得",
+    "get_weather_forecast": "天気予報を取得",
+    "get_farming_calendar": "農作業カレンダーを確認",
+}
+
+def stream_rag_response(user_input, farm_id=None, date=None):
+    """
+    RAGを用いた回答をストリーミングで生成する
+    農場の取得と会話スレッドの準備はこの関数の呼び出し時に行い、
+    グラフの実行は返されたジェネレータを読み進めたときに行う
+    
+    Parameters:
+    user_input (str): ユーザーの質問
+    farm_id (str): 農場ID（オプション）
+    date (str): 日付（オプション）
+    
+    Returns:
+    generator: {'event': イベント名, 'data': 内容} のイベント
+        tool_start: {'name', 'label'}（ツールの実行開始）
+        tool_end: {'name', 'label'}（ツールの実行終了）
+        token: 回答の断片（str）
+        done: 回答全体（str）
+        error: エラーメッセージ（str）
+    """
+    owner_id = current_owner_id()
+    farm = _find_farm(farm_id, owner_id)
+    new_message, config = _prepare_turn(user_input, farm, owner_id, farm_id, date)
+    
+    def events():
+        started = time.monotonic()
+        answer = []
+        route = "agent"
+        try:
+            for mode, chunk in get_graph().stream({"messages": [new_message], "question": user_input}, config=config,
+                                                  stream_mode=["messages", "updates"]):
+                if mode == "messages":
+                    message, metadata = chunk
+                    # 最終回答（generateノード）のトークンだけを送る
+                    if metadata.get("langgraph_node") == "generate" and message.content:
+                        answer.append(message.content)
+                        yield {"event": "token", "data": message.content}
+                    continue
+                
+                for node, update in chunk.items():
+                    if node == "router":
+                        route = update["route"]
+                    for message in (update or {}).get("messages", []):
+                        if node == "router" and message.content:
+                            # テンプレートの回答は一度に送る
+                            answer.append(message.content)
+                            yield {"event": "token", "data": message.content}
+                        if node in ("router", "query_or_respond"):
+                            for tool_call in getattr(message, "tool_calls", None) or []:
+                                yield {"event": "tool_start", "data": {
+                                    "name": tool_call["name"], "label": TOOL_LABELS.get(tool_call["name"], tool_call["name"])
+                                }}
+                        if node == "tools":
+                            yield {"event": "tool_end", "data": {
+                                "name": message.name, "label": TOOL_LABELS.get(message.name, message.name)
+                            }}
+            route_latency.record(route, time.monotonic() - started)
+            yield {"event": "done", "data": "".join(answer)}
+        except Exception as e:
+            yield {"event": "error", "data": f"申し訳ありません。応答の生成中にエラーが発生しました: {str(e)}"}
+    
+    return events()